@@ -1,7 +1,9 @@
 # encoding=utf-8
 
 import numpy as np
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
+
+from tracking_utils.basetrack import KalmanTableTrack, TrackIdAllocator
 
 
 class TrackState(object):
@@ -15,11 +17,13 @@ class TrackState(object):
 
 
 # Create a multi-object class BaseTrack class
-class MCBaseTrack(object):
+class MCBaseTrack(KalmanTableTrack):
     """
     Multi-class Base track
     """
-    _id_dict = defaultdict(int)  # the MCBaseTrack class owns this dict
+    # track id allocator of the owning tracker(set by activate),
+    # the class-level one is shared by the tracks not bound to any tracker's allocator
+    id_allocator = TrackIdAllocator()
 
     track_id = 0
     is_activated = False
@@ -47,28 +51,24 @@ class MCBaseTrack(object):
     @staticmethod
     def init_id_dict(num_classes):
         """
-        Initiate _count for all object classes
+        Initiate the shared track id counter for all object classes
         :param num_classes:
         """
-        for cls_id in range(num_classes):
-            MCBaseTrack._id_dict[cls_id] = 0
+        MCBaseTrack.id_allocator.init_id_dict(num_classes)
 
-    @staticmethod
-    def next_id(cls_id):
+    def next_id(self, cls_id):
         """
         :param cls_id:
         :return:
         """
-        MCBaseTrack._id_dict[cls_id] += 1
-        return MCBaseTrack._id_dict[cls_id]
+        return self.id_allocator.next_id(cls_id)
 
-    @staticmethod
-    def reset_track_id(cls_id):
+    def reset_track_id(self, cls_id):
         """
         :param cls_id:
         :return:
         """
-        MCBaseTrack._id_dict[cls_id] = 0
+        self.id_allocator.reset_track_id(cls_id)
 
     def activate(self, *args):
         """
@@ -105,7 +105,9 @@ class MCBaseTrack(object):
 
 
 class BaseTrack(object):
-    _count = 0
+    # track id allocator of the owning tracker(set by activate),
+    # the class-level one is shared by the tracks not bound to any tracker's allocator
+    id_allocator = TrackIdAllocator()
 
     track_id = 0
     is_activated = False
@@ -126,13 +128,11 @@ class BaseTrack(object):
     def end_frame(self):
         return self.frame_id
 
-    @staticmethod
-    def next_id():
+    def next_id(self):
         """
         :return:
         """
-        BaseTrack._count += 1
-        return BaseTrack._count
+        return self.id_allocator.next_id()
 
     def activate(self, *args):
         """
@@ -5,8 +5,9 @@ import numpy as np
 from collections import defaultdict, deque
 
 from ByteTracker import matching
-from .basetrack import BaseTrack, MCBaseTrack, TrackState
+from .basetrack import BaseTrack, MCBaseTrack, TrackState, TrackIdAllocator
 from .kalman_filter import KalmanFilter
+from tracking_utils.kalman_filter import KalmanTrackTable
 from utils.utils import box_ioa_np
 
 
@@ -48,7 +49,7 @@ class MCTrackEmb(MCBaseTrack):
         """
         :return:
         """
-        self.reset_track_id(self.cls_id)
+        self.id_allocator.reset_track_id(self.cls_id)
 
     def update_features(self, feat):
         """
@@ -85,6 +86,16 @@ class MCTrackEmb(MCBaseTrack):
         :return:
         """
         if len(tracks) > 0:
+            # batched prediction in place for the tracks bound to track tables
+            track_groups, unbound_inds = MCBaseTrack.group_by_table(tracks)
+            for track_table, inds in track_groups:
+                track_table.predict([tracks[i].slot for i in inds],
+                                    [tracks[i].state != TrackState.Tracked for i in inds])
+
+            tracks = [tracks[i] for i in unbound_inds]
+            if len(tracks) == 0:
+                return
+
             multi_mean = np.asarray([track.mean.copy() for track in tracks])
             multi_covariance = np.asarray([track.covariance for track in tracks])
 
@@ -98,19 +109,25 @@ class MCTrackEmb(MCBaseTrack):
                 tracks[i].mean = mean
                 tracks[i].covariance = cov
 
-    def activate(self, kalman_filter, frame_id):
+    def activate(self, kalman_filter, frame_id, track_table=None, id_allocator=None):
         """
         Start a new track-let: the initial activation
         :param kalman_filter:
         :param frame_id:
+        :param track_table: KalmanTrackTable of the object class
+        :param id_allocator: TrackIdAllocator of the owning tracker
         :return:
         """
         self.kalman_filter = kalman_filter
+        if id_allocator is not None:
+            self.id_allocator = id_allocator
 
         # update track id for the object class
         self.track_id = self.next_id(self.cls_id)
 
         self.mean, self.covariance = self.kalman_filter.initiate(self.tlwh_to_xyah(self._tlwh))
+        if track_table is not None:  # keep the kalman state in the class's track table
+            self.bind_table(track_table)
 
         self.tracklet_len = 0
 
@@ -122,17 +139,19 @@ class MCTrackEmb(MCBaseTrack):
         self.frame_id = frame_id
         self.start_frame = frame_id
 
-    def re_activate(self, new_track, frame_id, new_id=False):
+    def re_activate(self, new_track, frame_id, new_id=False, update_kalman=True):
         """
         :param new_track:
         :param frame_id:
         :param new_id:
+        :param update_kalman: False if already corrected by multi_update_kalman
         :return:
         """
         # kalman update
-        self.mean, self.covariance = self.kalman_filter.update(self.mean,
-                                                               self.covariance,
-                                                               self.tlwh_to_xyah(new_track.tlwh))
+        if update_kalman:
+            self.mean, self.covariance = self.kalman_filter.update(self.mean,
+                                                                   self.covariance,
+                                                                   self.tlwh_to_xyah(new_track.tlwh))
 
         # feature vector update
         self.update_features(new_track.curr_feat)
@@ -150,19 +169,23 @@ class MCTrackEmb(MCBaseTrack):
 
         self.score = new_track.score
 
-    def update(self, new_track, frame_id, update_feature=True):
+    def update(self, new_track, frame_id, update_feature=True, update_kalman=True):
         """
         Update a matched track
         :type new_track: Track
         :type frame_id: int
         :type update_feature: bool
+        :type update_kalman: bool
         :return:
         """
         self.frame_id = frame_id
         self.track_len += 1
 
-        new_tlwh = new_track.tlwh
-        self.mean, self.covariance = self.kalman_filter.update(self.mean, self.covariance, self.tlwh_to_xyah(new_tlwh))
+        if update_kalman:
+            new_tlwh = new_track.tlwh
+            self.mean, self.covariance = self.kalman_filter.update(self.mean,
+                                                                   self.covariance,
+                                                                   self.tlwh_to_xyah(new_tlwh))
 
         ## ----- Update the states
         self.state = TrackState.Tracked
@@ -270,7 +293,7 @@ class MCTrack(MCBaseTrack):
         """
         :return:
         """
-        self.reset_track_id(self.cls_id)
+        self.id_allocator.reset_track_id(self.cls_id)
 
     def predict(self):
         """
@@ -288,6 +311,16 @@ class MCTrack(MCBaseTrack):
         :return:
         """
         if len(tracks) > 0:
+            # batched prediction in place for the tracks bound to track tables
+            track_groups, unbound_inds = MCBaseTrack.group_by_table(tracks)
+            for track_table, inds in track_groups:
+                track_table.predict([tracks[i].slot for i in inds],
+                                    [tracks[i].state != TrackState.Tracked for i in inds])
+
+            tracks = [tracks[i] for i in unbound_inds]
+            if len(tracks) == 0:
+                return
+
             multi_mean = np.asarray([track.mean.copy() for track in tracks])
             multi_covariance = np.asarray([track.covariance for track in tracks])
 
@@ -301,19 +334,25 @@ class MCTrack(MCBaseTrack):
                 tracks[i].mean = mean
                 tracks[i].covariance = cov
 
-    def activate(self, kalman_filter, frame_id):
+    def activate(self, kalman_filter, frame_id, track_table=None, id_allocator=None):
         """
         Start a new track-let: the initial activation
         :param kalman_filter:
         :param frame_id:
+        :param track_table: KalmanTrackTable of the object class
+        :param id_allocator: TrackIdAllocator of the owning tracker
         :return:
         """
         self.kalman_filter = kalman_filter
+        if id_allocator is not None:
+            self.id_allocator = id_allocator
 
         # update track id for the object class
         self.track_id = self.next_id(self.cls_id)
 
         self.mean, self.covariance = self.kalman_filter.initiate(self.tlwh_to_xyah(self._tlwh))
+        if track_table is not None:  # keep the kalman state in the class's track table
+            self.bind_table(track_table)
 
         self.tracklet_len = 0
         self.state = TrackState.Tracked
@@ -324,16 +363,18 @@ class MCTrack(MCBaseTrack):
         self.frame_id = frame_id
         self.start_frame = frame_id
 
-    def re_activate(self, new_track, frame_id, new_id=False):
+    def re_activate(self, new_track, frame_id, new_id=False, update_kalman=True):
         """
         :param new_track:
         :param frame_id:
         :param new_id:
+        :param update_kalman: False if already corrected by multi_update_kalman
         :return:
         """
-        self.mean, self.covariance = self.kalman_filter.update(self.mean,
-                                                               self.covariance,
-                                                               self.tlwh_to_xyah(new_track.tlwh))
+        if update_kalman:
+            self.mean, self.covariance = self.kalman_filter.update(self.mean,
+                                                                   self.covariance,
+                                                                   self.tlwh_to_xyah(new_track.tlwh))
 
         self.tracklet_len = 0
         self.frame_id = frame_id
@@ -348,19 +389,23 @@ class MCTrack(MCBaseTrack):
 
         self.score = new_track.score
 
-    def update(self, new_track, frame_id):
+    def update(self, new_track, frame_id, update_kalman=True):
         """
         Update a matched track
         :type new_track: STrack
         :type frame_id: int
         :type update_feature: bool
+        :type update_kalman: bool
         :return:
         """
         self.frame_id = frame_id
         self.tracklet_len += 1
 
-        new_tlwh = new_track.tlwh
-        self.mean, self.covariance = self.kalman_filter.update(self.mean, self.covariance, self.tlwh_to_xyah(new_tlwh))
+        if update_kalman:
+            new_tlwh = new_track.tlwh
+            self.mean, self.covariance = self.kalman_filter.update(self.mean,
+                                                                   self.covariance,
+                                                                   self.tlwh_to_xyah(new_tlwh))
 
         ## ----- Update the states
         self.state = TrackState.Tracked
@@ -485,14 +530,17 @@ class STrack(BaseTrack):
                 stracks[i].mean = mean
                 stracks[i].covariance = cov
 
-    def activate(self, kalman_filter, frame_id):
+    def activate(self, kalman_filter, frame_id, id_allocator=None):
         """
         Start a new tracklet
         :param kalman_filter:
         :param frame_id:
+        :param id_allocator: TrackIdAllocator of the owning tracker
         :return:
         """
         self.kalman_filter = kalman_filter
+        if id_allocator is not None:
+            self.id_allocator = id_allocator
 
         self.track_id = self.next_id()
 
@@ -635,9 +683,18 @@ class BYTETracker(object):
         ## kalman filter
         self.kalman_filter = KalmanFilter()
 
+        # kalman states of each object class's tracks: dict(int, KalmanTrackTable)
+        self.track_tables = defaultdict(lambda: KalmanTrackTable(self.kalman_filter))
+
+        # track ids of this tracker(independent of other tracker instances)
+        self.id_allocator = TrackIdAllocator()
+
         # Get number of tracking object classes
         self.num_classes = args.n_classes
 
+        # associate all object classes jointly(one assignment per matching stage)
+        self.joint_assoc = getattr(args, 'joint_assoc', False)
+
         # Define 3 track lists for single object class
         self.tracked_tracks = []  # type: list[Track]
         self.lost_tracks = []     # type: list[Track]
@@ -662,6 +719,10 @@ class BYTETracker(object):
 
         # Reset kalman filter to stabilize the tracking
         self.kalman_filter = KalmanFilter()
+        self.track_tables = defaultdict(lambda: KalmanTrackTable(self.kalman_filter))
+
+        # Reset track ids
+        self.id_allocator = TrackIdAllocator()
 
     def get_all_boxes(self, boxes_dict):
         """
@@ -698,284 +759,247 @@ class BYTETracker(object):
         """
         return box_ioa_np(the_box, other_boxes)
 
-    def update_byte_mcmot_emb(self, boxes_dict, scores_dict, feats_dict):
+    def class_groups(self):
         """
-        :param boxes_dict:
-        :param scores_dict:
-        :param feats_dict:
-        :return:
+        The object classes associated together: all classes at once(joint association)
+        or one class at a time
+        :return: list of class id lists
         """
-        ## ----- update frame id
-        self.frame_id += 1
-
-        # ----- reset the track ids for all object classes in the first frame
-        if self.frame_id == 1:
-            MCTrack.init_id_dict(self.num_classes)
-        # -----
-
-        # ----- The current frame tracking states recording
-        unconfirmed_dict = defaultdict(list)
-        tracked_tracks_dict = defaultdict(list)
-        track_pool_dict = defaultdict(list)
-        activated_tracks_dict = defaultdict(list)
-        refind_tracks_dict = defaultdict(list)
-        lost_tracks_dict = defaultdict(list)
-        removed_tracks_dict = defaultdict(list)
-        output_tracks_dict = defaultdict(list)
-
-        # ## ----- @even: Test get all boxes
-        # self.all_boxes = self.get_all_boxes(boxes_dict)
-
-        #################### Even: Start MCMOT
-        ## ---------- Process each object class
-        for cls_id in range(self.num_classes):
-            ## ----- class boxes
-            cls_boxes = boxes_dict[cls_id]
-
-            # ## ----- @even: Test get other boxes
-            # other_boxes = self.get_all_other_boxes(self.all_boxes, cls_boxes[0])
-            # the_box = np.array(cls_boxes[0])
-            # the_box = the_box.reshape(1, -1)
-            # other_boxes = np.array(other_boxes)
-            # ioas = self.get_ioa(the_box, other_boxes)
-            # print(np.max(ioas))
-
-            cls_boxes = np.array(cls_boxes)
-
-            ## ----- Scaling the boxes to image size
-            # cls_boxes /= scale
-
-            ## ----- class scores
-            cls_scores = scores_dict[cls_id]
-            cls_scores = np.array(cls_scores)
-
-            ## ----- class feature vectors
-            cls_feats = feats_dict[cls_id]  # n_objs × 128
-            cls_feats = np.array(cls_feats)
-
-            cls_remain_1st = cls_scores > self.args.track_thresh
-            cls_inds_low = cls_scores > 0.1
-            cls_inds_high = cls_scores < self.args.track_thresh
-
-            ## ---------- class second indices
-            cls_inds_2nd = np.logical_and(cls_inds_low, cls_inds_high)
-
-            ## ----- boxes
-            cls_dets_boxes_1st = cls_boxes[cls_remain_1st]
-            cls_dets_boxes_2nd = cls_boxes[cls_inds_2nd]
+        if self.joint_assoc:
+            return [list(range(self.num_classes))]
+        return [[cls_id] for cls_id in range(self.num_classes)]
 
-            ## ----- scores
-            cls_scores_1st = cls_scores[cls_remain_1st]
-            cls_scores_2nd = cls_scores[cls_inds_2nd]
+    def get_detections(self, class_ids, boxes_dict, scores_dict, feats_dict=None):
+        """
+        Stack the dets of the object classes(class by class) and split them by score
+        :param class_ids: object classes of the association
+        :param boxes_dict: x1, y1, x2, y2 boxes of each class
+        :param scores_dict: scores of each class
+        :param feats_dict: reid feature vectors of each class(MCTrackEmb detections), None: MCTrack detections
+        :return: high score detections(1st association) and low score detections(2nd association)
+        """
+        boxes, scores, feats, cls_ids = [], [], [], []
+        for cls_id in class_ids:
+            boxes.extend(boxes_dict[cls_id])
+            scores.extend(scores_dict[cls_id])
+            if feats_dict is not None:
+                feats.extend(feats_dict[cls_id])
+            cls_ids.extend([cls_id] * len(boxes_dict[cls_id]))
+        boxes = np.array(boxes).reshape(-1, 4)
+        scores = np.array(scores)
 
-            ## ----- features
-            cls_feat_1st = cls_feats[cls_remain_1st]
-            cls_feat_2nd = cls_feats[cls_inds_2nd]
-            ## ----------
+        inds_1st = np.where(scores > self.args.track_thresh)[0]
+        inds_2nd = np.where(np.logical_and(scores > 0.1, scores < self.args.track_thresh))[0]
 
-            if len(cls_dets_boxes_1st) > 0:
-                '''Detections'''
-                cls_dets_1st = [MCTrackEmb(MCTrackEmb.tlbr_to_tlwh(tlbr), s, feat, cls_id) for
-                                (tlbr, s, feat) in zip(cls_dets_boxes_1st, cls_scores_1st, cls_feat_1st)]
-            else:
-                cls_dets_1st = []
+        if feats_dict is not None:
+            return [[MCTrackEmb(MCTrackEmb.tlbr_to_tlwh(boxes[i]), scores[i], feats[i], cls_ids[i]) for i in inds]
+                    for inds in (inds_1st, inds_2nd)]
+        return [[MCTrack(MCTrack.tlbr_to_tlwh(boxes[i]), scores[i], cls_ids[i]) for i in inds]
+                for inds in (inds_1st, inds_2nd)]
 
-            '''Add newly detected tracks(current frame) to tracked_tracks'''
+    def match_costs(self, tracks, detections, with_emb, fuse_score=True):
+        """
+        Matching costs of tracks and detections: iou distance(fused with the detection scores),
+        fused with the embedding distance if with_emb; class-mismatch costs set to inf
+        :param tracks:
+        :param detections:
+        :param with_emb:
+        :param fuse_score:
+        :return:
+        """
+        dists = matching.iou_distance(tracks, detections)
+        if fuse_score and not self.args.mot20:
+            dists = matching.fuse_score(dists, detections)
+        if with_emb:
+            dists = matching.fuse_costs(dists, matching.embedding_distance(tracks, detections))
+        return matching.mask_class_mismatch(dists, tracks, detections)
+
+    def associate(self,
+                  class_ids,
+                  dets_1st,
+                  dets_2nd,
+                  with_emb,
+                  activated_tracks_dict,
+                  refind_tracks_dict,
+                  lost_tracks_dict,
+                  removed_tracks_dict):
+        """
+        Steps 2 - 4 of the current frame for the object classes class_ids: the tracks and detections
+        of the classes are associated at once(one block-diagonal cost matrix for each matching stage)
+        :param class_ids: object classes of the association(one class: per-class association)
+        :param dets_1st: high score detections of the classes
+        :param dets_2nd: low score detections of the classes
+        :param with_emb: match with the reid embeddings too
+        (only the tracked tracks are predicted and the unmatched low score detections may init tracks)
+        :param activated_tracks_dict: the activated tracks of the current frame(key: cls_id)
+        :param refind_tracks_dict: the re-found tracks of the current frame
+        :param lost_tracks_dict: the newly lost tracks of the current frame
+        :param removed_tracks_dict: the newly removed tracks of the current frame
+        :return:
+        """
+        '''Add newly detected tracks(current frame) to tracked_tracks'''
+        unconfirmed = []
+        tracked_tracks = []
+        track_pool = []
+        for cls_id in class_ids:
+            cls_tracked_tracks = []
             for track in self.tracked_tracks_dict[cls_id]:
                 if not track.is_activated:
-                    unconfirmed_dict[cls_id].append(track)  # record unconfirmed tracks in this frame
+                    unconfirmed.append(track)  # record unconfirmed tracks in this frame
                 else:
-                    tracked_tracks_dict[cls_id].append(track)  # record tracked tracks of this frame
+                    cls_tracked_tracks.append(track)  # record tracked tracks of this frame
 
-            '''Step 2: First association, with high score detection boxes'''
+            tracked_tracks.extend(cls_tracked_tracks)
             ## ----- build track pool for the current frame by joining tracked_tracks and lost tracks
-            track_pool_dict[cls_id] = join_tracks(tracked_tracks_dict[cls_id], self.lost_tracks_dict[cls_id])
-
-            '''Predict the current location with KF
-            Whether are lost tracks better with KF or not?
-            '''
-            # MCTrackEmb.multi_predict(track_pool_dict[cls_id])    # predict all tracks in the track pool
-            MCTrackEmb.multi_predict(tracked_tracks_dict[cls_id])  # predict only tracks(not lost)
-
-            # ---------- Matching with Hungarian Algorithm
-            # ----- IOU matching
-            dists_iou = matching.iou_distance(track_pool_dict[cls_id], cls_dets_1st)
-            # print(dists_iou.shape)
-
-            # ----- Embedding matching
-            dists_emb = matching.embedding_distance(track_pool_dict[cls_id], cls_dets_1st)
-
-            if not self.args.mot20:
-                if dists_iou.shape[0] > 0:
-                    dists_iou = matching.fuse_score(dists_iou, cls_dets_1st)
-
-            # dists = matching.weight_sum_costs(dists_iou, dists_emb, alpha=0.9)
-            dists = matching.fuse_costs(dists_iou, dists_emb)
-
-            matches, u_track_1st, u_det_1st = matching.linear_assignment(dists, thresh=self.args.match_thresh)
-            # matches, u_track_1st, u_det_1st = matching.linear_assignment(dists_iou, thresh=self.args.match_thresh)
-
-            # --- process matched pairs between track pool and current frame detection
-            for i_tracked, i_det in matches:
-                track = track_pool_dict[cls_id][i_tracked]
-                det = cls_dets_1st[i_det]
-
-                if track.state == TrackState.Tracked:
-                    track.update(det, self.frame_id)
-                    activated_tracks_dict[cls_id].append(track)  # for multi-class
-                else:  # re-activate the lost track
-                    track.re_activate(det, self.frame_id, new_id=False)
-                    refind_tracks_dict[cls_id].append(track)
-
-            '''Step 3: Second association, with low score detection boxes'''
-            # association the un-track to the low score detections
-            if len(cls_dets_boxes_2nd) > 0:
-                '''Detections'''
-                cls_dets_2nd = [MCTrackEmb(MCTrackEmb.tlbr_to_tlwh(tlbr), s, feat, cls_id) for
-                                (tlbr, s, feat) in zip(cls_dets_boxes_2nd, cls_scores_2nd, cls_feat_2nd)]
-            else:
-                cls_dets_2nd = []
-
-            ## The tracks that are not matched in the 1st round matching
-            r_tracked_tracks = [track_pool_dict[cls_id][i]
-                                for i in u_track_1st if track_pool_dict[cls_id][i].state == TrackState.Tracked]
-
-            ## ----- IOU matching
-            dists_iou = matching.iou_distance(r_tracked_tracks, cls_dets_2nd)
-
-            ## ----- embedding matching
-            dists_emb = matching.embedding_distance(r_tracked_tracks, cls_dets_2nd)
-
-            # dists = matching.weight_sum_costs(dists_iou, dists_emb, alpha=0.9)
-            dists = matching.fuse_costs(dists_iou, dists_emb)
-
-            matches, u_track_2nd, u_det_2nd = matching.linear_assignment(dists, thresh=0.5)  # thresh=0.5
-
-            # matches, u_track_2nd, u_det_2nd = matching.linear_assignment(dists_iou, thresh=0.7)  # thresh=0.5
-
-            for i_tracked, i_det in matches:
-                track = r_tracked_tracks[i_tracked]
-                det = cls_dets_2nd[i_det]
+            track_pool.extend(join_tracks(cls_tracked_tracks, self.lost_tracks_dict[cls_id]))
 
-                if track.state == TrackState.Tracked:
-                    track.update(det, self.frame_id)
-                    activated_tracks_dict[cls_id].append(track)
-                else:
-                    track.re_activate(det, self.frame_id, new_id=False)
-                    refind_tracks_dict[cls_id].append(track)
-
-            ## ----- process unmatched tracks for 2 rounds
-            for i in u_track_2nd:
-                track = r_tracked_tracks[i]
-
-                # mark unmatched track as lost track
-                if not track.state == TrackState.Lost:
-                    track.mark_lost()
-                    lost_tracks_dict[cls_id].append(track)
-
-            '''Deal with unconfirmed tracks, usually tracks with only one beginning frame'''
-            # current frame's unmatched detection
-            cls_dets_1st = [cls_dets_1st[i] for i in u_det_1st]
-            cls_dets_2nd = [cls_dets_2nd[i] for i in u_det_2nd]
-            cls_dets_remain = cls_dets_1st + cls_dets_2nd
-
-            ## -----IOU matching
-            # dists = matching.iou_distance(unconfirmed_dict[cls_id], cls_dets_1st)
-            dists_iou = matching.iou_distance(unconfirmed_dict[cls_id], cls_dets_remain)
-
-            ## ----- Embedding matching
-            dists_emb = matching.embedding_distance(unconfirmed_dict[cls_id], cls_dets_remain)
-
-            if not self.args.mot20:
-                # dists = matching.fuse_score(dists, cls_dets_1st)
-                dists_iou = matching.fuse_score(dists_iou, cls_dets_remain)
-
-            # dists = matching.weight_sum_costs(dists_iou, dists_emb, alpha=0.9)
-            dists = matching.fuse_costs(dists_iou, dists_emb)
-
-            matches, u_unconfirmed, u_det_unconfirmed = matching.linear_assignment(dists, thresh=0.7)  # 0.7
+        '''Predict the current location with KF
+        Whether are lost tracks better with KF or not?
+        '''
+        if with_emb:
+            MCTrackEmb.multi_predict(tracked_tracks)  # predict only tracks(not lost)
+        else:
+            MCTrack.multi_predict(track_pool)
 
-            for i_tracked, i_det in matches:
-                # unconfirmed_dict[cls_id][i_tracked].update(cls_dets_1st[i_det], self.frame_id)
-                unconfirmed_dict[cls_id][i_tracked].update(cls_dets_remain[i_det], self.frame_id)
+        '''Step 2: First association, with high score detection boxes'''
+        dists = self.match_costs(track_pool, dets_1st, with_emb)
+        matches, u_track_1st, u_det_1st = matching.linear_assignment(dists, thresh=self.args.match_thresh)
+        self.update_matched(track_pool, dets_1st, matches, activated_tracks_dict, refind_tracks_dict)
 
-                activated_tracks_dict[cls_id].append(unconfirmed_dict[cls_id][i_tracked])
+        '''Step 3: Second association, with low score detection boxes'''
+        ## The tracks that are not matched in the 1st round matching
+        r_tracked_tracks = [track_pool[i] for i in u_track_1st if track_pool[i].state == TrackState.Tracked]
 
-            for i in u_unconfirmed:
-                track = unconfirmed_dict[cls_id][i]
-                track.mark_removed()
-                removed_tracks_dict[cls_id].append(track)
+        dists = self.match_costs(r_tracked_tracks, dets_2nd, with_emb, fuse_score=False)
+        matches, u_track_2nd, u_det_2nd = matching.linear_assignment(dists, thresh=0.5)  # thresh=0.5
+        self.update_matched(r_tracked_tracks, dets_2nd, matches, activated_tracks_dict, refind_tracks_dict)
 
-            """Step 4: Init new tracks"""
-            for i_new in u_det_unconfirmed:  # current frame's unmatched detection
-                # track = cls_dets_1st[i_new]
-                track = cls_dets_remain[i_new]
+        ## ----- process unmatched tracks for 2 rounds
+        for i in u_track_2nd:
+            track = r_tracked_tracks[i]
 
-                if track.score < self.det_thresh:
-                    continue
+            # mark unmatched track as lost track
+            if not track.state == TrackState.Lost:
+                track.mark_lost()
+                lost_tracks_dict[track.cls_id].append(track)
 
-                # tracked but not activated: activate do not set 'is_activated' to be True
-                track.activate(self.kalman_filter, self.frame_id)  # if fr_id > 1, tracked but not activated
+        '''Deal with unconfirmed tracks, usually tracks with only one beginning frame'''
+        # current frame's unmatched detection
+        dets_remain = [dets_1st[i] for i in u_det_1st]
+        if with_emb:
+            dets_remain += [dets_2nd[i] for i in u_det_2nd]
 
-                # activated_tarcks_dict may contain track with 'is_activated' False
-                activated_tracks_dict[cls_id].append(track)
+        dists = self.match_costs(unconfirmed, dets_remain, with_emb)
+        matches, u_unconfirmed, u_det_unconfirmed = matching.linear_assignment(dists, thresh=0.7)  # 0.7
+        self.update_matched(unconfirmed, dets_remain, matches, activated_tracks_dict, refind_tracks_dict)
 
-            """Step 5: Update state"""
-            # update removed tracks
-            for track in self.lost_tracks_dict[cls_id]:
-                if self.frame_id - track.end_frame > self.max_time_lost:
-                    track.mark_removed()
-                    removed_tracks_dict[cls_id].append(track)
+        for i in u_unconfirmed:
+            track = unconfirmed[i]
+            track.mark_removed()
+            removed_tracks_dict[track.cls_id].append(track)
 
-            """Post processing"""
-            self.tracked_tracks_dict[cls_id] = [t for t in self.tracked_tracks_dict[cls_id] if t.state == TrackState.Tracked]
-            self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id], activated_tracks_dict[cls_id])
-            self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id], refind_tracks_dict[cls_id])
+        """Step 4: Init new tracks"""
+        for i_new in u_det_unconfirmed:  # current frame's unmatched detection
+            track = dets_remain[i_new]
+            if track.score < self.det_thresh:
+                continue
 
-            self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id], self.tracked_tracks_dict[cls_id])
-            self.lost_tracks_dict[cls_id].extend(lost_tracks_dict[cls_id])
-            self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id], self.removed_tracks_dict[cls_id])
+            # tracked but not activated: activate do not set 'is_activated' to be True
+            # if fr_id > 1, tracked but not activated
+            track.activate(self.kalman_filter, self.frame_id, self.track_tables[track.cls_id], self.id_allocator)
 
-            self.removed_tracks_dict[cls_id].extend(removed_tracks_dict[cls_id])
+            # activated_tarcks_dict may contain track with 'is_activated' False
+            activated_tracks_dict[track.cls_id].append(track)
 
-            self.tracked_tracks_dict[cls_id], self.lost_tracks_dict[cls_id] = remove_duplicate_tracks(
-                self.tracked_tracks_dict[cls_id],
-                self.lost_tracks_dict[cls_id])
+    def update_matched(self, tracks, detections, matches, activated_tracks_dict, refind_tracks_dict):
+        """
+        Update the matched tracks with their detections(batched kalman correction):
+        tracked(and unconfirmed) tracks are updated, lost tracks are re-activated
+        :param tracks:
+        :param detections:
+        :param matches: matched (track index, detection index) pairs
+        :param activated_tracks_dict:
+        :param refind_tracks_dict:
+        :return:
+        """
+        # --- batched kalman correction of the matched tracks
+        MCBaseTrack.multi_update_kalman([tracks[i_tracked] for i_tracked, i_det in matches],
+                                        [detections[i_det] for i_tracked, i_det in matches])
 
-            # get scores of lost tracks
-            output_tracks_dict[cls_id] = [track for track in self.tracked_tracks_dict[cls_id] if track.is_activated]
+        # --- process matched pairs between tracks and current frame detection
+        for i_tracked, i_det in matches:
+            track = tracks[i_tracked]
+            det = detections[i_det]
 
-        ## ---------- Return final online targets of the frame
-        return output_tracks_dict
-        #################### MCMOT end
+            if track.state == TrackState.Tracked:
+                track.update(det, self.frame_id, update_kalman=False)
+                activated_tracks_dict[track.cls_id].append(track)  # for multi-class
+            else:  # re-activate the lost track
+                track.re_activate(det, self.frame_id, new_id=False, update_kalman=False)
+                refind_tracks_dict[track.cls_id].append(track)
 
-    def update_byte_mcmot(self, dets_results):
+    def update_tracks(self, boxes_dict, scores_dict, feats_dict=None):
         """
-        :param dets_results:
-        :return:
+        Update the tracks of all object classes with the current frame's detections
+        :param boxes_dict:
+        :param scores_dict:
+        :param feats_dict: None: match without reid embeddings
+        :return: output tracks dict(key: cls_id)
         """
         ## ----- update frame id
         self.frame_id += 1
 
         # ----- reset the track ids for all object classes in the first frame
         if self.frame_id == 1:
-            MCTrack.init_id_dict(self.num_classes)
+            self.id_allocator.init_id_dict(self.num_classes)
         # -----
 
         # ----- The current frame tracking states recording
-        unconfirmed_dict = defaultdict(list)
-        tracked_tracks_dict = defaultdict(list)
-        track_pool_dict = defaultdict(list)
         activated_tracks_dict = defaultdict(list)
         refind_tracks_dict = defaultdict(list)
         lost_tracks_dict = defaultdict(list)
         removed_tracks_dict = defaultdict(list)
         output_tracks_dict = defaultdict(list)
 
-        #################### Even: Start MCMOT
+        ## ---------- Steps 2 - 4 of each class group(all classes for joint association)
+        for class_ids in self.class_groups():
+            dets_1st, dets_2nd = self.get_detections(class_ids, boxes_dict, scores_dict, feats_dict)
+            self.associate(class_ids,
+                           dets_1st,
+                           dets_2nd,
+                           feats_dict is not None,
+                           activated_tracks_dict,
+                           refind_tracks_dict,
+                           lost_tracks_dict,
+                           removed_tracks_dict)
+
+        """Step 5: Update state and post processing of each object class"""
+        for cls_id in range(self.num_classes):
+            output_tracks_dict[cls_id] = self.merge_class_tracks(cls_id,
+                                                                 activated_tracks_dict[cls_id],
+                                                                 refind_tracks_dict[cls_id],
+                                                                 lost_tracks_dict[cls_id],
+                                                                 removed_tracks_dict[cls_id])
+
+        ## ---------- Return final online targets of the frame
+        return output_tracks_dict
+
+    def update_byte_mcmot_emb(self, boxes_dict, scores_dict, feats_dict):
+        """
+        :param boxes_dict:
+        :param scores_dict:
+        :param feats_dict:
+        :return:
+        """
+        return self.update_tracks(boxes_dict, scores_dict, feats_dict)
 
+    def update_byte_mcmot(self, dets_results):
+        """
+        :param dets_results:
+        :return:
+        """
         ## ----- Get box dict and score dict
-        boxxes_dict = defaultdict(list)
+        boxes_dict = defaultdict(list)
         scores_dict = defaultdict(list)
         for det in dets_results:
             if det.size == 7:
@@ -984,178 +1008,52 @@ class BYTETracker(object):
             elif det.size == 6:
                 x1, y1, x2, y2, score, cls_id = det  # 6
 
-            box = np.array([x1, y1, x2, y2])
-            boxxes_dict[int(cls_id)].append(box)
+            boxes_dict[int(cls_id)].append(np.array([x1, y1, x2, y2]))
             scores_dict[int(cls_id)].append(score)
 
-        ## ---------- Process each object class
-        for cls_id in range(self.num_classes):
-            ## ----- class boxes
-            cls_boxes = boxxes_dict[cls_id]
-            cls_boxes = np.array(cls_boxes)
-
-            ## ----- Scaling the boxes to image size
-            # cls_boxes /= scale
-
-            ## ----- class scores
-            cls_scores = scores_dict[cls_id]
-            cls_scores = np.array(cls_scores)
-
-            cls_remain_inds = cls_scores > self.args.track_thresh
-            cls_inds_low = cls_scores > 0.1
-            cls_inds_high = cls_scores < self.args.track_thresh
-
-            ## class second indices
-            cls_inds_second = np.logical_and(cls_inds_low, cls_inds_high)
-
-            cls_dets_boxes = cls_boxes[cls_remain_inds]
-            cls_dets_boxes_second = cls_boxes[cls_inds_second]
-
-            cls_scores_keep = cls_scores[cls_remain_inds]
-            cls_scores_second = cls_scores[cls_inds_second]
-
-            if len(cls_dets_boxes) > 0:
-                '''Detections'''
-                cls_detections = [MCTrack(MCTrack.tlbr_to_tlwh(tlbr), s, cls_id) for
-                                  (tlbr, s) in zip(cls_dets_boxes, cls_scores_keep)]
-            else:
-                cls_detections = []
-            # print(cls_detections)
-
-            '''Add newly detected tracks(current frame) to tracked_tracks'''
-            for track in self.tracked_tracks_dict[cls_id]:
-                if not track.is_activated:
-                    unconfirmed_dict[cls_id].append(track)  # record unconfirmed tracks in this frame
-                else:
-                    tracked_tracks_dict[cls_id].append(track)  # record tracked tracks of this frame
-
-            ''' Step 2: First association, with high score detection boxes'''
-            ## ----- build track pool for the current frame by joining tracked_tracks and lost tracks
-            track_pool_dict[cls_id] = join_tracks(tracked_tracks_dict[cls_id], self.lost_tracks_dict[cls_id])
-
-            # Predict the current location with KF
-            MCTrack.multi_predict(track_pool_dict[cls_id])
-
-            # Matching with Hungarian Algorithm
-            dists = matching.iou_distance(track_pool_dict[cls_id], cls_detections)
-            # print(dists)
-
-            if not self.args.mot20:
-                dists = matching.fuse_score(dists, cls_detections)
-
-            matches, u_track, u_detection = matching.linear_assignment(dists, thresh=self.args.match_thresh)
-
-            # --- process matched pairs between track pool and current frame detection
-            for i_tracked, i_det in matches:
-                track = track_pool_dict[cls_id][i_tracked]
-                det = cls_detections[i_det]
-
-                if track.state == TrackState.Tracked:
-                    track.update(det, self.frame_id)
-                    activated_tracks_dict[cls_id].append(track)  # for multi-class
-                else:  # re-activate the lost track
-                    track.re_activate(det, self.frame_id, new_id=False)
-                    refind_tracks_dict[cls_id].append(track)
-
-            ''' Step 3: Second association, with low score detection boxes'''
-            # association the un-track to the low score detections
-            if len(cls_dets_boxes_second) > 0:
-                '''Detections'''
-                cls_detections_second = [MCTrack(MCTrack.tlbr_to_tlwh(tlbr), s, cls_id) for
-                                         (tlbr, s) in zip(cls_dets_boxes_second, cls_scores_second)]
-            else:
-                cls_detections_second = []
-            # print(cls_detections_second)
-
-            r_tracked_tracks = [track_pool_dict[cls_id][i]
-                                for i in u_track if track_pool_dict[cls_id][i].state == TrackState.Tracked]
-
-            dists = matching.iou_distance(r_tracked_tracks, cls_detections_second)
-            matches, u_track, u_detection_second = matching.linear_assignment(dists, thresh=0.5)  # thresh=0.5
-
-            for i_tracked, i_det in matches:
-                track = r_tracked_tracks[i_tracked]
-                det = cls_detections_second[i_det]
+        return self.update_tracks(boxes_dict, scores_dict)
 
-                if track.state == TrackState.Tracked:
-                    track.update(det, self.frame_id)
-                    activated_tracks_dict[cls_id].append(track)
-                else:
-                    track.re_activate(det, self.frame_id, new_id=False)
-                    refind_tracks_dict[cls_id].append(track)
-
-            # process unmatched tracks for two rounds
-            for i in u_track:
-                track = r_tracked_tracks[i]
-                if not track.state == TrackState.Lost:
-                    # mark unmatched track as lost track
-                    track.mark_lost()
-                    lost_tracks_dict[cls_id].append(track)
-
-            '''Deal with unconfirmed tracks, usually tracks with only one beginning frame'''
-            # current frame's unmatched detection
-            cls_detections = [cls_detections[i] for i in u_detection]
-
-            # iou matching
-            dists = matching.iou_distance(unconfirmed_dict[cls_id], cls_detections)
-
-            if not self.args.mot20:
-                dists = matching.fuse_score(dists, cls_detections)
-
-            matches, u_unconfirmed, u_detection = matching.linear_assignment(dists, thresh=0.7)  # 0.7
-
-            for i_tracked, i_det in matches:
-                unconfirmed_dict[cls_id][i_tracked].update(cls_detections[i_det], self.frame_id)
-                activated_tracks_dict[cls_id].append(unconfirmed_dict[cls_id][i_tracked])
-
-            for i in u_unconfirmed:
-                track = unconfirmed_dict[cls_id][i]
+    def merge_class_tracks(self,
+                           cls_id,
+                           activated_tracks,
+                           refind_tracks,
+                           lost_tracks,
+                           removed_tracks):
+        """
+        Update state for lost tracks and post-process the tracks of one object class
+        :param cls_id:
+        :param activated_tracks: the class's activated tracks of the current frame
+        :param refind_tracks: the class's re-found tracks of the current frame
+        :param lost_tracks: the class's newly lost tracks of the current frame
+        :param removed_tracks: the class's newly removed tracks of the current frame
+        :return: output tracks of the object class
+        """
+        """Step 5: Update state"""
+        # update removed tracks
+        for track in self.lost_tracks_dict[cls_id]:
+            if self.frame_id - track.end_frame > self.max_time_lost:
                 track.mark_removed()
-                removed_tracks_dict[cls_id].append(track)
-
-            """Step 4: Init new tracks"""
-            for i_new in u_detection:  # current frame's unmatched detection
-                track = cls_detections[i_new]
-                if track.score < self.det_thresh:
-                    continue
-
-                # tracked but not activated: activate do not set 'is_activated' to be True
-                track.activate(self.kalman_filter, self.frame_id)  # if fr_id > 1, tracked but not activated
-
-                # activated_tarcks_dict may contain track with 'is_activated' False
-                activated_tracks_dict[cls_id].append(track)
-
-            """Step 5: Update state"""
-            # update removed tracks
-            for track in self.lost_tracks_dict[cls_id]:
-                if self.frame_id - track.end_frame > self.max_time_lost:
-                    track.mark_removed()
-                    removed_tracks_dict[cls_id].append(track)
+                removed_tracks.append(track)
 
-            """Post processing"""
-            self.tracked_tracks_dict[cls_id] = [t for t in self.tracked_tracks_dict[cls_id] if
-                                                t.state == TrackState.Tracked]
-            self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id],
-                                                           activated_tracks_dict[cls_id])
-            self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id],
-                                                           refind_tracks_dict[cls_id])
+        """Post processing"""
+        self.tracked_tracks_dict[cls_id] = [t for t in self.tracked_tracks_dict[cls_id] if t.state == TrackState.Tracked]
+        self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id], activated_tracks)
+        self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id], refind_tracks)
 
-            self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id], self.tracked_tracks_dict[cls_id])
-            self.lost_tracks_dict[cls_id].extend(lost_tracks_dict[cls_id])
-            self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id], self.removed_tracks_dict[cls_id])
+        self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id], self.tracked_tracks_dict[cls_id])
+        self.lost_tracks_dict[cls_id].extend(lost_tracks)
+        self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id], self.removed_tracks_dict[cls_id])
 
-            self.removed_tracks_dict[cls_id].extend(removed_tracks_dict[cls_id])
+        self.removed_tracks_dict[cls_id].extend(removed_tracks)
 
-            self.tracked_tracks_dict[cls_id], self.lost_tracks_dict[cls_id] = remove_duplicate_tracks(
-                self.tracked_tracks_dict[cls_id],
-                self.lost_tracks_dict[cls_id])
+        self.tracked_tracks_dict[cls_id], self.lost_tracks_dict[cls_id] = remove_duplicate_tracks(
+            self.tracked_tracks_dict[cls_id],
+            self.lost_tracks_dict[cls_id])
 
-            # get scores of lost tracks
-            output_tracks_dict[cls_id] = [track for track in self.tracked_tracks_dict[cls_id] if track.is_activated]
+        # release the track table slots of removed(or dropped) tracks
+        self.track_tables[cls_id].retain(self.tracked_tracks_dict[cls_id] + self.lost_tracks_dict[cls_id])
 
-        ## ---------- Return final online targets of the frame
-        return output_tracks_dict
-        #################### MCMOT end
+        return [track for track in self.tracked_tracks_dict[cls_id] if track.is_activated]
 
     def update(self, output_results, img_info, img_size):
         """
@@ -1287,7 +1185,7 @@ class BYTETracker(object):
             track = detections[i_new]
             if track.score < self.det_thresh:
                 continue
-            track.activate(self.kalman_filter, self.frame_id)
+            track.activate(self.kalman_filter, self.frame_id, self.id_allocator)
             activated_tarcks.append(track)
 
         """Step 5: Update state"""
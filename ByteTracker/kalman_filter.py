@@ -20,6 +20,33 @@ chi2inv95 = {
     9: 16.919}
 
 
+def solve_lower_triangular(lower, b):
+    """
+    Batched forward substitution: solves lower @ x = b for T small lower triangular systems
+    :param lower: T×n×n lower triangular matrices(e.g. cholesky factors)
+    :param b: T×n×D right hand sides
+    :return: T×n×D solutions
+    """
+    x = np.empty(b.shape, dtype=np.result_type(lower, b))
+    for i in range(lower.shape[1]):
+        x[:, i] = (b[:, i] - np.einsum('tk,tkd->td', lower[:, i, :i], x[:, :i])) / lower[:, i, i, None]
+    return x
+
+
+def solve_upper_triangular(upper, b):
+    """
+    Batched back substitution: solves upper @ x = b for T small upper triangular systems
+    :param upper: T×n×n upper triangular matrices(e.g. transposed cholesky factors)
+    :param b: T×n×D right hand sides
+    :return: T×n×D solutions
+    """
+    n = upper.shape[1]
+    x = np.empty(b.shape, dtype=np.result_type(upper, b))
+    for i in range(n - 1, -1, -1):
+        x[:, i] = (b[:, i] - np.einsum('tk,tkd->td', upper[:, i, i + 1:], x[:, i + 1:])) / upper[:, i, i, None]
+    return x
+
+
 class KalmanFilter(object):
     """
     A simple Kalman filter for tracking bounding boxes in image space.
@@ -180,10 +207,8 @@ class KalmanFilter(object):
             self._std_weight_velocity * mean[:, 3]]
         sqr = np.square(np.r_[std_pos, std_vel]).T
 
-        motion_cov = []
-        for i in range(len(mean)):
-            motion_cov.append(np.diag(sqr[i]))
-        motion_cov = np.asarray(motion_cov)
+        motion_cov = np.zeros((len(mean), 8, 8))
+        motion_cov[:, np.arange(8), np.arange(8)] = sqr
 
         mean = np.dot(mean, self._motion_mat.T)
         left = np.dot(self._motion_mat, covariance).transpose((1, 0, 2))
@@ -267,4 +292,109 @@ class KalmanFilter(object):
             squared_maha = np.sum(z * z, axis=0)
             return squared_maha
         else:
-            raise ValueError('invalid distance metric')
\ No newline at end of file
+            raise ValueError('invalid distance metric')
+
+    def multi_project(self, mean, covariance):
+        """Project state distributions to measurement space (Vectorized version).
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean matrix of the object states.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrics of the object states.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx4 projected means and Nx4x4 projected covariance
+            matrics of the given state estimates.
+        """
+        std = [
+            self._std_weight_position * mean[:, 3],
+            self._std_weight_position * mean[:, 3],
+            1e-1 * np.ones_like(mean[:, 3]),
+            self._std_weight_position * mean[:, 3]
+        ]
+        sqr = np.square(np.r_[std]).T
+
+        innovation_cov = np.zeros((len(mean), 4, 4))
+        innovation_cov[:, np.arange(4), np.arange(4)] = sqr
+
+        mean = np.dot(mean, self._update_mat.T)
+        covariance = np.matmul(np.matmul(self._update_mat, covariance), self._update_mat.T)
+        return mean, covariance + innovation_cov
+
+    def multi_update(self, mean, covariance, measurement):
+        """Run Kalman filter correction step (Vectorized version):
+        the projected covariances are factorized by one batched Cholesky decomposition.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional predicted states' mean matrix.
+        covariance : ndarray
+            The Nx8x8 dimensional states' covariance matrics.
+        measurement : ndarray
+            The Nx4 dimensional measurement matrix (x, y, a, h), one row for each state.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the measurement-corrected state distributions.
+        """
+        projected_mean, projected_cov = self.multi_project(mean, covariance)
+
+        # solve (L L^T) K^T = (P H^T)^T for all states
+        chol_factor = np.linalg.cholesky(projected_cov)
+        b = np.matmul(covariance, self._update_mat.T).transpose((0, 2, 1))
+        kalman_gain = solve_upper_triangular(chol_factor.transpose((0, 2, 1)),
+                                             solve_lower_triangular(chol_factor, b)).transpose((0, 2, 1))
+        innovation = measurement - projected_mean
+
+        new_mean = mean + np.matmul(kalman_gain, innovation[:, :, None])[:, :, 0]
+        new_covariance = covariance - np.matmul(np.matmul(kalman_gain, projected_cov),
+                                                kalman_gain.transpose((0, 2, 1)))
+        return new_mean, new_covariance
+
+    def multi_gating_distance(self,
+                              mean,
+                              covariance,
+                              measurements,
+                              only_position=False,
+                              metric='maha'):
+        """Compute gating distance between T state distributions and D measurements
+        (Vectorized version): all covariances are projected at once and all the
+        triangular systems are solved in one batched call.
+        Parameters
+        ----------
+        :param mean : ndarray
+            The Tx8 dimensional mean matrix of the state distributions.
+        :param covariance : ndarray
+            The Tx8x8 dimensional covariance matrics of the state distributions.
+        :param measurements : ndarray
+            A Dx4 dimensional matrix of D measurements, each in
+            format (x, y, a, h).
+        :param only_position : Optional[bool]
+            If True, distance computation is done with respect to the bounding
+            box center position only.
+        :param metric
+        :return:
+        -------
+        ndarray
+            Returns a TxD matrix, where the (i, j) element contains the
+            squared Mahalanobis distance between the i-th state distribution and
+            `measurements[j]`.
+        """
+        mean, covariance = self.multi_project(mean, covariance)
+        if only_position:
+            mean, covariance = mean[:, :2], covariance[:, :2, :2]
+            measurements = measurements[:, :2]
+
+        d = measurements[None, :, :] - mean[:, None, :]  # T×D×4
+        if metric == 'gaussian':
+            return np.sum(d * d, axis=2)
+        elif metric == 'maha':
+            # solve the T small triangular systems for all D measurements at once
+            cholesky_factor = np.linalg.cholesky(covariance)
+            z = solve_lower_triangular(cholesky_factor, d.transpose((0, 2, 1)))  # T×4×D
+            squared_maha = np.sum(z * z, axis=1)
+            return squared_maha
+        else:
+            raise ValueError('invalid distance metric')
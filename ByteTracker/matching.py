@@ -6,7 +6,7 @@ import numpy as np
 import scipy
 from cython_bbox import bbox_overlaps as bbox_ious
 from scipy.spatial.distance import cdist
-from yolox.tracker import kalman_filter
+from ByteTracker import kalman_filter
 
 
 def merge_matches(m1, m2, shape):
@@ -151,6 +151,22 @@ def embedding_distance(tracks, detections, metric='cosine'):
     return cost_matrix
 
 
+def gating_distance_matrix(kf, tracks, measurements, only_position=False, metric='maha'):
+    """
+    Gating distances of all tracks to all measurements: all track covariances are
+    projected at once and all triangular systems are solved in one batched call
+    :param kf:
+    :param tracks: T tracks
+    :param measurements: D×4 measurements (x, y, a, h)
+    :param only_position:
+    :param metric:
+    :return: T×D gating distance matrix
+    """
+    means = np.asarray([track.mean for track in tracks])
+    covariances = np.asarray([track.covariance for track in tracks])
+    return kf.multi_gating_distance(means, covariances, measurements, only_position, metric)
+
+
 def gate_cost_matrix(kf, cost_matrix, tracks, detections, only_position=False):
     """
     :param kf:
@@ -162,13 +178,14 @@ def gate_cost_matrix(kf, cost_matrix, tracks, detections, only_position=False):
     """
     if cost_matrix.size == 0:
         return cost_matrix
+
     gating_dim = 2 if only_position else 4
     gating_threshold = kalman_filter.chi2inv95[gating_dim]
     measurements = np.asarray([det.to_xyah() for det in detections])
-    for row, track in enumerate(tracks):
-        gating_distance = kf.gating_distance(
-            track.mean, track.covariance, measurements, only_position)
-        cost_matrix[row, gating_distance > gating_threshold] = np.inf
+
+    gating_distance = gating_distance_matrix(kf, tracks, measurements, only_position)
+    cost_matrix[gating_distance > gating_threshold] = np.inf
+
     return cost_matrix
 
 
@@ -184,14 +201,15 @@ def fuse_motion(kf, cost_matrix, tracks, detections, only_position=False, lambda
     """
     if cost_matrix.size == 0:
         return cost_matrix
+
     gating_dim = 2 if only_position else 4
     gating_threshold = kalman_filter.chi2inv95[gating_dim]
     measurements = np.asarray([det.to_xyah() for det in detections])
-    for row, track in enumerate(tracks):
-        gating_distance = kf.gating_distance(
-            track.mean, track.covariance, measurements, only_position, metric='maha')
-        cost_matrix[row, gating_distance > gating_threshold] = np.inf
-        cost_matrix[row] = lambda_ * cost_matrix[row] + (1 - lambda_) * gating_distance
+
+    gating_distance = gating_distance_matrix(kf, tracks, measurements, only_position, metric='maha')
+    cost_matrix[gating_distance > gating_threshold] = np.inf
+    cost_matrix[:] = lambda_ * cost_matrix + (1 - lambda_) * gating_distance
+
     return cost_matrix
 
 
@@ -271,4 +289,24 @@ def weight_sum_costs(cost_mat1, cost_mat2, alpha=0.5):
     fuse_sim = sim1 * alpha + (1.0 - alpha) * sim2
     fuse_cost = 1.0 - fuse_sim
 
-    return fuse_cost
\ No newline at end of file
+    return fuse_cost
+
+
+def mask_class_mismatch(cost_matrix, tracks, detections):
+    """
+    Set the costs between tracks and detections of different object classes to inf,
+    so that the tracks and detections of all classes can be associated at once
+    (block-diagonal cost matrix)
+    :param cost_matrix:
+    :param tracks:
+    :param detections:
+    :return:
+    """
+    if cost_matrix.size == 0:
+        return cost_matrix
+
+    track_cls_ids = np.array([track.cls_id for track in tracks])
+    det_cls_ids = np.array([det.cls_id for det in detections])
+    cost_matrix[track_cls_ids[:, None] != det_cls_ids[None, :]] = np.inf
+
+    return cost_matrix
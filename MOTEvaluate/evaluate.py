@@ -431,12 +431,17 @@ def parse_args():
     return args
 
 
-def evaluate_mcmot_seqs(test_root, default_fps=12):
+def evaluate_mcmot_seqs(test_root, default_fps=12, res_root=None):
     """
     :param test_root:
     :param default_fps: fps for sampling
-    :return:
+    :param res_root: dir of the tracking result files(None: test_root),
+    to compare the results of different models(i.e. fp32 vs int8) on the same ground truth
+    :return: mean metrics of all test seqs(ordered as metric_names)
     """
+    if res_root is None:
+        res_root = test_root
+
     if not os.path.isdir(test_root):
         print('[Err]: invalid test root.')
         return
@@ -450,7 +455,7 @@ def evaluate_mcmot_seqs(test_root, default_fps=12):
     for i, seq_name in enumerate(seq_names):
         seq_name = seq_name[:-4]
         gt_path = test_root + '/' + seq_name + '_gt_mot16' + '_fps' + str(default_fps) + '.txt'
-        res_path = test_root + '/' + seq_name + '_results_fps' + str(default_fps) + '.txt'
+        res_path = res_root + '/' + seq_name + '_results_fps' + str(default_fps) + '.txt'
 
         if not (os.path.isfile(gt_path) and os.path.isfile(res_path)):
             print('[Warning]: {:s} test file not exists.'.format(seq_name))
@@ -466,6 +471,7 @@ def evaluate_mcmot_seqs(test_root, default_fps=12):
     mean_metrics = metrics.mean(axis=0)  # mean value of each column
     print_metrics('All test seq evaluation mean metrics: '.format(seq_name), mean_metrics)
 
+    return mean_metrics
 
 
 if __name__ == '__main__':
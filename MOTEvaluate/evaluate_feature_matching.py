@@ -15,7 +15,7 @@ import torch.nn.functional as F
 from models import Darknet, load_darknet_weights
 from utils.datasets import LoadImages
 from utils.utils import load_classes, non_max_suppression, \
-    map_resize_back, cos, find_free_gpu
+    map_resize_back, cos, find_free_gpu, gather_reid_feats
 from mAPEvaluate.cmp_det_label_sf import box_iou as b_iou
 from tqdm import tqdm
 
@@ -453,45 +453,29 @@ class FeatureMatcher(object):
 
         return TPs, GT_tr_ids
 
-    def get_feature(self, reid_feat_map,
-                    feat_map_w, feat_map_h,
-                    img_w, img_h,
-                    x1, y1, x2, y2):
+    def get_features(self, reid_feat_out, dets, img_w, img_h, yolo_inds=None):
         """
-        Get feature vector
-        :param reid_feat_map:
-        :param feat_map_w:
-        :param feat_map_h:
+        Get L2 normalized feature vectors of all dets
+        :param reid_feat_out: list of reid feature maps(tensor)
+        :param dets: x1, y1, x2, y2, ...
         :param img_w:
         :param img_h:
-        :param x1:
-        :param y1:
-        :param x2:
-        :param y2:
-        :return:
+        :param yolo_inds: which feature map each det belongs to(None for one feature map)
+        :return: N×D numpy array
         """
-        # get center point
-        center_x = (x1 + x2) * 0.5
-        center_y = (y1 + y2) * 0.5
-
-        # map center point from net scale to feature map scale(1/4 of net input size)
-        center_x = center_x / float(img_w)
-        center_x = center_x * float(feat_map_w)
-        center_y = center_y / float(img_h)
-        center_y = center_y * float(feat_map_h)
-
-        # convert to int64 for indexing
-        center_x = int(center_x + 0.5)
-        center_y = int(center_y + 0.5)
+        dets = np.array([det[:4] for det in dets], dtype=np.float32).reshape(-1, 4)
+        if yolo_inds is None:
+            return gather_reid_feats(reid_feat_out[0], dets, img_w, img_h)
 
-        # to avoid the object center out of reid feature map's range
-        center_x = np.clip(center_x, 0, feat_map_w - 1)
-        center_y = np.clip(center_y, 0, feat_map_h - 1)
+        # gather the dets belonging to each feature map in one shot
+        yolo_inds = np.array(yolo_inds, dtype=np.int64).reshape(-1)
+        reid_dim = reid_feat_out[0].shape[1]
+        feats = np.zeros((len(dets), reid_dim), dtype=np.float32)
+        for yolo_id in np.unique(yolo_inds):
+            inds = np.where(yolo_inds == yolo_id)[0]
+            feats[inds] = gather_reid_feats(reid_feat_out[yolo_id], dets[inds], img_w, img_h)
 
-        # get reid feature vector and put into a dict
-        reid_feat_vect = reid_feat_map[0, :, center_y, center_x]
-
-        return reid_feat_vect
+        return feats
 
     def run_a_seq(self, seq_name, cls_id=0, img_w=1920, img_h=1080, viz_dir=None):
         """
@@ -538,24 +522,13 @@ class FeatureMatcher(object):
                     if fr_id % 100 == 0:
                         print('Frame %d done, time: %.3fms' % (fr_id, 1000.0 * (t2 - t1)))
 
-                    # ----- get reid feature map: reid_feat_out: GPU -> CPU and L2 normalize
-                    feat_tmp_list = []
-                    for tmp in reid_feat_out:
-                        # L2 normalize the feature map(feature map scale)
-                        tmp = F.normalize(tmp, dim=1)
-
-                        if fr_id == 0:
+                    # ----- reid feature maps stay on device: only TPs' vectors are gathered
+                    if fr_id == 0:
+                        for tmp in reid_feat_out:
                             # feature map size
                             n, c, h, w = tmp.shape
                             print('Feature map size: {:d}×{:d}'.format(w, h))
 
-                        # GPU -> CPU
-                        tmp = tmp.detach().cpu().numpy()
-
-                        feat_tmp_list.append(tmp)
-
-                    reid_feat_out = feat_tmp_list
-
                 elif len(self.model.feat_out_ids) == 1:
                     t1 = torch_utils.time_synchronized()
 
@@ -565,7 +538,7 @@ class FeatureMatcher(object):
                     if fr_id % 20 == 0:
                         print('Frame %d done, time: %.5fms' % (fr_id, 1000.0 * (t2 - t1)))
 
-                    # ----- get reid feature map: reid_feat_out: GPU -> CPU and L2 normalize
+                    # ----- reid feature map stays on device: only TPs' vectors are gathered
                     reid_feat_map = reid_feat_out[0]
 
                     if fr_id == 0:
@@ -573,12 +546,6 @@ class FeatureMatcher(object):
                         n, c, h, w = reid_feat_map.shape
                         print('Feature map size: {:d}×{:d}'.format(w, h))
 
-                    # L2 normalize the feature map(feature map scale(1/4 or 1/8 of net input size))
-                    reid_feat_map = F.normalize(reid_feat_map, dim=1)
-
-                    reid_feat_map = reid_feat_map.detach().cpu().numpy()
-                    b, reid_dim, feat_map_h, feat_map_w = reid_feat_map.shape
-
                 # ----- apply NMS
                 if len(self.model.feat_out_ids) == 3:
                     pred, pred_yolo_ids = non_max_suppression_with_yolo_inds(predictions=pred,
@@ -638,6 +605,12 @@ class FeatureMatcher(object):
 
             num_tps += len(TPs)
 
+            # ----- get L2 normalized reid feature vectors of TPs: GPU -> CPU
+            if len(self.model.feat_out_ids) == 3:
+                TP_feats = self.get_features(reid_feat_out, TPs, img_w, img_h, TP_yolo_inds)
+            elif len(self.model.feat_out_ids) == 1:
+                TP_feats = self.get_features([reid_feat_map], TPs, img_w, img_h)
+
             # ----- build mapping from TP id to GT track id
             tpid_to_gttrid = [GT_tr_ids[x] for x in range(len(TPs))]
 
@@ -680,20 +653,12 @@ class FeatureMatcher(object):
                 if len(self.model.feat_out_ids) == 1:  # one feature map layer
                     for tpid_cur, det_cur in zip(TPs_ids_cur, TPs_cur):  # current frame as row
                         x1_cur, y1_cur, x2_cur, y2_cur = det_cur[:4]
-                        reid_feat_vect_cur = self.get_feature(reid_feat_map,
-                                                              feat_map_w, feat_map_h,
-                                                              img_w, img_h,
-                                                              x1_cur, y1_cur, x2_cur, y2_cur)
+                        reid_feat_vect_cur = TP_feats[tpid_cur]
 
                         best_sim = -1.0
                         best_tpid_pre = -1
                         for tpid_pre, det_pre in zip(TPs_ids_pre, TPs_pre):  # previous frame as col
-                            x1_pre, y1_pre, x2_pre, y2_pre = det_pre[:4]
-
-                            reid_feat_vect_pre = self.get_feature(self.reid_feat_map_pre,
-                                                                  feat_map_w, feat_map_h,
-                                                                  img_w, img_h,
-                                                                  x1_pre, y1_pre, x2_pre, y2_pre)
+                            reid_feat_vect_pre = self.TP_feats_pre[tpid_pre]
 
                             # --- compute cosine of cur and pre corresponding feature vector
                             sim = cos(reid_feat_vect_cur, reid_feat_vect_pre)
@@ -807,28 +772,13 @@ class FeatureMatcher(object):
                     for tpid_cur, det_cur, yolo_id_cur in zip(TPs_ids_cur, TPs_cur,
                                                               TP_yolo_inds_cur):  # current frame as row
                         x1_cur, y1_cur, x2_cur, y2_cur = det_cur[:4]
-
-                        reid_feat_map_cur = reid_feat_out[yolo_id_cur]
-                        b, reid_dim, feat_map_h_cur, feat_map_w_cur = reid_feat_map_cur.shape
-
-                        reid_feat_vect_cur = self.get_feature(reid_feat_map_cur,
-                                                              feat_map_w_cur, feat_map_h_cur,
-                                                              img_w, img_h,
-                                                              x1_cur, y1_cur, x2_cur, y2_cur)
+                        reid_feat_vect_cur = TP_feats[tpid_cur]
 
                         best_sim = -1.0
                         best_tpid_pre = -1
                         for tpid_pre, det_pre, yolo_id_pre in zip(TPs_ids_pre, TPs_pre,
                                                                   TP_yolo_inds_pre):  # previous frame as col
-                            x1_pre, y1_pre, x2_pre, y2_pre = det_pre[:4]
-
-                            reid_feat_map_pre = self.reid_feat_out_pre[yolo_id_pre]
-                            b, reid_dim, feat_map_h_pre, feat_map_w_pre = reid_feat_map_pre.shape
-
-                            reid_feat_vect_pre = self.get_feature(reid_feat_map_pre,
-                                                                  feat_map_w_pre, feat_map_h_pre,
-                                                                  img_w, img_h,
-                                                                  x1_pre, y1_pre, x2_pre, y2_pre)
+                            reid_feat_vect_pre = self.TP_feats_pre[tpid_pre]
 
                             # --- compute cosine of cur and pre corresponding feature vector
                             sim = cos(reid_feat_vect_cur, reid_feat_vect_pre)
@@ -931,11 +881,9 @@ class FeatureMatcher(object):
             self.TPs_pre = TPs
             self.GT_tr_ids_pre = GT_tr_ids
             self.tpid_to_gttrid_pre = tpid_to_gttrid
+            self.TP_feats_pre = TP_feats  # TPs' feature vectors
 
-            if len(self.model.feat_out_ids) == 1:
-                self.reid_feat_map_pre = reid_feat_map  # contains 1 feature map
-            elif len(self.model.feat_out_ids) == 3:
-                self.reid_feat_out_pre = reid_feat_out  # contains 3 feature map
+            if len(self.model.feat_out_ids) == 3:
                 self.TP_yolo_inds_pre = TP_yolo_inds
 
             self.img0_pre = img0
@@ -0,0 +1,166 @@
+# encoding=utf-8
+"""
+Training step(forward + backward) peak memory and speed on cpu of the mish(swish) cfgs:
+the plain activation(x * tanh(softplus(x)), autograd keeps its intermediate tensors) vs.
+the memory efficient activation(Mish/Swish of utils/layers.py: only the input saved for backward),
+with random weights and a random loss. Each(cfg, activation) runs in a fresh process to report its
+peak resident memory; the bytes saved for backward are reported too(torch >= 1.10).
+
+usage: python3 ./benchmarks/bench_activations.py --cfgs cfg/yolov4-pacsp-mish.cfg --batch-size 4
+"""
+import sys
+
+sys.path.append('.')
+import argparse
+import json
+import resource
+import subprocess
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models import Darknet
+from utils.layers import Mish, Swish, MISH_CUDA
+
+
+class PlainMish(nn.Module):
+    def forward(self, x):
+        return x * F.softplus(x).tanh()
+
+
+class PlainSwish(nn.Module):
+    def forward(self, x):
+        return x * torch.sigmoid(x)
+
+
+def use_plain_activations(model):
+    """
+    :param model:
+    :return:
+    """
+    for module in model.module_list:
+        if isinstance(module, nn.Sequential) and 'activation' in module._modules:
+            if isinstance(module.activation, Mish):
+                module.activation = PlainMish()
+            elif isinstance(module.activation, Swish):
+                module.activation = PlainSwish()
+
+
+def saved_bytes(func):
+    """
+    :param func: forward function
+    :return: output of func, bytes of the tensors saved for backward(-1: not supported)
+    """
+    if not hasattr(torch.autograd, 'graph') or not hasattr(torch.autograd.graph, 'saved_tensors_hooks'):
+        return func(), -1
+
+    storages = {}
+
+    def pack(x):
+        storages[x.data_ptr()] = x.numel() * x.element_size()
+        return x
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        out = func()
+    return out, sum(storages.values())
+
+
+def run_one(opt):
+    """
+    Runs one(cfg, activation) in this process and prints the result as json
+    :param opt:
+    :return:
+    """
+    torch.manual_seed(0)
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    model = Darknet(opt.cfg, (opt.net_h, opt.net_w), mode='detect').train()
+    if opt.activation == 'plain':
+        use_plain_activations(model)
+    x = torch.rand(opt.batch_size, 3, opt.net_h, opt.net_w)
+
+    def step():
+        model.zero_grad()
+        out = model(x)
+        sum(o.float().mean() for o in out).backward()
+
+    out, n_bytes = saved_bytes(lambda: model(x))
+    del out
+
+    step()  # warm up
+    t1 = time.perf_counter()
+    for _ in range(opt.iters):
+        step()
+    t2 = time.perf_counter()
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KB -> MB on linux
+    print(json.dumps({'ms': (t2 - t1) * 1000.0 / opt.iters, 'peak_mb': peak, 'saved_mb': n_bytes / 2 ** 20}))
+
+
+def run(opt):
+    """
+    :param opt:
+    :return:
+    """
+    if MISH_CUDA:
+        print('Warning: mish_cuda installed, Mish is MishCuda(not the fallback being benchmarked).')
+
+    results = []
+    for cfg in opt.cfgs:
+        for activation in ('plain', 'efficient'):
+            cmd = [sys.executable, __file__, '--one', '--cfg', cfg, '--activation', activation,
+                   '--net_w', str(opt.net_w), '--net_h', str(opt.net_h), '--batch-size', str(opt.batch_size),
+                   '--threads', str(opt.threads), '--iters', str(opt.iters)]
+            out = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            results.append((cfg, activation, json.loads(out.strip().splitlines()[-1])))
+
+    print('{:>32s} {:>10s} {:>10s} {:>12s} {:>10s}'.format('cfg', 'activation', 'step(ms)', 'peak_rss(MB)', 'saved(MB)'))
+    for cfg, activation, r in results:
+        print('{:>32s} {:>10s} {:>10.1f} {:>12.1f} {:>10.1f}'
+              .format(cfg.split('/')[-1], activation, r['ms'], r['peak_mb'], r['saved_mb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cfgs',
+                        nargs='+',
+                        type=str,
+                        default=['cfg/yolov4-pacsp-s-mish.cfg',
+                                 'cfg/yolov4-pacsp-mish.cfg',
+                                 'cfg/yolov4-pacsp-x-mish.cfg'],
+                        help='cfg files to benchmark')
+    parser.add_argument('--net_w',
+                        type=int,
+                        default=416,
+                        help='net input width')
+    parser.add_argument('--net_h',
+                        type=int,
+                        default=416,
+                        help='net input height')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=2,
+                        help='batch size')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=0,
+                        help='number of cpu threads(0: torch default)')
+    parser.add_argument('--iters',
+                        type=int,
+                        default=3,
+                        help='timing iterations')
+
+    # ----- a single run(in a child process)
+    parser.add_argument('--one', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--cfg', type=str, default='', help=argparse.SUPPRESS)
+    parser.add_argument('--activation', type=str, default='efficient', help=argparse.SUPPRESS)
+
+    opt = parser.parse_args()
+    if opt.one:
+        run_one(opt)
+    else:
+        run(opt)
@@ -0,0 +1,109 @@
+# encoding=utf-8
+"""
+Micro-benchmark of Mahalanobis gating:
+per-track kf.gating_distance loop vs. the batched matching.gating_distance_matrix,
+for a grid of T(number of tracks) and D(number of detections).
+
+usage: python3 ./benchmarks/bench_gating.py --tracks 10 100 300 --dets 10 100 300
+"""
+import sys
+
+sys.path.append('.')
+import argparse
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from tracker.matching import gating_distance_matrix
+from tracking_utils.kalman_filter import KalmanFilter
+
+
+def random_states(kf, n, rng):
+    """
+    :param kf:
+    :param n:
+    :param rng:
+    :return: n tracks with predicted mean and covariance
+    """
+    tracks = []
+    for i in range(n):
+        measurement = rng.random(4) * [1920.0, 1080.0, 1.0, 200.0] + [0.0, 0.0, 0.2, 10.0]
+        mean, covariance = kf.initiate(measurement)
+        mean, covariance = kf.predict(mean, covariance)
+        tracks.append(SimpleNamespace(mean=mean, covariance=covariance))
+    return tracks
+
+
+def loop_gating(kf, tracks, measurements, only_position=False):
+    """
+    The per-row path: project and factorize one track covariance at a time
+    """
+    gating_distance = np.zeros((len(tracks), len(measurements)))
+    for row, track in enumerate(tracks):
+        gating_distance[row] = kf.gating_distance(track.mean, track.covariance, measurements, only_position)
+    return gating_distance
+
+
+def timeit(func, n_iters):
+    """
+    :param func:
+    :param n_iters:
+    :return: ms per call
+    """
+    func()  # warm up
+    t1 = time.perf_counter()
+    for _ in range(n_iters):
+        func()
+    t2 = time.perf_counter()
+    return (t2 - t1) * 1000.0 / n_iters
+
+
+def run(opt):
+    """
+    :param opt:
+    :return:
+    """
+    kf = KalmanFilter()
+    rng = np.random.default_rng(0)
+
+    print('{:>6s} {:>6s} {:>12s} {:>12s} {:>8s} {:>10s}'
+          .format('T', 'D', 'loop(ms)', 'batched(ms)', 'speedup', 'max_diff'))
+    for n_tracks in opt.tracks:
+        tracks = random_states(kf, n_tracks, rng)
+        for n_dets in opt.dets:
+            measurements = np.asarray([track.mean[:4] for track in random_states(kf, n_dets, rng)])
+
+            ref = loop_gating(kf, tracks, measurements, opt.only_position)
+            out = gating_distance_matrix(kf, tracks, measurements, opt.only_position)
+            max_diff = np.max(np.abs(out - ref) / np.maximum(np.abs(ref), 1.0))
+
+            t_loop = timeit(lambda: loop_gating(kf, tracks, measurements, opt.only_position), opt.iters)
+            t_batch = timeit(lambda: gating_distance_matrix(kf, tracks, measurements, opt.only_position), opt.iters)
+            print('{:>6d} {:>6d} {:>12.3f} {:>12.3f} {:>7.1f}x {:>10.2e}'
+                  .format(n_tracks, n_dets, t_loop, t_batch, t_loop / t_batch, max_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--tracks',
+                        nargs='+',
+                        type=int,
+                        default=[10, 50, 100, 300, 1000],
+                        help='numbers of tracks(T)')
+    parser.add_argument('--dets',
+                        nargs='+',
+                        type=int,
+                        default=[10, 100, 300],
+                        help='numbers of detections(D)')
+    parser.add_argument('--only-position',
+                        action='store_true',
+                        help='gating with the center position only')
+    parser.add_argument('--iters',
+                        type=int,
+                        default=20,
+                        help='timing iterations for each (T, D)')
+
+    opt = parser.parse_args()
+    run(opt)
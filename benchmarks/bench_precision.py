@@ -0,0 +1,109 @@
+# encoding=utf-8
+"""
+Frames/sec of the Darknet inference forward for each precision(fp32, bf16) and
+memory format(contiguous, channels_last) combination(Darknet.set_precision),
+with random weights, for a list of cfg files; also reports the max abs difference
+of the decoded outputs w.r.t. fp32 contiguous.
+
+usage: python3 ./benchmarks/bench_precision.py --cfgs cfg/yolov4-tiny.cfg cfg/yolov4-pacsp.cfg --threads 8
+"""
+import sys
+
+sys.path.append('.')
+import argparse
+import time
+
+import torch
+
+from models import Darknet
+
+
+def timeit(func, n_iters):
+    """
+    :param func:
+    :param n_iters:
+    :return: ms per call
+    """
+    func()  # warm up
+    t1 = time.perf_counter()
+    for _ in range(n_iters):
+        func()
+    t2 = time.perf_counter()
+    return (t2 - t1) * 1000.0 / n_iters
+
+
+def run(opt):
+    """
+    :param opt:
+    :return:
+    """
+    torch.manual_seed(0)
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    combos = [(precision, memory_format)
+              for precision in opt.precisions
+              for memory_format in ('contiguous', 'channels_last')]
+
+    results = []
+    for cfg in opt.cfgs:
+        model = Darknet(cfg, (opt.net_h, opt.net_w), mode='detect').eval()
+        x = torch.rand(opt.batch_size, 3, opt.net_h, opt.net_w)
+
+        ref = None
+        with torch.no_grad():
+            for precision, memory_format in combos:
+                model.set_precision(precision, memory_format)
+                out = model(x)[0]
+                if ref is None:
+                    ref = out
+                ms = timeit(lambda: model(x), opt.iters)
+                max_diff = (out - ref).abs().max().item()
+                results.append((cfg, precision, memory_format, 1000.0 * opt.batch_size / ms, max_diff))
+
+    print('{:>32s} {:>9s} {:>14s} {:>8s} {:>10s}'.format('cfg', 'precision', 'memory_format', 'fps', 'max_diff'))
+    for cfg, precision, memory_format, fps, max_diff in results:
+        print('{:>32s} {:>9s} {:>14s} {:>8.2f} {:>10.2e}'
+              .format(cfg.split('/')[-1], precision, memory_format, fps, max_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cfgs',
+                        nargs='+',
+                        type=str,
+                        default=['cfg/yolov4-tiny.cfg',
+                                 'cfg/yolov4-pacsp.cfg',
+                                 'cfg/yolov4-pacsp-s.cfg',
+                                 'cfg/yolov4-pacsp-mish.cfg',
+                                 'cfg/yolov4-paspp-mcmot.cfg'],
+                        help='cfg files to benchmark')
+    parser.add_argument('--precisions',
+                        nargs='+',
+                        type=str,
+                        default=['fp32', 'bf16'],
+                        help='precisions to benchmark')
+    parser.add_argument('--net_w',
+                        type=int,
+                        default=768,
+                        help='net input width')
+    parser.add_argument('--net_h',
+                        type=int,
+                        default=448,
+                        help='net input height')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=1,
+                        help='batch size')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=0,
+                        help='number of cpu threads(0: torch default)')
+    parser.add_argument('--iters',
+                        type=int,
+                        default=10,
+                        help='timing iterations for each combination')
+
+    opt = parser.parse_args()
+    run(opt)
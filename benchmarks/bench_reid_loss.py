@@ -0,0 +1,216 @@
+# encoding=utf-8
+"""
+Training step(forward + backward) throughput of the multi-class reid loss:
+the per class loop(one classifier and one CrossEntropyLoss for each object class)
+vs. the packed classifier(one matmul and one masked CE, packed_id_loss),
+with random reid feature vectors and track ids, for the object classes of a cfg;
+also reports the max abs difference of the losses and of the classifier gradients.
+--loss ghmc compares the GHM-C loss of the single GPU training path instead:
+GHMC on each class's block of the packed logits vs. packed_ghmc_loss.
+
+usage: python3 ./benchmarks/bench_reid_loss.py --cfg cfg/yolov4-paspp-mcmot.cfg --fc Arc --device cuda:0
+"""
+import sys
+
+sys.path.append('.')
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils.layers import ArcMargin
+from utils.parse_config import parse_model_cfg
+from utils.utils import packed_id_logits, packed_id_loss, packed_ghmc_loss
+
+
+def loop_id_loss(id_vects, cls_ids, tr_ids, id_classifiers, fc_type):
+    """
+    The per class reid loss of compute_loss_with_ids before packing(reference)
+    :return:
+    """
+    CE_reid = nn.CrossEntropyLoss()
+    l_reid = id_vects.new_zeros(1)
+    for cls_id, classifier in enumerate(id_classifiers):
+        inds = torch.where(cls_ids == cls_id)
+        if inds[0].shape[0] == 0:
+            continue
+
+        if fc_type == 'FC':
+            fc_preds = classifier.forward(id_vects[inds]).contiguous()
+        else:
+            fc_preds = classifier.forward(id_vects[inds], tr_ids[inds]).contiguous()
+        l_reid += CE_reid(fc_preds, tr_ids[inds])
+
+    return l_reid
+
+
+def ghmc(pred, target, bins=100):
+    """
+    GHMC.forward(momentum 0, all labels valid) on any device(reference)
+    :return:
+    """
+    edges = torch.arange(bins + 1, device=pred.device).float() / bins
+    edges[-1] += 1e-6
+    weights = torch.zeros_like(pred, dtype=torch.float32)
+    g = torch.abs(pred.sigmoid().detach() - target)
+    tot = max(float(pred.numel()), 1.0)
+
+    n = 0  # n valid bins
+    for i in range(bins):
+        inds = (g >= edges[i]) & (g < edges[i + 1])
+        num_in_bin = inds.sum().item()
+        if num_in_bin > 0:
+            weights[inds] = tot / num_in_bin
+            n += 1
+    if n > 0:
+        weights = weights / n
+
+    return F.binary_cross_entropy_with_logits(pred, target, weights, reduction='sum') / tot
+
+
+def loop_ghmc_loss(id_vects, cls_ids, tr_ids, id_classifiers, fc_type):
+    """
+    The per class GHM-C reid loss of compute_loss_one_layer before vectorizing(reference)
+    :return:
+    """
+    logits, targets, _, offsets = packed_id_logits(id_vects, cls_ids, tr_ids, id_classifiers, fc_type)
+    bounds = offsets.tolist() + [logits.shape[1]]  # each class's column block
+
+    l_reid = id_vects.new_zeros(1)
+    for cls_id in range(len(id_classifiers)):
+        inds = torch.where(cls_ids == cls_id)
+        if inds[0].shape[0] == 0:
+            continue
+
+        fc_preds = logits[inds][:, bounds[cls_id]:bounds[cls_id + 1]]
+        target = torch.zeros_like(fc_preds)
+        target.scatter_(1, (targets[inds] - bounds[cls_id]).view(-1, 1), 1)
+        l_reid += ghmc(fc_preds, target)
+
+    return l_reid
+
+
+def ghmc_id_loss(id_vects, cls_ids, tr_ids, id_classifiers, fc_type):
+    """
+    The GHM-C reid loss of compute_loss_one_layer
+    :return:
+    """
+    logits, targets, col_cls, _ = packed_id_logits(id_vects, cls_ids, tr_ids, id_classifiers, fc_type)
+    return packed_ghmc_loss(logits, targets, cls_ids, col_cls)
+
+
+def timeit(func, n_iters, device):
+    """
+    :param func:
+    :param n_iters:
+    :param device:
+    :return: ms per call
+    """
+    func()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    t1 = time.perf_counter()
+    for _ in range(n_iters):
+        func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    t2 = time.perf_counter()
+    return (t2 - t1) * 1000.0 / n_iters
+
+
+def run(opt):
+    """
+    :param opt:
+    :return:
+    """
+    device = torch.device(opt.device)
+    torch.manual_seed(0)
+
+    # ----- number of track ids of each object class
+    nc = [mdef for mdef in parse_model_cfg(opt.cfg) if mdef['type'] == 'yolo'][0]['classes']
+    if os.path.isfile(opt.max_id_dict):
+        max_id_dict = np.load(opt.max_id_dict, allow_pickle=True)['max_id_dict'][()]
+    else:
+        max_id_dict = {cls_id: opt.n_ids for cls_id in range(nc)}
+    print('{:d} object classes, track ids: {}'.format(nc, max_id_dict))
+
+    if opt.fc == 'FC':
+        id_classifiers = nn.ModuleList([nn.Linear(opt.dim, n_ids) for n_ids in max_id_dict.values()])
+    else:
+        id_classifiers = nn.ModuleList([ArcMargin(opt.dim, n_ids, device=device, m=0.1)
+                                        for n_ids in max_id_dict.values()])
+    id_classifiers.to(device)
+
+    # ----- GT of a batch: class ids and track ids in each class
+    cls_ids = torch.randint(0, nc, (opt.n_gt,), device=device)
+    n_ids = torch.tensor(list(max_id_dict.values()), device=device)
+    tr_ids = (torch.rand(opt.n_gt, device=device) * n_ids[cls_ids]).long()
+    feats = torch.randn(opt.n_gt, opt.dim, device=device, requires_grad=True)
+
+    def step(loss_func):
+        id_classifiers.zero_grad()
+        feats.grad = None
+        loss = loss_func(F.normalize(feats, dim=1), cls_ids, tr_ids, id_classifiers, opt.fc)
+        loss.backward()
+        return loss
+
+    loop_loss, packed_loss = (loop_ghmc_loss, ghmc_id_loss) if opt.loss == 'ghmc' else (loop_id_loss, packed_id_loss)
+    ref = step(loop_loss).item()
+    ref_grads = [p.grad.clone() for p in id_classifiers.parameters()]
+    out = step(packed_loss).item()
+    max_diff = max([abs(out - ref)] + [(p.grad - g).abs().max().item()
+                                       for p, g in zip(id_classifiers.parameters(), ref_grads)])
+
+    t_loop = timeit(lambda: step(loop_loss), opt.iters, device)
+    t_packed = timeit(lambda: step(packed_loss), opt.iters, device)
+
+    print('{:>10s} {:>12s} {:>8s} {:>10s}'.format('loop(ms)', 'packed(ms)', 'speedup', 'max_diff'))
+    print('{:>10.3f} {:>12.3f} {:>7.2f}x {:>10.2e}'.format(t_loop, t_packed, t_loop / t_packed, max_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cfg',
+                        type=str,
+                        default='cfg/yolov4-paspp-mcmot.cfg',
+                        help='*.cfg path(number of object classes)')
+    parser.add_argument('--max-id-dict',
+                        type=str,
+                        default='/mnt/diskb/even/dataset/MCMOT/max_id_dict.npz',
+                        help='max_id_dict.npz path, if not exists: --n-ids track ids for each class')
+    parser.add_argument('--n-ids',
+                        type=int,
+                        default=2000,
+                        help='number of track ids of each class without max_id_dict')
+    parser.add_argument('--n-gt',
+                        type=int,
+                        default=512,
+                        help='number of GT objects of a batch(of one yolo layer)')
+    parser.add_argument('--dim',
+                        type=int,
+                        default=128,
+                        help='reid feature vector dimension')
+    parser.add_argument('--fc',
+                        type=str,
+                        default='Arc',
+                        help='FC layer type: FC or Arc')
+    parser.add_argument('--loss',
+                        type=str,
+                        default='ce',
+                        help='reid loss: ce(packed_id_loss) or ghmc(packed_ghmc_loss)')
+    parser.add_argument('--device',
+                        type=str,
+                        default='cpu',
+                        help='cpu or cuda:0...')
+    parser.add_argument('--iters',
+                        type=int,
+                        default=50,
+                        help='timing iterations')
+
+    opt = parser.parse_args()
+    run(opt)
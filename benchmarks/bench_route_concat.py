@@ -0,0 +1,107 @@
+# encoding=utf-8
+"""
+Numerical check and micro-benchmark of the planned route concatenation:
+Darknet forward with torch.cat routes vs. routes written into pre-allocated concat buffers
+(Darknet.plan_concat), with random weights, for a list of cfg files.
+
+usage: python3 ./benchmarks/bench_route_concat.py --cfgs cfg/yolov4-tiny.cfg cfg/yolov4-pacsp.cfg --device cpu
+"""
+import sys
+
+sys.path.append('.')
+import argparse
+import time
+
+import torch
+
+from models import Darknet
+
+
+def timeit(func, n_iters):
+    """
+    :param func:
+    :param n_iters:
+    :return: ms per call
+    """
+    func()  # warm up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t1 = time.perf_counter()
+    for _ in range(n_iters):
+        func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t2 = time.perf_counter()
+    return (t2 - t1) * 1000.0 / n_iters
+
+
+def run(opt):
+    """
+    :param opt:
+    :return:
+    """
+    device = torch.device(opt.device)
+    torch.manual_seed(0)
+
+    results = []
+    for cfg in opt.cfgs:
+        model = Darknet(cfg, (opt.net_h, opt.net_w), mode='detect').to(device).eval()
+        x = torch.rand(opt.batch_size, 3, opt.net_h, opt.net_w, device=device)
+
+        with torch.no_grad():
+            model.plan_concat(False)
+            ref, ref_p = model(x)
+            t_cat = timeit(lambda: model(x), opt.iters)
+
+            model.plan_concat(True)
+            n_routes = sum(route is not None for route in model.concat_plan['routes'])
+            n_writers = sum(writer is not None for writer in model.concat_plan['writers'])
+            out, out_p = model(x)
+            t_planned = timeit(lambda: model(x), opt.iters)
+
+        max_diff = max([(out - ref).abs().max().item()] +
+                       [(o - r).abs().max().item() for o, r in zip(out_p, ref_p)])
+        results.append((cfg, n_routes, n_writers, t_cat, t_planned, max_diff))
+
+    print('{:>32s} {:>7s} {:>8s} {:>10s} {:>12s} {:>10s}'
+          .format('cfg', 'routes', 'writers', 'cat(ms)', 'planned(ms)', 'max_diff'))
+    for cfg, n_routes, n_writers, t_cat, t_planned, max_diff in results:
+        print('{:>32s} {:>7d} {:>8d} {:>10.2f} {:>12.2f} {:>10.2e}'
+              .format(cfg.split('/')[-1], n_routes, n_writers, t_cat, t_planned, max_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cfgs',
+                        nargs='+',
+                        type=str,
+                        default=['cfg/yolov4-tiny.cfg',
+                                 'cfg/yolov4-pacsp.cfg',
+                                 'cfg/yolov4-pacsp-s.cfg',
+                                 'cfg/yolov4-pacsp-mish.cfg',
+                                 'cfg/yolov4-paspp-mcmot.cfg'],
+                        help='cfg files to check')
+    parser.add_argument('--net_w',
+                        type=int,
+                        default=768,
+                        help='net input width')
+    parser.add_argument('--net_h',
+                        type=int,
+                        default=448,
+                        help='net input height')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=1,
+                        help='batch size')
+    parser.add_argument('--device',
+                        type=str,
+                        default='cpu',
+                        help='cpu or cuda:0...')
+    parser.add_argument('--iters',
+                        type=int,
+                        default=10,
+                        help='timing iterations for each cfg')
+
+    opt = parser.parse_args()
+    run(opt)
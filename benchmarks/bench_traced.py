@@ -0,0 +1,102 @@
+# encoding=utf-8
+"""
+Per-frame latency of the eager Darknet forward vs. the traced(TorchScript) inference module,
+with random weights, on the same net input; also reports the max abs difference of the outputs.
+
+usage: python3 ./benchmarks/bench_traced.py --cfg cfg/yolov4-paspp-mcmot.cfg --net_w 768 --net_h 448 --device cpu
+"""
+import sys
+
+sys.path.append('.')
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from models import Darknet, save_traced, load_traced
+
+
+def timeit(func, n_iters):
+    """
+    :param func:
+    :param n_iters:
+    :return: ms per call
+    """
+    func()  # warm up
+    func()
+    t1 = time.perf_counter()
+    for _ in range(n_iters):
+        func()
+    t2 = time.perf_counter()
+    return (t2 - t1) * 1000.0 / n_iters
+
+
+def run(opt):
+    """
+    :param opt:
+    :return:
+    """
+    torch.manual_seed(0)
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    model = Darknet(cfg=opt.cfg,
+                    img_size=(opt.net_h, opt.net_w),
+                    feat_out_ids=opt.feat_out_ids,
+                    mode='track').to(opt.device).eval()
+    x = torch.rand(1, 3, opt.net_h, opt.net_w, device=opt.device)
+
+    # the eager model is fused by save_traced too: both run the same fused weights
+    path = os.path.join(tempfile.mkdtemp(), 'model.torchscript')
+    save_traced(model, (opt.net_h, opt.net_w), path, opt.device)
+    traced = load_traced(path, opt.device, (opt.net_h, opt.net_w))
+
+    with torch.no_grad():
+        ref = model(x)
+        out = traced(x)
+        max_diff = max((ref[0] - out[0]).abs().max().item(),
+                       max((r - o).abs().max().item() for r, o in zip(ref[2], out[2])))
+
+        t_eager = timeit(lambda: model(x), opt.iters)
+        t_traced = timeit(lambda: traced(x), opt.iters)
+
+    print('{:>12s} {:>12s} {:>8s} {:>10s}'.format('eager(ms)', 'traced(ms)', 'speedup', 'max_diff'))
+    print('{:>12.2f} {:>12.2f} {:>7.2f}x {:>10.2e}'.format(t_eager, t_traced, t_eager / t_traced, max_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cfg',
+                        type=str,
+                        default='cfg/yolov4-paspp-mcmot.cfg',
+                        help='*.cfg path')
+    parser.add_argument('--feat-out-ids',
+                        type=str,
+                        default='-1',
+                        help='reid feature map output layer ids.')
+    parser.add_argument('--net_w',
+                        type=int,
+                        default=768,
+                        help='net input width')
+    parser.add_argument('--net_h',
+                        type=int,
+                        default=448,
+                        help='net input height')
+    parser.add_argument('--device',
+                        type=str,
+                        default='cpu',
+                        help='cpu or cuda:0...')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=0,
+                        help='number of cpu threads(0: torch default)')
+    parser.add_argument('--iters',
+                        type=int,
+                        default=20,
+                        help='timing iterations')
+
+    opt = parser.parse_args()
+    run(opt)
@@ -13,7 +13,9 @@ from tracker.multitracker import JDETracker, MCJDETracker
 from tracking_utils import visualization as vis
 from tracking_utils.io import write_results_dict
 from utils.datasets import *
+from utils.pipeline import Pipeline, PipelineStage
 from utils.utils import *
+from utils.video_sink import VideoSink
 
 
 def format_output(dets, w, h):
@@ -39,6 +41,29 @@ def format_output(dets, w, h):
     return out_list
 
 
+def load_video(opt, video_path, hold=1):
+    """
+    :param opt:
+    :param video_path:
+    :param hold: number of returned frames still used by the caller(for the prefetch loader)
+    :return: the video's frame loader
+    """
+    dataset = LoadImages(video_path,
+                         opt.img_proc_method,
+                         net_w=opt.net_w,
+                         net_h=opt.net_h,
+                         stride=opt.interval,  # skip frames at demux level
+                         seek_stride=opt.seek_stride)
+
+    if opt.prefetch > 0:  # decode and pre-process frames ahead on a worker thread
+        dataset = PrefetchLoader(dataset,
+                                 prefetch=opt.prefetch,
+                                 pin_memory=opt.pin_memory,
+                                 hold=hold)
+
+    return dataset
+
+
 def run_detection(opt):
     """
     :param opt:
@@ -158,7 +183,7 @@ def run_detection(opt):
                 tracker.reset()
 
             # set dataset
-            dataset = LoadImages(video_path, opt.img_proc_method, net_w=opt.net_w, net_h=opt.net_h)
+            dataset = load_video(opt, video_path)
 
             # set txt results path
             src_name = os.path.split(video_path)[-1]
@@ -167,9 +192,12 @@ def run_detection(opt):
             # set sampled frame count
             fr_cnt = 0
 
-            # reset(clear) frame directory: write opt.save_img_dir
-            shutil.rmtree(frame_dir)
-            os.makedirs(frame_dir)
+            # stream the visualized frames to the output video
+            result_video_path = opt.save_img_dir + '/' + name + '_detect' + '_fps' + str(out_fps) + '.' + suffix
+            video_sink = VideoSink(result_video_path,
+                                   out_fps,
+                                   backend=opt.video_backend,
+                                   queue_size=opt.sink_queue_size)
 
             # iterate tracking results of each frame
             for fr_id, (path, img, img0, vid_cap) in enumerate(dataset):
@@ -196,37 +224,28 @@ def run_detection(opt):
                                                      id2cls=id2cls)
 
                     if opt.save_img_dir is not None:
-                        save_img_path = os.path.join(frame_dir, '{:05d}.jpg'.format(fr_id))
-                        cv2.imwrite(save_img_path, online_im)
-                        print('{:s} saved.'.format(save_img_path))
+                        video_sink.write(online_im)
 
                 else:  # interval > 1
-                    if fr_id % opt.interval == 0:  # skip some frames
-
-                        # ---------- update detection result of this frame
-                        dets = tracker.update_detection(img, img0)
-                        # ----------
+                    # ---------- update detection result of this frame
+                    dets = tracker.update_detection(img, img0)
+                    # ----------
 
-                        if opt.show_image:
-                            online_im = vis.plot_detects(img=img0,
-                                                         dets=dets,
-                                                         num_classes=opt.num_classes,
-                                                         frame_id=fr_cnt,
-                                                         id2cls=id2cls)
+                    if opt.show_image:
+                        online_im = vis.plot_detects(img=img0,
+                                                     dets=dets,
+                                                     num_classes=opt.num_classes,
+                                                     frame_id=fr_cnt,
+                                                     id2cls=id2cls)
 
-                        if opt.save_img_dir is not None:
-                            save_img_path = os.path.join(frame_dir, '{:05d}.jpg'.format(fr_cnt))
-                            cv2.imwrite(save_img_path, online_im)
-                            print('{:s} saved.'.format(save_img_path))
+                    if opt.save_img_dir is not None:
+                        video_sink.write(online_im)
 
-                        # update sampled frame count
-                        fr_cnt += 1
+                    # update sampled frame count
+                    fr_cnt += 1
 
-            # output tracking result as video: read and write opt.save_img_dir
-            result_video_path = opt.save_img_dir + '/' + name + '_detect' + '_fps' + str(out_fps) + '.' + suffix
-            cmd_str = 'ffmpeg -f image2 -r {:d} -i {}/%05d.jpg -b 5000k -c:v mpeg4 {}' \
-                .format(out_fps, frame_dir, result_video_path)
-            os.system(cmd_str)
+            # flush and close the output video
+            video_sink.close()
 
 
 def track_videos_txt(opt):
@@ -273,7 +292,7 @@ def track_videos_txt(opt):
             tracker.reset()
 
         # set dataset
-        dataset = LoadImages(video_path, opt.img_proc_method, net_w=opt.net_w, net_h=opt.net_h)
+        dataset = load_video(opt, video_path)
 
         # set txt results path
         src_name = os.path.split(video_path)[-1]
@@ -320,30 +339,29 @@ def track_videos_txt(opt):
                 for cls_id in range(opt.num_classes):
                     res_dict[cls_id].append((fr_id + 1, online_tlwhs_dict[cls_id], online_ids_dict[cls_id]))
             else:
-                if fr_id % opt.interval == 0:  # skip some frames
-                    online_targets_dict = tracker.update_track_fair(img, img0)
+                online_targets_dict = tracker.update_track_fair(img, img0)
 
-                    if online_targets_dict is None:
-                        print('[Warning]: Skip frame {:d}.'.format(fr_cnt))
-                        continue
+                if online_targets_dict is None:
+                    print('[Warning]: Skip frame {:d}.'.format(fr_cnt))
+                    continue
 
-                    # aggregate current frame's results for each object class
-                    online_tlwhs_dict = defaultdict(list)
-                    online_ids_dict = defaultdict(list)
+                # aggregate current frame's results for each object class
+                online_tlwhs_dict = defaultdict(list)
+                online_ids_dict = defaultdict(list)
 
-                    # iterate each object class
-                    for cls_id in range(opt.num_classes):  # process each object class
-                        online_targets = online_targets_dict[cls_id]
-                        for track in online_targets:
-                            online_tlwhs_dict[cls_id].append(track.tlwh)
-                            online_ids_dict[cls_id].append(track.track_id)
+                # iterate each object class
+                for cls_id in range(opt.num_classes):  # process each object class
+                    online_targets = online_targets_dict[cls_id]
+                    for track in online_targets:
+                        online_tlwhs_dict[cls_id].append(track.tlwh)
+                        online_ids_dict[cls_id].append(track.track_id)
 
-                    # collect result
-                    for cls_id in range(opt.num_classes):
-                        res_dict[cls_id].append((fr_cnt + 1, online_tlwhs_dict[cls_id], online_ids_dict[cls_id]))
+                # collect result
+                for cls_id in range(opt.num_classes):
+                    res_dict[cls_id].append((fr_cnt + 1, online_tlwhs_dict[cls_id], online_ids_dict[cls_id]))
 
-                    # update sampled frame count
-                    fr_cnt += 1
+                # update sampled frame count
+                fr_cnt += 1
 
         if opt.interval == 1:
             print('Total {:d} frames.'.format(fr_id + 1))
@@ -354,6 +372,110 @@ def track_videos_txt(opt):
         write_results_dict(result_f_name, res_dict, data_type)  # write txt to opt.save_img_dir
 
 
+def track_video_pipelined(opt, tracker, dataset, video_sink, id2cls):
+    """
+    Track one video with the decode, inference, tracking, rendering and writing stages
+    running concurrently on their own threads(connected by bounded queues, frame order kept)
+    :param opt:
+    :param tracker: MCJDETracker
+    :param dataset: LoadImages of the video
+    :param video_sink: VideoSink of the output video
+    :param id2cls:
+    :return: number of frames written
+    """
+
+    def decode():
+        """
+        Decode and pre-process the sampled frames
+        """
+        for fr_id, (path, img, img0, vid_cap) in enumerate(dataset):  # sampled frames only
+            yield fr_id, torch.from_numpy(img), img0
+
+    def infer(item):
+        """
+        Detection and reid feature extraction
+        """
+        fr_cnt, img, img0 = item
+
+        img = img.to(opt.device)
+        img = img.float()  # uint8 to fp32
+        img /= 255.0  # 0 - 255 to 0.0 - 1.0
+        if img.ndimension() == 3:
+            img = img.unsqueeze(0)
+
+        if opt.name == "fair":
+            dets = tracker.infer_dets_feats(img, img0)
+        else:  # byte
+            dets = tracker.infer_dets_feats_dicts(img, img0)
+
+        return fr_cnt, img0, dets
+
+    def track(item):
+        """
+        Update tracking result and aggregate current frame's results for each object class
+        """
+        fr_cnt, img0, dets = item
+
+        if opt.name == "fair":
+            online_targets_dict = tracker.track_fair(dets)
+        else:  # byte
+            online_targets_dict = tracker.track_byte_emb(dets)
+
+        if online_targets_dict is None:
+            print('[Warning]: Skip frame {:d}.'.format(fr_cnt))
+            return None
+
+        online_tlwhs_dict = defaultdict(list)
+        online_ids_dict = defaultdict(list)
+        for cls_id in range(opt.num_classes):  # process each object class
+            online_targets = online_targets_dict[cls_id]
+            for track in online_targets:
+                online_tlwhs_dict[cls_id].append(track.tlwh)
+                online_ids_dict[cls_id].append(track.track_id)
+
+        return fr_cnt, img0, online_tlwhs_dict, online_ids_dict
+
+    def render(item):
+        """
+        Draw track/detection
+        """
+        fr_cnt, img0, online_tlwhs_dict, online_ids_dict = item
+
+        online_im = vis.plot_tracks(image=img0,
+                                    tlwhs_dict=online_tlwhs_dict,
+                                    obj_ids_dict=online_ids_dict,
+                                    num_classes=opt.num_classes,
+                                    frame_id=fr_cnt,
+                                    id2cls=id2cls)
+
+        return fr_cnt, online_im
+
+    out_cnt = [0]  # written frame count
+
+    def write(item):
+        """
+        Queue the rendered frame to the video encoder
+        """
+        fr_cnt, online_im = item
+
+        video_sink.write(online_im)
+        out_cnt[0] += 1
+
+        return item
+
+    stages = [PipelineStage('infer', infer),
+              PipelineStage('track', track)]
+    if opt.save_img_dir is not None:
+        stages += [PipelineStage('render', render),
+                   PipelineStage('write', write)]
+
+    pipeline = Pipeline(decode(), stages, queue_size=opt.queue_size)
+    pipeline.run()
+    pipeline.print_stats()
+
+    return out_cnt[0]
+
+
 def track_videos_vid(opt):
     """
     :param opt:
@@ -370,12 +492,8 @@ def track_videos_vid(opt):
     opt.device = device
 
     # set result output
-    frame_dir = opt.save_img_dir + '/tmp'
-    if not os.path.isdir(frame_dir):
-        os.makedirs(frame_dir)
-    else:
-        shutil.rmtree(frame_dir)
-        os.makedirs(frame_dir)
+    if not os.path.isdir(opt.save_img_dir):
+        os.makedirs(opt.save_img_dir)
 
     # class name to class id and class id to class name
     names = load_classes(opt.names)
@@ -394,7 +512,8 @@ def track_videos_vid(opt):
         "match_thresh": 0.8,  # 0.8
         "n_classes": 5,
         "track_buffer": 240,  # 30 | 60 | 90 | 120 | 150 | 180 | 210 | 240
-        "track_thresh": 0.5  # 0.5
+        "track_thresh": 0.5,  # 0.5
+        "joint_assoc": opt.joint_assoc
     }
     byte_args = edict(byte_args)
     tracker.backend = BYTETracker(byte_args, frame_rate=30)
@@ -414,7 +533,8 @@ def track_videos_vid(opt):
                 tracker.backend.reset()
 
         # set dataset
-        dataset = LoadImages(video_path, opt.img_proc_method, net_w=opt.net_w, net_h=opt.net_h)
+        # the pipeline holds up to queue_size + 2 frames between decoding and inference
+        dataset = load_video(opt, video_path, hold=opt.queue_size + 2 if opt.pipeline else 1)
 
         # get video name
         src_name = os.path.split(video_path)[-1]
@@ -423,59 +543,65 @@ def track_videos_vid(opt):
         # set sampled frame count
         fr_cnt = 0
 
-        # reset(clear) frame directory: write opt.save_img_dir
-        shutil.rmtree(frame_dir)
-        os.makedirs(frame_dir)
+        # stream the visualized frames to the output video
+        result_video_path = opt.save_img_dir + '/' + vid_name \
+                            + '_track' + '_fps' + str(out_fps) + "_" + opt.name + '.' + ext
+        print('Write mp4 in fps: {:d}'.format(out_fps))
+        video_sink = VideoSink(result_video_path,
+                               out_fps,
+                               backend=opt.video_backend,
+                               queue_size=opt.sink_queue_size)
 
         # iterate tracking results of each frame
-        for fr_id, (path, img, img0, vid_cap) in enumerate(dataset):
-            ## -----
-            # img0: original image data(read from opencv and HWC)
+        if opt.pipeline:
+            track_video_pipelined(opt, tracker, dataset, video_sink, id2cls)
+        else:
+            for fr_id, (path, img, img0, vid_cap) in enumerate(dataset):
+                ## -----
+                # img0: original image data(read from opencv and HWC)
 
-            img = torch.from_numpy(img).to(opt.device)
-            img = img.float()  # uint8 to fp32
-            img /= 255.0  # 0 - 255 to 0.0 - 1.0
-            if img.ndimension() == 3:
-                img = img.unsqueeze(0)
+                img = torch.from_numpy(img).to(opt.device)
+                img = img.float()  # uint8 to fp32
+                img /= 255.0  # 0 - 255 to 0.0 - 1.0
+                if img.ndimension() == 3:
+                    img = img.unsqueeze(0)
 
-            # Update tracking result of this frame
-            if opt.interval == 1:
-                if opt.name == "fair":
-                    # ----- Update tracking result of current frame
-                    online_targets_dict = tracker.update_track_fair(img, img0)
-                    # -----
+                # Update tracking result of this frame
+                if opt.interval == 1:
+                    if opt.name == "fair":
+                        # ----- Update tracking result of current frame
+                        online_targets_dict = tracker.update_track_fair(img, img0)
+                        # -----
 
-                elif opt.name == "byte":
-                    # ----- Using ByteTrack backend
-                    online_targets_dict = tracker.update_track_byte_emb(img, img0)
-                    # -----
+                    elif opt.name == "byte":
+                        # ----- Using ByteTrack backend
+                        online_targets_dict = tracker.update_track_byte_emb(img, img0)
+                        # -----
 
-                if online_targets_dict is None:
-                    print('[Warning]: Skip frame {:d}.'.format(fr_id))
-                    continue
+                    if online_targets_dict is None:
+                        print('[Warning]: Skip frame {:d}.'.format(fr_id))
+                        continue
 
-                # aggregate current frame's results for each object class
-                online_tlwhs_dict = defaultdict(list)
-                online_ids_dict = defaultdict(list)
-                for cls_id in range(opt.num_classes):  # process each object class
-                    online_targets = online_targets_dict[cls_id]
-                    for track in online_targets:
-                        online_tlwhs_dict[cls_id].append(track.tlwh)
-                        online_ids_dict[cls_id].append(track.track_id)
+                    # aggregate current frame's results for each object class
+                    online_tlwhs_dict = defaultdict(list)
+                    online_ids_dict = defaultdict(list)
+                    for cls_id in range(opt.num_classes):  # process each object class
+                        online_targets = online_targets_dict[cls_id]
+                        for track in online_targets:
+                            online_tlwhs_dict[cls_id].append(track.tlwh)
+                            online_ids_dict[cls_id].append(track.track_id)
 
-                # to draw track/detection
-                online_im = vis.plot_tracks(image=img0,
-                                            tlwhs_dict=online_tlwhs_dict,
-                                            obj_ids_dict=online_ids_dict,
-                                            num_classes=opt.num_classes,
-                                            frame_id=fr_id,
-                                            id2cls=id2cls)
+                    # to draw track/detection
+                    online_im = vis.plot_tracks(image=img0,
+                                                tlwhs_dict=online_tlwhs_dict,
+                                                obj_ids_dict=online_ids_dict,
+                                                num_classes=opt.num_classes,
+                                                frame_id=fr_id,
+                                                id2cls=id2cls)
 
-                if opt.save_img_dir is not None:
-                    save_path = os.path.join(frame_dir, '{:05d}.jpg'.format(fr_id))
-                    cv2.imwrite(save_path, online_im)
-            else:  # interval > 1
-                if fr_id % opt.interval == 0:  # skip some frames
+                    if opt.save_img_dir is not None:
+                        video_sink.write(online_im)
+                else:  # interval > 1
 
                     # ----- update tracking result of current frame
                     online_targets_dict = tracker.update_track_fair(img, img0)
@@ -505,20 +631,13 @@ def track_videos_vid(opt):
                                                 id2cls=id2cls)
 
                     if opt.save_img_dir is not None:
-                        save_path = os.path.join(frame_dir, '{:05d}.jpg'.format(fr_cnt))
-                        cv2.imwrite(save_path, online_im)  # write img to opt.save_img_dir
+                        video_sink.write(online_im)  # queue img to the video encoder
 
                     # update sampled frame count
                     fr_cnt += 1
 
-        # output tracking result as video: read and write opt.save_img_dir
-        print('Zip to mp4 in fps: {:d}'.format(out_fps))
-        result_video_path = opt.save_img_dir + '/' + vid_name \
-                            + '_track' + '_fps' + str(out_fps) + "_" + opt.name + '.' + ext
-        cmd_str = 'ffmpeg -f image2 -r {:d} -i {}/%05d.jpg -b 5000k -c:v mpeg4 {}' \
-            .format(out_fps, frame_dir, result_video_path)
-        print(cmd_str)
-        os.system(cmd_str)
+        # flush and close the output video
+        video_sink.close()
 
 
 class DemoRunner(object):
@@ -545,6 +664,9 @@ class DemoRunner(object):
                                  type=str,
                                  default='weights/mcmot_half_track_last_211014.weights',
                                  help='weights path')
+        self.parser.add_argument('--mmap-weights',
+                                 action='store_true',
+                                 help='memory-map the *.weights file(cpu parameters share the page cache).')
         # ----------
 
         # input file/folder, 0 for webcam
@@ -591,6 +713,38 @@ class DemoRunner(object):
                                  type=int,
                                  default=1,
                                  help='The interval frame of tracking, default no interval.')
+        self.parser.add_argument('--seek-stride',
+                                 type=int,
+                                 default=0,
+                                 help='seek instead of grabbing the skipped frames if interval >= seek-stride(0: never).')
+
+        # decode and pre-process frames ahead into pre-allocated buffers
+        self.parser.add_argument('--prefetch',
+                                 type=int,
+                                 default=0,
+                                 help='number of frames decoded ahead on a worker thread(0: no prefetching).')
+        self.parser.add_argument('--pin-memory',
+                                 action='store_true',
+                                 help='pre-allocate the prefetch buffers in pinned(page-locked) memory.')
+
+        # run decode, inference, tracking, rendering and writing concurrently
+        self.parser.add_argument('--pipeline',
+                                 action='store_true',
+                                 help='run the tracking stages on their own threads(pipelined).')
+        self.parser.add_argument('--queue-size',
+                                 type=int,
+                                 default=4,
+                                 help='max number of frames waiting between two pipeline stages.')
+
+        # output video encoding
+        self.parser.add_argument('--video-backend',
+                                 type=str,
+                                 default='ffmpeg',
+                                 help='output video encoder: ffmpeg(raw frames piped to stdin) or cv2')
+        self.parser.add_argument('--sink-queue-size',
+                                 type=int,
+                                 default=8,
+                                 help='max number of frames waiting to be encoded.')
 
         # standard output FPS
         self.parser.add_argument('--fps',
@@ -626,6 +780,9 @@ class DemoRunner(object):
                                  type=int,
                                  default=30,  # 30, 60, 90, 120, 150, 180...
                                  help='tracking buffer frames')
+        self.parser.add_argument('--joint-assoc',
+                                 action='store_true',
+                                 help='associate all object classes jointly: one assignment per matching round')
 
         # ---------- NMS parameters: 0.3, 0.6 or 0.2, 0.45
         self.parser.add_argument('--conf-thres',
@@ -667,6 +824,20 @@ class DemoRunner(object):
                                  default='Arc',  # Arc
                                  help='FC layer type: FC or Arc')
 
+        self.parser.add_argument('--planned-concat',
+                                 action='store_true',
+                                 help='write route inputs into pre-allocated concat buffers(no torch.cat per route).')
+        self.parser.add_argument('--sparse-decode',
+                                 action='store_true',
+                                 help='decode only the yolo cells whose objectness > conf-thres(sparse candidates).')
+        self.parser.add_argument('--precision',
+                                 type=str,
+                                 default='fp32',
+                                 help='net precision: fp32 or bf16(cpu), yolo decoding and nms stay in fp32.')
+        self.parser.add_argument('--memory-format',
+                                 type=str,
+                                 default='contiguous',
+                                 help='net memory format: contiguous(NCHW) or channels_last(NHWC).')
         self.parser.add_argument('--device',
                                  default='7',
                                  help='device id (i.e. 0 or 0,1) or cpu')
@@ -0,0 +1,133 @@
+# encoding=utf-8
+"""
+Export a self-contained, conv + bn fused inference artifact for the trackers:
+the artifact is loaded directly(pass it as --weights to demo.py),
+without parsing the cfg, creating the modules or fusing at each start.
+--format fused: the pickled fused Darknet model(*.pt)
+--format torchscript: a traced static graph of a fixed net input size(*.torchscript)
+--format onnx: raw yolo outputs and reid feature maps as named outputs(*.onnx), run by OnnxDarknet
+
+usage: python3 export.py --cfg cfg/yolov4-paspp-mcmot.cfg --weights weights/track_last.weights --output weights/track_last_fused.pt
+python3 export.py --format torchscript --net_w 768 --net_h 448 --output weights/track_last.torchscript
+python3 export.py --format onnx --net_w 768 --net_h 448 --output weights/track_last.onnx
+"""
+import argparse
+import os
+
+from models import *
+
+
+def export(opt):
+    """
+    :param opt:
+    :return:
+    """
+    device = torch_utils.select_device(device=opt.device)
+
+    # ----- read max_id_dict(number of track ids of each object class)
+    max_id_dict = None
+    if opt.task == 'track':
+        if not os.path.isfile(opt.max_id_dict):
+            print('[Err]: max_id_dict file {} not exists.'.format(opt.max_id_dict))
+            return
+        load_dict = np.load(opt.max_id_dict, allow_pickle=True)
+        max_id_dict = load_dict['max_id_dict'][()]
+        print(max_id_dict)
+
+    model = Darknet(cfg=opt.cfg,
+                    img_size=opt.img_size,
+                    verbose=False,
+                    max_id_dict=max_id_dict,
+                    emb_dim=opt.dim,
+                    fc=opt.fc,
+                    feat_out_ids=opt.feat_out_ids,
+                    mode=opt.task).to(device)
+
+    # ----- load weights
+    if opt.weights.endswith('.pt'):  # py-torch format
+        ckpt = load_checkpoint(opt.weights, device)
+        model.load_state_dict(ckpt['model'])
+        if 'epoch' in ckpt.keys():
+            print('Checkpoint of epoch {} loaded.'.format(ckpt['epoch']))
+    else:  # dark-net format
+        load_darknet_weights(model, opt.weights, int(opt.cutoff))
+        print('{} loaded.'.format(opt.weights))
+
+    # ----- fuse conv + bn and save
+    if opt.format == 'fused':
+        save_fused(model, opt.output)
+    elif opt.format == 'torchscript':
+        save_traced(model, (opt.net_h, opt.net_w), opt.output, device)
+    elif opt.format == 'onnx':
+        save_onnx(model, (opt.net_h, opt.net_w), opt.output, opt.opset)
+    else:
+        print('[Err]: un-recognized export format {}.'.format(opt.format))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cfg',
+                        type=str,
+                        default='cfg/yolov4-paspp-mcmot.cfg',
+                        help='*.cfg path')
+    parser.add_argument('--weights',
+                        type=str,
+                        default='weights/mcmot_half_track_last_211014.weights',
+                        help='weights path(*.weights or *.pt)')
+    parser.add_argument('--output',
+                        type=str,
+                        default='weights/mcmot_fused.pt',
+                        help='fused artifact path')
+    parser.add_argument('--format',
+                        type=str,
+                        default='fused',
+                        help='fused(pickled fused model, *.pt), torchscript(traced, *.torchscript) or onnx(*.onnx)')
+    parser.add_argument('--opset',
+                        type=int,
+                        default=11,
+                        help='ONNX opset version')
+    parser.add_argument('--net_w',
+                        type=int,
+                        default=768,
+                        help='net input width of the traced model')
+    parser.add_argument('--net_h',
+                        type=int,
+                        default=448,
+                        help='net input height of the traced model')
+    parser.add_argument('--max-id-dict',
+                        type=str,
+                        default='/mnt/diskb/even/dataset/MCMOT/max_id_dict.npz',
+                        help='max_id_dict.npz path(track task)')
+    parser.add_argument('--task',
+                        type=str,
+                        default='track',  # track or detect
+                        help='task mode: track or detect')
+    parser.add_argument('--img-size',
+                        type=int,
+                        default=768,
+                        help='Image size')
+    parser.add_argument('--cutoff',
+                        type=int,
+                        default=0,
+                        help='cutoff layer index, 0 means all layers loaded.')
+    parser.add_argument('--feat-out-ids',
+                        type=str,
+                        default='-1',
+                        help='reid feature map output layer ids.')
+    parser.add_argument('--dim',
+                        type=int,
+                        default=128,
+                        help='reid feature map output embedding dimension')
+    parser.add_argument('--fc',
+                        type=str,
+                        default='Arc',
+                        help='FC layer type: FC or Arc')
+    parser.add_argument('--device',
+                        default='cpu',
+                        help='device id (i.e. 0 or 0,1) or cpu')
+
+    opt = parser.parse_args()
+    print(opt)
+
+    export(opt)
@@ -1,11 +1,36 @@
 # encoding=utf-8
 
+import inspect
+import json
+import pickletools
+import zipfile
+from collections import OrderedDict
+
+from torch.utils.checkpoint import checkpoint
+
 import utils.torch_utils as torch_utils
 from utils.google_utils import *
 from utils.layers import *
 from utils.parse_config import *
 
 ONNX_EXPORT = False
+FLAT_MAGIC = b'DKFLAT01'  # flat(memory-mappable) weights file magic
+
+# ----- layers reading the recorded outputs of previous layers: forward(x, outputs)
+USE_OUTPUT_LAYERS = ['WeightedFeatureFusion',  # Shortcut(add)
+                     'FeatureConcat',  # Route(concatenate)
+                     'FeatureConcat_l',
+                     'RouteGroup',
+                     'ScaleChannel',
+                     'ScaleChannels',  # my own implemention
+                     'SAM']
+
+# ----- numpy globals(data reconstructors only) allowed in the training checkpoints loaded with weights_only
+NUMPY_SAFE_GLOBALS = [np.core.multiarray.scalar, np.core.multiarray._reconstruct, np.ndarray, np.dtype] \
+                     + [type(np.dtype(t)) for t in (np.float32, np.float64, np.int64, np.int32, np.bool_)]
+
+# ----- non-reentrant checkpoint(torch >= 1.11): the segment inputs need not require grad
+CHECKPOINT_NON_REENTRANT = 'use_reentrant' in inspect.signature(checkpoint).parameters
 
 
 # Parse cfg file, create every layer
@@ -71,9 +96,9 @@ def create_modules(module_defs, img_size, cfg, id_classifiers=None):
             elif mdef['activation'] == 'logistic':  # Add logistic activation support
                 modules.add_module('activation', nn.Sigmoid())
             elif mdef['activation'] == 'swish':
-                modules.add_module('activation', Swish())
+                modules.add_module('activation', Swish(inplace=True))
             elif mdef['activation'] == 'mish':
-                modules.add_module('activation', Mish())
+                modules.add_module('activation', Mish() if MISH_CUDA else Mish(inplace=True))
 
         # To parse deconvolution for learnable up-sampling
         elif mdef['type'] == 'deconvolutional':
@@ -108,9 +133,9 @@ def create_modules(module_defs, img_size, cfg, id_classifiers=None):
             elif mdef['activation'] == 'logistic':  # Add logistic activation support
                 modules.add_module('activation', nn.Sigmoid())
             elif mdef['activation'] == 'swish':
-                modules.add_module('activation', Swish())
+                modules.add_module('activation', Swish(inplace=True))
             elif mdef['activation'] == 'mish':
-                modules.add_module('activation', Mish())
+                modules.add_module('activation', Mish() if MISH_CUDA else Mish(inplace=True))
 
         elif mdef['type'] == 'BatchNorm2d':
             filters = output_filters[-1]
@@ -185,7 +210,8 @@ def create_modules(module_defs, img_size, cfg, id_classifiers=None):
                 modules = RouteGroup(layers, groups, group_id)
                 filters //= groups
             else:
-                modules = FeatureConcat(layers=layers)
+                modules = FeatureConcat(layers=layers,
+                                        channels=[output_filters[l + 1 if l > 0 else l] for l in layers])
 
         elif mdef['type'] == 'route_lhalf':  # nn.Sequential() placeholder for 'route' layer
             layers = mdef['layers']
@@ -369,6 +395,30 @@ class YOLOLayer(nn.Module):
             # return io, pred
             return io, pred
 
+    def forward_sparse(self, pred, logit_thres):
+        """
+        Inference decoding of the cells(anchors) whose objectness logit > logit_thres only
+        :param pred: B×(na·no)×ny×nx raw output of the yolo layer's conv
+        :param logit_thres: objectness logit threshold: logit(conf_thres)
+        :return: n×(2 + no) candidates: image index, yolo layer index, x, y, w, h, obj, cls scores
+        """
+        bs, _, ny, nx = pred.shape  # bs, 255, 13, 13
+        if (self.nx, self.ny) != (nx, ny):
+            self.create_grids(ng=(nx, ny), device=pred.device)
+
+        # ----- threshold the raw objectness logits and gather the surviving cells: n×no
+        pred = pred.view(bs, self.na, self.no, ny, nx)
+        b, a, gy, gx = (pred[:, :, 4] > logit_thres).nonzero(as_tuple=True)
+        p = pred[b, a, :, gy, gx]
+
+        # ----- decode the surviving cells only
+        xy = (torch.sigmoid(p[:, :2]) + torch.stack((gx, gy), 1).to(p.dtype)) * self.stride  # xy
+        wh = torch.exp(p[:, 2:4]) * self.anchor_vec[a].to(p.dtype) * self.stride  # wh YOLO method
+        conf = torch.sigmoid(p[:, 4:])  # confidence score and cls pred
+        inds = torch.stack((b, torch.full_like(b, self.index)), 1).to(p.dtype)
+
+        return torch.cat((inds, xy, wh, conf), 1)
+
 
 class Darknet(nn.Module):
     # YOLOv3/v4 object detection model
@@ -427,10 +477,37 @@ class Darknet(nn.Module):
                 elif self.fc_type == 'Arc':
                     self.id_classifiers.append(ArcMargin(self.emb_dim, nID, device='cuda:0', m=0.1))
 
+                ## choice 3: sampled(partial) classifier, weights offloaded to cpu: PartialFC or PartialArc
+                elif self.fc_type in ('PartialFC', 'PartialArc'):
+                    self.id_classifiers.append(PartialFC(self.emb_dim, nID, margin=self.fc_type == 'PartialArc', m=0.1))
+
             # add reid classifiers(nn.ModuleList) to self.module_list to be registered
             self.module_list.append(self.id_classifiers)
 
         self.yolo_layer_inds = get_yolo_layers(self)
+
+        # ----- stacked anchor vectors and grid gains for building targets, see get_target_tables
+        self.target_tables = {}  # key: (device, grid sizes of the yolo layers)
+
+        # ----- layer outputs to be freed after each layer in forward_once
+        self.free_plan = get_free_plan(self.module_list, self.feat_out_ids)
+
+        # ----- planned(pre-allocated) route concatenation: off by default, see plan_concat
+        self.concat_plan = None
+        self.concat_bufs = {}  # key: route layer id, reused while the batch shape, dtype and device are unchanged
+
+        # ----- activation(gradient) checkpointing segments for training: off by default, see checkpoint_segments
+        self.checkpoint_plan = None
+
+        # ----- sparse yolo decoding(objectness logit threshold): off by default, see sparse_decode
+        self.sparse_logit_thres = None
+
+        # ----- output the raw yolo layer outputs(B×(na·no)×ny×nx) in inference: for exporting, see save_onnx
+        self.raw_yolo_out = False
+
+        # ----- inference dtype and memory format of the net: fp32 NCHW by default, see set_precision
+        self.infer_dtype = None
+        self.memory_format = None
         # torch_utils.initialize_weights(self)
 
         # Darknet Header https://github.com/AlexeyAB/darknet/issues/2914#issuecomment-496675346
@@ -483,6 +560,11 @@ class Darknet(nn.Module):
         """
         img_size = x.shape[-2:]  # height, width
         yolo_out, out, reid_feat_out = [], [], []  # 3(or 2) yolo laers correspond to 3(or 2) reid feature map layers
+
+        # ----- bf16 and(or) channels_last net: convert the input once, cast the yolo inputs and reid maps back
+        cast = self.infer_dtype is not None or self.memory_format is not None
+        if cast:
+            x = x.to(dtype=self.infer_dtype or x.dtype, memory_format=self.memory_format or torch.preserve_format)
         if verbose:
             print('0', x.shape)
             str = ''
@@ -496,28 +578,50 @@ class Darknet(nn.Module):
                            torch_utils.scale_img(x, s[1]),  # scale
                            ), 0)
 
+        # ----- sparse decoding: only the yolo cells above the objectness threshold are decoded(inference only)
+        sparse = self.sparse_logit_thres is not None and not self.training and not ONNX_EXPORT and not augment
+
+        # ----- planned concat: route inputs are written into pre-allocated concat buffers(inference only)
+        planned = self.concat_plan is not None and not torch.is_grad_enabled()
+
+        # ----- activation checkpointing: the layers of each segment are recomputed in backward(training only)
+        checkpointed = self.checkpoint_plan is not None and self.training and torch.is_grad_enabled()
+        seg_end = 0  # end(exclusive) of the current checkpoint segment
+
         # ---------- traverse the network(by traversing the module_list)
-        use_output_layers = ['WeightedFeatureFusion',  # Shortcut(add)
-                             'FeatureConcat',  # Route(concatenate)
-                             'FeatureConcat_l',
-                             'RouteGroup',
-                             'ScaleChannel',
-                             'ScaleChannels',  # my own implemention
-                             'SAM']
-
-        # ----- traverse forward
         for i, module in enumerate(self.module_list):
+            if i < seg_end:  # computed by its checkpoint segment
+                continue
+            if checkpointed and self.checkpoint_plan['ends'][i] is not None:
+                seg_end = self.checkpoint_plan['ends'][i]
+                x = self.forward_checkpoint(i, seg_end, x, out, yolo_out)
+                continue
+
             name = module.__class__.__name__
-            if name in use_output_layers:  # sum, concat
+            if name in USE_OUTPUT_LAYERS:  # sum, concat
                 if verbose:
                     l = [i - 1] + module.layers  # layers
                     sh = [list(x.shape)] + [list(out[i].shape) for i in module.layers]  # shapes
                     str = ' >> ' + ' + '.join(['layer %g %s' % x for x in zip(l, sh)])
 
-                x = module.forward(x, out)
+                if planned and self.concat_plan['routes'][i] is not None:
+                    # the route is a view of its buffer: only copy in the inputs not written in place
+                    x = self.concat_bufs[i]
+                    for j, c0, c1 in self.concat_plan['routes'][i]:
+                        x[:, c0:c1].copy_(out[j])
+                else:
+                    x = module.forward(x, out)
 
             elif name == 'YOLOLayer':  # x: current layer, out: previous layers output
-                yolo_out.append(module.forward(x, out))
+                if cast:  # yolo decoding in fp32 NCHW
+                    x = x.float().contiguous()
+
+                if self.raw_yolo_out and not self.training:
+                    yolo_out.append(x)
+                elif sparse:
+                    yolo_out.append(module.forward_sparse(x, self.sparse_logit_thres))
+                else:
+                    yolo_out.append(module.forward(x, out))
 
             elif name == 'ModuleList':  # last 5 layers of FC: reid classifiers
                 continue
@@ -525,10 +629,19 @@ class Darknet(nn.Module):
             # We need to process a shortcut layer combined with a activation layer
             # followed by a activation layer
             elif name == 'Sequential':
+                writer = self.concat_plan['writers'][i] if planned else None
                 for j, layer in enumerate(module):  # for debugging...
                     layer_name = layer.__class__.__name__
 
-                    if layer_name in use_output_layers:
+                    if writer is not None and j == len(module) - 1:
+                        # the last activation writes its output into the concat buffer slice
+                        route_i, c0, c1, c = writer
+                        buf = self.concat_bufs.get(route_i)
+                        shape = (x.shape[0], c, x.shape[2], x.shape[3])
+                        if buf is None or buf.shape != shape or buf.dtype != x.dtype or buf.device != x.device:
+                            buf = self.concat_bufs[route_i] = x.new_empty(shape)
+                        x = ACTIVATION_OUT[type(layer)](layer, x, buf[:, c0:c1])
+                    elif layer_name in USE_OUTPUT_LAYERS:
                         x = layer.forward(x, out)
                     else:
                         x = layer.forward(x)
@@ -539,6 +652,10 @@ class Darknet(nn.Module):
 
             # ----------- record previous output layers
             out.append(x if self.routs[i] else [])
+
+            # ----------- drop the outputs not used by the following layers
+            for j in self.free_plan[i]:
+                out[j] = []
             # out.append(x)  # for debugging...
             # f_debug.close()
 
@@ -560,16 +677,10 @@ class Darknet(nn.Module):
         # reid_feat_out.append(out[-1])  # the 3rd YOLO scale feature map
 
         for out_id in self.feat_out_ids:
-            reid_feat_out.append(out[out_id])
+            feat = out[out_id]  # [] if not recorded(not a rout layer, e.g. detect mode)
+            reid_feat_out.append(feat.float().contiguous() if cast and isinstance(feat, torch.Tensor) else feat)
 
-        # for converting... 3(or 2, or 1) YOLO output layers and 3 feature layers
-        # return out[36], out[43], out[50], out[-5], out[-3], out[-1]  # for yolov4-tiny-3l
-        # return out[69], out[79], out[-3], out[-1]  # for mbv2-2l
-        # return out[69], out[79], out[89], out[-5], out[-3], out[-1]  # for mbv2-3l 3 feat out
-        # return out[29], out[36], out[43], out[-1]  # for one layer feature map
-        # return out[32], out[39], out[46], out[-1]  # for one layer se
-        # return out[69], out[79], out[89], out[-1]  # # for mbv2-3l 1 feat out
-        # return out[138], out[149], out[160], out[-1]  # for half_3l 1 feat out
+        # for converting: save_onnx exports the raw YOLO outputs and the feat_out_ids feature maps of any cfg
 
         # ----- Output mode
         if self.training:  # train
@@ -580,9 +691,24 @@ class Darknet(nn.Module):
             else:
                 print('[Err]: unrecognized task mode.')
                 return None
+        elif self.raw_yolo_out:  # export: raw yolo layer outputs, decoded by the runtime's runner(OnnxDarknet)
+            return tuple(yolo_out) + tuple(reid_feat_out)
         elif ONNX_EXPORT:  # export
             x = [torch.cat(x, 0) for x in zip(*yolo_out)]
             return x[0], torch.cat(x[1:3], 1)  # scores, boxes: 3780x80, 3780x4
+        elif sparse:  # inference: one candidates tensor of all yolo layers
+            x = torch.cat(yolo_out, 0)
+
+            if self.mode == 'pure_detect' or self.mode == 'detect':
+                return x, None
+            elif self.mode == 'track':
+                if len(self.feat_out_ids) == 3:
+                    return x, None, reid_feat_out, x[:, 1:2].long()
+                elif len(self.feat_out_ids) == 1:
+                    return x, None, reid_feat_out
+            else:
+                print('[Err]: un-recognized mode, return None.')
+                return None
         else:  # inference or test
             x, p = zip(*yolo_out)  # inference output, training output
 
@@ -614,6 +740,138 @@ class Darknet(nn.Module):
                 print('[Err]: un-recognized mode, return None.')
                 return None
 
+    def plan_concat(self, enabled=True):
+        """
+        Planned-memory route concatenation for inference(under torch.no_grad()):
+        the layers concatenated by a route write their outputs directly into channel slices
+        of a pre-allocated concat buffer and the route returns the buffer without copying.
+        The buffers are kept and reused by the following forwards of the same input shape
+        :param enabled:
+        :return:
+        """
+        self.concat_plan = get_concat_plan(self.module_list, self.feat_out_ids) if enabled else None
+        self.concat_bufs = {}
+
+    def checkpoint_segments(self, n_segments=0):
+        """
+        Activation(gradient) checkpointing for training: the module list is partitioned into
+        about n_segments segments at route-safe boundaries(no route or shortcut input crosses a
+        boundary except the previous layer output x), see get_checkpoint_plan.
+        Each segment keeps only its outputs(x, its yolo outputs and reid feature maps) in forward,
+        its inner activations are recomputed in backward
+        :param n_segments: number of segments, 0: off
+        :return:
+        """
+        self.checkpoint_plan = get_checkpoint_plan(self.module_list, self.feat_out_ids, n_segments) \
+            if n_segments > 0 else None
+        if self.checkpoint_plan is not None:
+            starts = [i for i, end in enumerate(self.checkpoint_plan['ends']) if end is not None]
+            print('Checkpoint segments(start layer ids): ', starts)
+
+    def run_segment(self, start, end, x):
+        """
+        Runs the layers [start, end) of a checkpoint segment:
+        route-safe, the segment reads no recorded output but its input x(the output of layer start - 1)
+        :param start:
+        :param end:
+        :param x:
+        :return: tuple of the output x, the kept layer outputs and the yolo outputs of the segment
+        """
+        out = [[] for _ in range(start)]  # the recorded outputs: indexed by layer id
+        if start > 0:
+            out[-1] = x
+        yolo_out = []
+
+        for i in range(start, end):
+            module = self.module_list[i]
+            name = module.__class__.__name__
+            if name in USE_OUTPUT_LAYERS:
+                x = module.forward(x, out)
+            elif name == 'YOLOLayer':
+                yolo_out.append(module.forward(x, out))
+            elif name == 'Sequential':
+                for layer in module:
+                    x = layer.forward(x, out) if layer.__class__.__name__ in USE_OUTPUT_LAYERS else layer.forward(x)
+            else:
+                x = module.forward(x)
+
+            out.append(x if self.routs[i] else [])
+            for j in self.free_plan[i]:
+                out[j] = []
+
+        return tuple([x] + [out[j] for j in self.checkpoint_plan['keeps'][start]] + yolo_out)
+
+    def forward_checkpoint(self, start, end, x, out, yolo_out):
+        """
+        Runs the checkpoint segment [start, end) in forward_once
+        :param start:
+        :param end:
+        :param x: output of layer start - 1
+        :param out: recorded layer outputs of forward_once(the segment's are appended)
+        :param yolo_out: yolo outputs of forward_once(the segment's are appended)
+        :return: output x of the segment
+        """
+        last, keeps = self.checkpoint_plan['lasts'][start], self.checkpoint_plan['keeps'][start]
+        if CHECKPOINT_NON_REENTRANT:
+            seg_outs = checkpoint(self.run_segment, start, end, x, use_reentrant=False)
+        else:  # the reentrant checkpoint backwards only if an input requires grad: the net input of segment 0
+            seg_outs = checkpoint(self.run_segment, start, end, x if x.requires_grad else x.detach().requires_grad_())
+        x = seg_outs[0]
+
+        # ----- record the outputs of the segment
+        out.extend([[] for _ in range(start, end)])
+        for j, o in zip(keeps, seg_outs[1:]):
+            out[j] = o
+        for j in range(last, end):  # the trailing yolo layers do not change x
+            out[j] = x if self.routs[j] else []
+        yolo_out.extend(seg_outs[1 + len(keeps):])
+
+        # ----- drop the outputs last used by the segment
+        for i in range(start, end):
+            for j in self.free_plan[i]:
+                if j < start:
+                    out[j] = []
+
+        return x
+
+    def step_id_classifiers(self, lr):
+        """
+        Sparse update of the sampled(PartialFC) reid classifiers, after each optimizer step:
+        their weights are not held by the optimizer
+        :param lr:
+        :return:
+        """
+        for classifier in getattr(self, 'id_classifiers', []):
+            if isinstance(classifier, PartialFC):
+                classifier.step(lr)
+
+    def set_precision(self, precision='fp32', memory_format='contiguous'):
+        """
+        Converts the model once for inference: bf16 weights(precision='bf16') and(or)
+        channels_last(NHWC) layout(memory_format='channels_last'), mainly for cpu.
+        The net input is converted at the start of forward_once; the yolo layer inputs
+        and the reid feature maps are cast back to fp32 NCHW, so yolo decoding, NMS and
+        reid feature normalization run in fp32
+        :param precision: fp32 or bf16
+        :param memory_format: contiguous or channels_last
+        :return:
+        """
+        self.infer_dtype = torch.bfloat16 if precision == 'bf16' else None
+        self.memory_format = torch.channels_last if memory_format == 'channels_last' else None
+
+        self.to(self.infer_dtype or torch.float32, memory_format=self.memory_format or torch.contiguous_format)
+
+    def sparse_decode(self, conf_thres=None):
+        """
+        Sparse inference decoding of the yolo layers:
+        the raw objectness logits are thresholded by logit(conf_thres) first, then only the surviving
+        cells of all yolo layers are decoded into one n×(2 + no) candidates tensor
+        (see YOLOLayer.forward_sparse), to be consumed by non_max_suppression_sparse
+        :param conf_thres: objectness threshold, None: dense decoding
+        :return:
+        """
+        self.sparse_logit_thres = None if conf_thres is None else math.log(conf_thres / (1.0 - conf_thres))
+
     def fuse(self):
         """
         :return:
@@ -625,7 +883,7 @@ class Darknet(nn.Module):
         for ch_i, a in enumerate(children):
             if isinstance(a, nn.Sequential):
                 for i, b in enumerate(a):
-                    if isinstance(b, nn.modules.batchnorm.BatchNorm2d):
+                    if isinstance(b, nn.modules.batchnorm.BatchNorm2d) and isinstance(a[i - 1], nn.Conv2d):
                         # fuse this bn layer with the previous conv2d layer
                         conv = a[i - 1]
                         try:
@@ -646,15 +904,306 @@ class Darknet(nn.Module):
         torch_utils.model_info(self, verbose)
 
 
+class DarknetTrace(nn.Module):
+    # Inference wrapper of a Darknet model to be traced into one static graph
+    def __init__(self, model):
+        """
+        :param model: Darknet model in eval mode
+        """
+        super(DarknetTrace, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        """
+        :param x:
+        :return: tuple of decoded predictions(B×N×no), reid feature maps(track mode)
+        and yolo layer indices(track mode with 3 reid feature maps)
+        """
+        out = self.model.forward_once(x)
+        if self.model.mode != 'track':
+            return (out[0],)
+        return (out[0],) + tuple(out[2]) + tuple(out[3:])
+
+
+class TracedDarknet(nn.Module):
+    # Traced Darknet(TorchScript) with the eager Darknet's inference interface
+    def __init__(self, traced, feat_out_ids, mode, img_size=None):
+        """
+        :param traced: traced DarknetTrace(torch.jit.ScriptModule)
+        :param feat_out_ids: reid feature map layer ids
+        :param mode:
+        :param img_size: traced net input height, width(None: not checked)
+        """
+        super(TracedDarknet, self).__init__()
+        self.traced = traced
+        self.feat_out_ids = feat_out_ids
+        self.mode = mode
+        self.img_size = None if img_size is None else tuple(img_size)
+
+    def forward(self, x, augment=False, verbose=False):
+        """
+        :param x: net input of the traced size
+        :param augment: not supported
+        :param verbose:
+        :return: the same outputs as Darknet in inference mode, without the training outputs(None)
+        """
+        # the traced graph is fixed to one input size: other sizes fail deep in the graph or give wrong boxes
+        if self.img_size is not None and tuple(x.shape[2:]) != self.img_size:
+            raise ValueError('net input size(h, w) {} does not match the traced size {}'
+                             .format(tuple(x.shape[2:]), self.img_size))
+
+        out = self.traced(x)
+        if self.mode != 'track':
+            return out[0], None
+
+        n_feats = len(self.feat_out_ids)
+        reid_feat_out = list(out[1:1 + n_feats])
+        if n_feats == 3:
+            return out[0], None, reid_feat_out, out[-1]
+        return out[0], None, reid_feat_out
+
+    def plan_concat(self, enabled=True):
+        print('Warning: planned concat is not supported by the traced model.')
+
+    def sparse_decode(self, conf_thres=None):
+        print('Warning: sparse decoding is not supported by the traced model.')
+
+    def set_precision(self, precision='fp32', memory_format='contiguous'):
+        print('Warning: precision and memory format are fixed in the traced model.')
+
+
+class OnnxDarknet(nn.Module):
+    # ONNX runtime runner of a model exported by save_onnx with the eager Darknet's inference interface
+    def __init__(self, path, providers=('CPUExecutionProvider',)):
+        """
+        :param path: *.onnx file saved by save_onnx
+        :param providers: onnxruntime execution providers
+        """
+        super(OnnxDarknet, self).__init__()
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(path, providers=list(providers))
+        meta = json.loads(self.session.get_modelmeta().custom_metadata_map['darknet'])
+        self.feat_out_ids = meta['feat_out_ids']
+        self.mode = meta['mode']
+        self.n_reid = len(self.feat_out_ids) if self.mode == 'track' else 0
+        print('ONNX model {} loaded, net input size(h, w): {}'.format(path, meta['img_size']))
+
+        # the yolo layers decode the raw outputs
+        self.yolo_layers = nn.ModuleList([YOLOLayer(anchors=np.array(layer['anchors']),
+                                                    nc=layer['nc'],
+                                                    img_size=meta['img_size'],
+                                                    yolo_idx=i,
+                                                    layers=[],
+                                                    stride=layer['stride'])
+                                          for i, layer in enumerate(meta['yolo_layers'])])
+        self.sparse_logit_thres = None
+        self.eval()
+
+    def forward(self, x, augment=False, verbose=False):
+        """
+        :param x: net input
+        :param augment: not supported
+        :param verbose:
+        :return: the same outputs as Darknet in inference mode
+        """
+        outs = self.session.run(None, {'images': x.detach().cpu().numpy().astype(np.float32)})
+        outs = [torch.from_numpy(out).to(x.device) for out in outs]
+        raw, reid_feat_out = outs[:len(self.yolo_layers)], outs[len(self.yolo_layers):]
+
+        if self.sparse_logit_thres is not None:  # one candidates tensor of all yolo layers
+            x = torch.cat([m.forward_sparse(p, self.sparse_logit_thres) for m, p in zip(self.yolo_layers, raw)], 0)
+            p, yolo_inds = None, x[:, 1:2].long()
+        else:
+            x, p = zip(*[m.forward(pred, None) for m, pred in zip(self.yolo_layers, raw)])
+            yolo_inds = torch.cat([torch.full((io.size(0), io.size(1), 1), i, dtype=torch.long)
+                                   for i, io in enumerate(x)], 1)
+            x = torch.cat(x, 1)
+
+        if self.mode != 'track':
+            return x, p
+        if len(self.feat_out_ids) == 3:
+            return x, p, reid_feat_out, yolo_inds
+        return x, p, reid_feat_out
+
+    def plan_concat(self, enabled=True):
+        print('Warning: planned concat is not supported by the ONNX runner.')
+
+    def set_precision(self, precision='fp32', memory_format='contiguous'):
+        print('Warning: precision and memory format are fixed in the ONNX model.')
+
+    def sparse_decode(self, conf_thres=None):
+        """
+        :param conf_thres: objectness threshold, None: dense decoding
+        :return:
+        """
+        self.sparse_logit_thres = None if conf_thres is None else math.log(conf_thres / (1.0 - conf_thres))
+
+
 def get_yolo_layers(model):
     return [i for i, m in enumerate(model.module_list) if m.__class__.__name__ == 'YOLOLayer']  # [89, 101, 113]
 
 
-def load_darknet_weights(model, weights, cutoff=0):
+def get_last_use(module_list):
+    """
+    :param module_list:
+    :return: number of layers(without the reid classifiers),
+             the last consumer(route, shortcut, ... layer in USE_OUTPUT_LAYERS) id of each layer output
+             (itself if not consumed)
+    """
+    # the reid classifiers(ModuleList) do not record outputs
+    n_layers = len([m for m in module_list if m.__class__.__name__ != 'ModuleList'])
+
+    last_use = list(range(n_layers))
+    for i, module in enumerate(module_list[:n_layers]):
+        sub_modules = module if module.__class__.__name__ == 'Sequential' else [module]
+        for sub_module in sub_modules:
+            # only the layers reading the recorded outputs: a yolo layer's 'from' layers are read by ASFF only(off)
+            if sub_module.__class__.__name__ not in USE_OUTPUT_LAYERS:
+                continue
+            for l in sub_module.layers:
+                j = i + l if l < 0 else l
+                last_use[j] = max(last_use[j], i)
+
+    return n_layers, last_use
+
+
+def get_free_plan(module_list, feat_out_ids):
+    """
+    Liveness plan of the recorded layer outputs:
+    a layer output is freed right after its last consumer(route, shortcut, ... layer) is computed
+    :param module_list:
+    :param feat_out_ids: reid feature map layer ids(kept until the end of forward)
+    :return: list of layer ids to be freed after each layer
+    """
+    # ----- find the last consumer of each layer output(not consumed: freed right after being recorded)
+    n_layers, last_use = get_last_use(module_list)
+
+    # ----- reid feature map layers are used after the last layer
+    for out_id in feat_out_ids:
+        j = n_layers + out_id if out_id < 0 else out_id
+        last_use[j] = n_layers
+
+    free_plan = [[] for _ in range(len(module_list))]
+    for j, i in enumerate(last_use):
+        if i < n_layers:
+            free_plan[i].append(j)
+
+    return free_plan
+
+
+def get_checkpoint_plan(module_list, feat_out_ids, n_segments):
+    """
+    Checkpoint segments of the layers: a boundary before layer k is route-safe if no output of
+    the layers before k - 1 is consumed by layer k or later(only x, the output of layer k - 1, crosses it),
+    and layer k is neither a shortcut(which may modify its input in place) nor a yolo layer.
+    The boundaries are the route-safe ones nearest to the even split of the layers into n_segments.
+    :param module_list:
+    :param feat_out_ids: reid feature map layer ids(returned by the segments computing them)
+    :param n_segments:
+    :return: dict of
+             'ends': for each layer, the end(exclusive) layer id of the segment starting at it, or None
+             'lasts': for each segment start, the last layer id of the segment changing x(not a yolo layer)
+             'keeps': for each segment start, the reid feature map layer ids(besides the last) whose outputs
+                      the segment returns
+    """
+    n_layers, last_use = get_last_use(module_list)
+    feat_layers = [n_layers + out_id if out_id < 0 else out_id for out_id in feat_out_ids]
+
+    # ----- route-safe boundaries
+    max_use = np.maximum.accumulate(last_use)  # max_use[j]: last consumer of the outputs of layers 0...j
+    safe = []
+    for k in range(1, n_layers):
+        sub_modules = module_list[k] if module_list[k].__class__.__name__ == 'Sequential' else [module_list[k]]
+        if (k < 2 or max_use[k - 2] < k) \
+                and not any(m.__class__.__name__ in ('WeightedFeatureFusion', 'YOLOLayer') for m in sub_modules):
+            safe.append(k)
+
+    # ----- the boundaries nearest to the even split
+    bounds = set()
+    for s in range(1, n_segments):
+        if safe:
+            bounds.add(min(safe, key=lambda k: abs(k - s * n_layers / n_segments)))
+    bounds = [0] + sorted(bounds) + [n_layers]
+
+    ends = [None] * len(module_list)
+    lasts, keeps = {}, {}
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        ends[start] = end
+        lasts[start] = max([j for j in range(start, end) if module_list[j].__class__.__name__ != 'YOLOLayer'] + [start])
+        keeps[start] = [j for j in range(start, lasts[start]) if j in feat_layers]
+
+    return {'ends': ends, 'lasts': lasts, 'keeps': keeps}
+
+
+def get_concat_plan(module_list, feat_out_ids):
+    """
+    Concat buffer plan of the multi-layer routes(FeatureConcat):
+    each route input is either written into its channel slice of the route buffer by the
+    producer layer's last activation(a writer), or copied into the slice by the route.
+    A layer writes into at most one route buffer(the first route using it), and only if
+    its output can be a non-contiguous view: i.e. it is not a reid feature map layer and it is
+    not fed into a shortcut(which may modify its input in place) or a yolo layer(view).
+    The route buffers are reused across forwards, so a reid feature map route is not planned.
+    :param module_list:
+    :param feat_out_ids: reid feature map layer ids
+    :return: dict of
+             'routes': for each layer, list of (input layer id, start channel, end channel) to be
+                       copied into the route buffer, or None if the layer is not a planned route
+             'writers': for each layer, (route layer id, start channel, end channel, route channels)
+                        of the buffer slice the layer writes into, or None
+    """
+    # the reid classifiers(ModuleList) do not record outputs
+    n_layers = len([m for m in module_list if m.__class__.__name__ != 'ModuleList'])
+    feat_layers = [n_layers + out_id if out_id < 0 else out_id for out_id in feat_out_ids]
+
+    def view_safe(i):  # may the output of layer i(or its input to layer i + 1) be a buffer view
+        if i + 1 >= n_layers:
+            return True
+        next_module = module_list[i + 1]
+        sub_modules = next_module if next_module.__class__.__name__ == 'Sequential' else [next_module]
+        return not any(m.__class__.__name__ in ('WeightedFeatureFusion', 'YOLOLayer') for m in sub_modules)
+
+    routes = [None] * len(module_list)
+    writers = [None] * len(module_list)
+    for i, module in enumerate(module_list[:n_layers]):
+        if module.__class__.__name__ != 'FeatureConcat' or not module.multiple or not view_safe(i) \
+                or i in feat_layers:
+            continue
+
+        layers = [i + l if l < 0 else l for l in module.layers]
+        starts = np.cumsum([0] + module.channels).tolist()
+        c = starts[-1]
+
+        copied, n_written = [], 0
+        for j, c0, c1 in zip(layers, starts[:-1], starts[1:]):
+            producer = module_list[j]
+            if producer.__class__.__name__ == 'Sequential' and len(producer) > 1 \
+                    and type(producer[-1]) in ACTIVATION_OUT \
+                    and writers[j] is None and layers.count(j) == 1 \
+                    and j not in feat_layers and view_safe(j):
+                writers[j] = (i, c0, c1, c)
+                n_written += 1
+            else:
+                copied.append((j, c0, c1))
+
+        if n_written:
+            routes[i] = copied
+        else:  # nothing written in place: keep torch.cat
+            for j in layers:
+                if writers[j] is not None and writers[j][0] == i:
+                    writers[j] = None
+
+    return {'routes': routes, 'writers': writers}
+
+
+def load_darknet_weights(model, weights, cutoff=0, mmap=False):
     """
     :param model:
     :param weights:
     :param cutoff:
+    :param mmap: memory-map the weights file: the cpu parameters become views of the mapped file
+    (shared page cache between processes, copy-on-write), the others are copied from it
     :return:
     """
     print('Cutoff: ', cutoff)
@@ -673,7 +1222,18 @@ def load_darknet_weights(model, weights, cutoff=0):
         # Read Header https://github.com/AlexeyAB/darknet/issues/2914#issuecomment-496675346
         model.version = np.fromfile(f, dtype=np.int32, count=3)  # (int32) version info: major, minor, revision
         model.seen = np.fromfile(f, dtype=np.int64, count=1)  # (int64) number of images seen during training
-        weights = np.fromfile(f, dtype=np.float32)  # the rest are weights
+        if mmap:
+            weights = np.memmap(f, dtype=np.float32, mode='c', offset=f.tell())  # the rest are weights
+        else:
+            weights = np.fromfile(f, dtype=np.float32)  # the rest are weights
+
+    def load(tensor, ptr):
+        w = torch.from_numpy(weights[ptr:ptr + tensor.numel()]).view_as(tensor)
+        if mmap and tensor.device.type == 'cpu':
+            tensor.data = w  # a view of the mapped file
+        else:
+            tensor.data.copy_(w)
+        return ptr + tensor.numel()
 
     ptr = 0
     # for i, (mdef, module) in enumerate(zip(self.module_defs[:cutoff], self.module_list[:cutoff])):
@@ -686,35 +1246,16 @@ def load_darknet_weights(model, weights, cutoff=0):
             if mdef['batch_normalize']:
                 # Load BN bias, weights, running mean and running variance
                 bn = module[1]
-                nb = bn.bias.numel()  # number of biases
-
-                # Bias
-                bn.bias.data.copy_(torch.from_numpy(weights[ptr:ptr + nb]).view_as(bn.bias))
-                ptr += nb
-
-                # Weight
-                bn.weight.data.copy_(torch.from_numpy(weights[ptr:ptr + nb]).view_as(bn.weight))
-                ptr += nb
-
-                # Running Mean
-                bn.running_mean.data.copy_(torch.from_numpy(weights[ptr:ptr + nb]).view_as(bn.running_mean))
-                ptr += nb
-
-                # Running Var
-                bn.running_var.data.copy_(torch.from_numpy(weights[ptr:ptr + nb]).view_as(bn.running_var))
-                ptr += nb
+                ptr = load(bn.bias, ptr)  # Bias
+                ptr = load(bn.weight, ptr)  # Weight
+                ptr = load(bn.running_mean, ptr)  # Running Mean
+                ptr = load(bn.running_var, ptr)  # Running Var
             else:
                 # Load conv. bias
-                nb = conv.bias.numel()
-                conv_b = torch.from_numpy(weights[ptr:ptr + nb]).view_as(conv.bias)
-
-                conv.bias.data.copy_(conv_b)
-                ptr += nb
+                ptr = load(conv.bias, ptr)
 
             # Load conv. weights
-            nw = conv.weight.numel()  # number of weights
-            conv.weight.data.copy_(torch.from_numpy(weights[ptr:ptr + nw]).view_as(conv.weight))
-            ptr += nw
+            ptr = load(conv.weight, ptr)
 
 
 def save_darknet_weights(self, path='model.weights', cutoff=-1):
@@ -799,6 +1340,378 @@ def convert(cfg='cfg/yolov4-pacsp.cfg', weights='weights/yolov4-pacsp.weights'):
         print('Error: extension not supported.')
 
 
+def save_fused(model, path='weights/fused.pt'):
+    """
+    Saves a self-contained inference artifact of the model: the whole model with its conv + bn layers fused
+    (module list, routs, yolo layers' anchors, reid settings and max_id_dict included),
+    to be loaded by load_fused without parsing the cfg, creating the modules or fusing again.
+    The nn.Module is pickled: the artifact only loads against the same class layout of
+    models.py and utils/layers.py, re-export it after changing them
+    :param model: Darknet model with loaded weights
+    :param path:
+    :return:
+    """
+    model.eval()
+    model.fuse()
+
+    chkpt = {
+        'fused_model': model.to('cpu'),
+        'max_id_dict': getattr(model, 'max_id_dict', None),
+        'feat_out_ids': model.feat_out_ids,
+        'emb_dim': model.emb_dim,
+        'mode': model.mode
+    }
+
+    torch.save(chkpt, path)
+    print("Success: saved fused model to '%s'" % path)
+
+
+def load_checkpoint(weights, device='cpu', weights_only=True):
+    """
+    :param weights: *.pt file path
+    :param device:
+    :param weights_only: unpickle tensors and plain containers only(training checkpoints),
+                         False only for the fused artifact(pickled modules, see load_fused)
+    :return: checkpoint dict
+    """
+    if weights_only and hasattr(torch.serialization, 'safe_globals'):  # torch >= 2.5
+        # the training checkpoints keep numpy values(best_fitness): the numpy array and scalar reconstructors
+        with torch.serialization.safe_globals(NUMPY_SAFE_GLOBALS):
+            return torch.load(weights, map_location=device, weights_only=True)
+    try:
+        return torch.load(weights, map_location=device, weights_only=weights_only)
+    except TypeError:  # torch < 1.13
+        return torch.load(weights, map_location=device)
+
+
+def is_fused_artifact(weights):
+    """
+    Whether a *.pt file is a fused artifact saved by save_fused, without unpickling it:
+    the opcodes of the checkpoint's pickle are scanned for the 'fused_model' key
+    :param weights: *.pt file path
+    :return:
+    """
+    if not zipfile.is_zipfile(weights):  # legacy(torch < 1.6) format: not saved by save_fused
+        return False
+
+    with zipfile.ZipFile(weights) as f:
+        names = [name for name in f.namelist() if name.endswith('data.pkl')]
+        if not names:
+            return False
+        data = f.read(names[0])
+
+    return any(arg == 'fused_model' for _, arg, _ in pickletools.genops(data))
+
+
+def load_fused(chkpt, device='cpu'):
+    """
+    :param chkpt: fused inference artifact(path or checkpoint dict saved by save_fused)
+    :param device: cpu only for an int8 quantized artifact
+    :return: the fused Darknet model in eval mode
+    """
+    if isinstance(chkpt, str):
+        if not is_fused_artifact(chkpt):  # arbitrary pickles are not loaded
+            raise ValueError('{} is not a fused artifact saved by save_fused'.format(chkpt))
+        chkpt = load_checkpoint(chkpt, 'cpu', weights_only=False)  # the fused artifact pickles modules
+
+    model = chkpt['fused_model']
+    if getattr(model, 'qengine', None) is not None:  # int8 quantized artifact: cpu only
+        if torch.device(device).type != 'cpu':
+            raise ValueError('int8 quantized model has cpu kernels only, got device {}: use --device cpu'
+                             .format(device))
+        torch.backends.quantized.engine = model.qengine
+        restore_module_state(model)
+
+    return model.to(device).eval()
+
+
+def restore_module_state(module):
+    """
+    The quantized conv layers pickle only their own state(__getstate__), unpickling them leaves out
+    the nn.Module bookkeeping(_modules, _parameters, hooks...): re-initialize it in place
+    :param module: unpickled model
+    :return:
+    """
+    if '_modules' not in module.__dict__:
+        training = module.training
+        nn.Module.__init__(module)
+        module.training = training
+
+    for sub_module in module.__dict__['_modules'].values():
+        if sub_module is not None:
+            restore_module_state(sub_module)
+
+
+def get_layer_ancestors(module_defs, out_ids):
+    """
+    :param module_defs:
+    :param out_ids: layer ids(negative: counted from the last layer)
+    :return: set of the layer ids the outputs of out_ids depend on(out_ids included)
+    """
+    n_layers = len(module_defs)
+    stack = [n_layers + i if i < 0 else i for i in out_ids]
+    ancestors = set()
+    while stack:
+        i = stack.pop()
+        if i < 0 or i in ancestors:
+            continue
+        ancestors.add(i)
+
+        mdef = module_defs[i]
+        if mdef['type'] in ('route', 'route_lhalf'):  # route layers only take their 'layers'
+            inputs = mdef['layers']
+        else:  # the previous layer and the 'from' layers(shortcut, sam, scale_channels)
+            inputs = [-1] + list(mdef.get('from', []))
+        stack.extend([i + l if l < 0 else l for l in inputs])
+
+    return ancestors
+
+
+def prepare_quantization(model, reid_precision='int8', backend='fbgemm'):
+    """
+    Prepares a Darknet model for post-training static int8 quantization(eager mode, cpu inference):
+    each conv layer is fused per the cfg(Conv2d + BatchNorm2d, + ReLU if its activation is relu)
+    and wrapped by quant/dequant stubs with observers, while the layers without int8 kernels
+    (route, shortcut, upsample, leaky/mish activations, yolo) stay in fp32.
+    The convs right before the yolo layers stay in fp32, the convs only computing
+    the reid feature maps(reid head) are quantized or not by reid_precision.
+    Run calibration frames through the returned model, then call convert_quantization.
+    :param model: Darknet model with loaded weights
+    :param reid_precision: int8 or fp32
+    :param backend: fbgemm(x86) or qnnpack(arm)
+    :return: the prepared model(in place)
+    """
+    torch.backends.quantized.engine = backend
+    qconfig = torch.quantization.get_default_qconfig(backend)
+    model.eval()
+
+    # ----- layers whose convs stay in fp32
+    yolo_defs = [i for i, mdef in enumerate(model.module_defs) if mdef['type'] == 'yolo']
+    reid_head = get_layer_ancestors(model.module_defs, model.feat_out_ids) \
+                - get_layer_ancestors(model.module_defs, yolo_defs)
+    fp32_layers = set(i - 1 for i in yolo_defs)
+    if reid_precision == 'fp32':
+        fp32_layers |= reid_head
+
+    n_quantized = 0
+    for i, mdef in enumerate(model.module_defs):
+        module = model.module_list[i]
+        if mdef['type'] != 'convolutional' or i in fp32_layers or 'Conv2d' not in module._modules:
+            continue  # MixConv2d is not quantized
+
+        to_fuse = ['Conv2d']
+        if 'BatchNorm2d' in module._modules:
+            to_fuse.append('BatchNorm2d')
+        if isinstance(module._modules.get('activation'), nn.ReLU):
+            to_fuse.append('activation')
+        fused = torch.quantization.fuse_modules(module, [to_fuse]) if len(to_fuse) > 1 else module
+
+        layers = OrderedDict()
+        layers['quant'] = torch.quantization.QuantStub()
+        layers['Conv2d'] = fused.Conv2d
+        layers['dequant'] = torch.quantization.DeQuantStub()
+        if 'activation' in module._modules and 'activation' not in to_fuse:
+            layers['activation'] = module.activation
+        quant_module = nn.Sequential(layers)
+        quant_module.qconfig = qconfig
+        if 'activation' in layers:  # the activation takes the dequantized output: not swapped to int8 by convert
+            layers['activation'].qconfig = None
+        model.module_list[i] = quant_module
+        n_quantized += 1
+
+    print('{:d} conv layers to be quantized, {:d} reid head layers in {:s}.'
+          .format(n_quantized, len(reid_head), reid_precision))
+
+    model.qengine = backend
+    torch.quantization.prepare(model, inplace=True)
+    return model
+
+
+def convert_quantization(model):
+    """
+    Converts a calibrated model(see prepare_quantization) to int8
+    :param model:
+    :return: the int8 model(in place)
+    """
+    model.eval()
+    torch.quantization.convert(model, inplace=True)
+    return model
+
+
+def save_traced(model, img_size=(448, 768), path='weights/model.torchscript', device='cpu'):
+    """
+    Saves a TorchScript(traced) inference module of the model: the decoded detections and the reid
+    feature maps of a fixed size net input, computed by one static graph(no cfg, no per layer dispatch)
+    :param model: Darknet model with loaded weights
+    :param img_size: net input height, width
+    :param path:
+    :param device:
+    :return:
+    """
+    model.eval()
+    model.fuse()
+    model.to(device)
+
+    # the planned concat(out=) and sparse decoding(dynamic shapes) are not traced
+    model.plan_concat(False)
+    model.sparse_decode(None)
+
+    img = torch.zeros((1, 3) + tuple(img_size), device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(DarknetTrace(model).eval(), img, check_trace=False)
+    if hasattr(torch.jit, 'freeze'):  # torch >= 1.8
+        traced = torch.jit.freeze(traced)
+
+    meta = {'feat_out_ids': model.feat_out_ids, 'mode': model.mode, 'img_size': list(img_size)}
+    torch.jit.save(traced, path, _extra_files={'meta.json': json.dumps(meta)})
+    print("Success: saved traced model to '%s'" % path)
+
+
+def load_traced(path, device='cpu', img_size=None):
+    """
+    :param path: TorchScript file saved by save_traced
+    :param device:
+    :param img_size: net input height, width to be used, checked against the traced size(None: not checked)
+    :return: TracedDarknet in eval mode
+    """
+    extra_files = {'meta.json': ''}
+    traced = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    meta = json.loads(extra_files['meta.json'])
+    if img_size is not None and tuple(img_size) != tuple(meta['img_size']):
+        raise ValueError('traced model {} takes net input size(h, w) {}, got {}: re-export it with this size'
+                         .format(path, tuple(meta['img_size']), tuple(img_size)))
+    print('Traced model {} loaded, net input size(h, w): {}'.format(path, meta['img_size']))
+
+    return TracedDarknet(traced, meta['feat_out_ids'], meta['mode'], meta['img_size']).to(device).eval()
+
+
+def save_onnx(model, img_size=(448, 768), path='weights/model.onnx', opset=11):
+    """
+    Exports the model to ONNX with named outputs: the raw yolo layer outputs(yolo_0, yolo_1...: B×(na·no)×ny×nx)
+    and the feat_out_ids reid feature maps(reid_0, reid_1...), for any cfg.
+    The yolo layers' anchors, strides and classes are saved in the model's metadata(needs the onnx package)
+    to be decoded by OnnxDarknet.
+    :param model: Darknet model with loaded weights
+    :param img_size: net input height, width
+    :param path:
+    :param opset:
+    :return:
+    """
+    import onnx
+
+    model.eval()
+    model.fuse()
+    model.to('cpu')
+
+    # the planned concat(out=) and sparse decoding(dynamic shapes) are not exported
+    model.plan_concat(False)
+    model.sparse_decode(None)
+
+    yolo_layers = [model.module_list[i] for i in model.yolo_layer_inds]
+    output_names = ['yolo_%d' % i for i in range(len(yolo_layers))] + \
+                   ['reid_%d' % i for i in range(len(model.feat_out_ids) if model.mode == 'track' else 0)]
+    if model.mode != 'track':
+        model.feat_out_ids, feat_out_ids = [], model.feat_out_ids
+
+    # the TorchScript based exporter(opset, dynamic_axes): not the default one of torch >= 2.9
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    img = torch.zeros((1, 3) + tuple(img_size))
+    model.raw_yolo_out = True
+    try:
+        with torch.no_grad():
+            torch.onnx.export(model, img, path,
+                              opset_version=opset,
+                              input_names=['images'],
+                              output_names=output_names,
+                              dynamic_axes={name: {0: 'batch'} for name in ['images'] + output_names},
+                              **kwargs)
+    finally:
+        model.raw_yolo_out = False
+        if model.mode != 'track':
+            model.feat_out_ids = feat_out_ids
+
+    # ----- save the yolo layers' decoding parameters and reid settings as metadata
+    meta = {'yolo_layers': [{'anchors': m.anchors.tolist(), 'nc': m.nc, 'stride': m.stride}
+                            for m in yolo_layers],
+            'feat_out_ids': model.feat_out_ids,
+            'mode': model.mode,
+            'img_size': list(img_size)}
+    onnx_model = onnx.load(path)
+    onnx.helper.set_model_props(onnx_model, {'darknet': json.dumps(meta)})
+    onnx.save(onnx_model, path)
+    print("Success: saved onnx model to '%s'" % path)
+
+
+def save_flat_weights(state_dict, path='weights/model.flat'):
+    """
+    Saves a state dict as a flat, memory-mappable file:
+    magic, uint64 header size, json header(name: dtype, shape, offset) and 64-byte aligned raw tensors
+    :param state_dict:
+    :param path:
+    :return:
+    """
+    index, offset = {}, 0
+    for name, tensor in state_dict.items():
+        offset = (offset + 63) // 64 * 64
+        array = tensor.detach().cpu().numpy()
+        index[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+
+    header = json.dumps(index).encode('utf-8')
+    data_start = (len(FLAT_MAGIC) + 8 + len(header) + 63) // 64 * 64
+
+    with open(path, 'wb') as f:
+        f.write(FLAT_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, tensor in state_dict.items():
+            f.seek(data_start + index[name]['offset'])
+            f.write(tensor.detach().cpu().numpy().tobytes())
+    print("Success: saved flat weights to '%s'" % path)
+
+
+def load_flat_weights(model, path):
+    """
+    Loads a flat weights file(save_flat_weights) by memory-mapping it:
+    the cpu parameters and buffers become views of the mapped file
+    (shared page cache between processes, copy-on-write), the others are copied from it
+    :param model:
+    :param path:
+    :return:
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(FLAT_MAGIC)) != FLAT_MAGIC:
+            raise ValueError('%s is not a flat weights file' % path)
+        header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        index = json.loads(f.read(header_size).decode('utf-8'))
+    data_start = (len(FLAT_MAGIC) + 8 + header_size + 63) // 64 * 64
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start)
+
+    tensors = dict(model.named_parameters())
+    tensors.update(model.named_buffers())
+    for name, entry in index.items():
+        if name not in tensors:
+            print('Warning: %s of %s not in the model.' % (name, path))
+            continue
+        dtype = np.dtype(entry['dtype'])
+        n_bytes = int(np.prod(entry['shape'])) * dtype.itemsize
+        w = torch.from_numpy(data[entry['offset']:entry['offset'] + n_bytes].view(dtype).reshape(entry['shape']))
+
+        tensor = tensors[name]
+        if tensor.device.type == 'cpu' and tensor.dtype == w.dtype:
+            tensor.data = w.view_as(tensor)  # a view of the mapped file
+        else:
+            tensor.data.copy_(w.view_as(tensor))
+
+
+def pt2flat(weights='weights/last.pt', path=None):
+    # Converts a PyTorch checkpoint to a flat, memory-mappable weights file(*.pt to *.flat)
+    # from models import *; pt2flat('weights/last.pt')
+    path = path or str(Path(weights).with_suffix('.flat'))
+    save_flat_weights(load_checkpoint(weights)['model'], path)
+
+
 def attempt_download(weights):
     # Attempt to download pretrained weights if not found locally
     weights = weights.strip()
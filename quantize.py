@@ -0,0 +1,282 @@
+# encoding=utf-8
+"""
+Post-training static int8 quantization of a tracking model for cpu inference:
+the conv layers are fused per the cfg(Conv2d + BatchNorm2d, + ReLU), calibrated on a sample of frames
+read by LoadImages, converted to int8 and saved as a fused inference artifact(pass it as --weights to demo.py
+with --device cpu). The reid head precision is selected by --reid-precision.
+Reports the cpu latency of the fp32 and int8 models, the mAP delta(--data, by test.py)
+and the MOTA delta(--mot-root and --mot-res, by MOTEvaluate/evaluate.py).
+
+usage: python3 quantize.py --cfg cfg/yolov4-paspp-mcmot.cfg --weights weights/track_last.weights --source /mnt/diskb/even/calib.mp4
+python3 quantize.py --reid-precision fp32 --data data/mcmot_det.data --output weights/track_last_int8.pt
+python3 quantize.py --mot-root /mnt/diskb/even/dataset/MCMOT_Evaluate --mot-res ./results_fp32 ./results_int8
+"""
+import argparse
+import copy
+import os
+import time
+
+from torch.utils.data import DataLoader
+
+import test
+from models import *
+from utils.datasets import *
+
+
+def load_model(opt, device):
+    """
+    :param opt:
+    :param device:
+    :return: the fp32 Darknet model with loaded weights
+    """
+    # ----- read max_id_dict(number of track ids of each object class)
+    max_id_dict = None
+    if opt.task == 'track':
+        if not os.path.isfile(opt.max_id_dict):
+            print('[Err]: max_id_dict file {} not exists.'.format(opt.max_id_dict))
+            return None
+        load_dict = np.load(opt.max_id_dict, allow_pickle=True)
+        max_id_dict = load_dict['max_id_dict'][()]
+        print(max_id_dict)
+
+    model = Darknet(cfg=opt.cfg,
+                    img_size=opt.img_size,
+                    verbose=False,
+                    max_id_dict=max_id_dict,
+                    emb_dim=opt.dim,
+                    fc=opt.fc,
+                    feat_out_ids=opt.feat_out_ids,
+                    mode=opt.task).to(device)
+
+    # ----- load weights
+    if opt.weights.endswith('.pt'):  # py-torch format
+        ckpt = load_checkpoint(opt.weights, device)
+        model.load_state_dict(ckpt['model'])
+    else:  # dark-net format
+        load_darknet_weights(model, opt.weights, int(opt.cutoff))
+    print('{} loaded.'.format(opt.weights))
+
+    return model.eval()
+
+
+def calibrate(model, opt):
+    """
+    Runs the calibration frames through a prepared model to collect the activation ranges
+    :param model:
+    :param opt:
+    :return:
+    """
+    dataset = LoadImages(opt.source, opt.img_proc_method,
+                         net_w=opt.net_w, net_h=opt.net_h, stride=opt.calib_stride)
+
+    n_frames = 0
+    with torch.no_grad():
+        for path, img, img0, vid_cap in dataset:
+            img = torch.from_numpy(img).float() / 255.0
+            model(img.unsqueeze(0))
+
+            n_frames += 1
+            if n_frames >= opt.n_calib:
+                break
+
+    print('{:d} calibration frames done.'.format(n_frames))
+
+
+def timeit(model, x, n_iters):
+    """
+    :param model:
+    :param x:
+    :param n_iters:
+    :return: ms per frame
+    """
+    with torch.no_grad():
+        model(x)  # warm up
+        t1 = time.perf_counter()
+        for _ in range(n_iters):
+            model(x)
+        t2 = time.perf_counter()
+
+    return (t2 - t1) * 1000.0 / n_iters
+
+
+def eval_map(model, opt):
+    """
+    :param model:
+    :param opt:
+    :return: mAP@0.5 on the valid set of opt.data, by test.py
+    """
+    path = parse_data_cfg(opt.data)['valid']
+    dataset = LoadImgsAndLbsWithID(path, opt.img_size, opt.batch_size, rect=True)
+    data_loader = DataLoader(dataset,
+                             batch_size=min(opt.batch_size, len(dataset)),
+                             num_workers=min([os.cpu_count(), opt.batch_size if opt.batch_size > 1 else 0, 8]),
+                             collate_fn=dataset.collate_fn)
+
+    results, _ = test.test(opt.cfg,
+                           opt.data,
+                           batch_size=opt.batch_size,
+                           img_size=opt.img_size,
+                           model=model,
+                           data_loader=data_loader,
+                           task='track')
+    return results[2]
+
+
+def quantize(opt):
+    """
+    :param opt:
+    :return:
+    """
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    # ----- MOTA delta of the tracking results of the fp32 and int8 models(written by demo.py)
+    if opt.mot_root and opt.mot_res:
+        from MOTEvaluate.evaluate import evaluate_mcmot_seqs, metric_names
+
+        metrics = [evaluate_mcmot_seqs(opt.mot_root, opt.fps, res_root) for res_root in opt.mot_res]
+        if any(m is None for m in metrics):
+            return
+        for name in ('MOTA', 'IDF1'):
+            k = metric_names.index(name)
+            print('{:s}: fp32 {:.3f}, int8 {:.3f}, delta {:+.3f}'
+                  .format(name, metrics[0][k], metrics[1][k], metrics[1][k] - metrics[0][k]))
+        return
+
+    device = torch.device('cpu')  # the quantized kernels run on cpu
+    model = load_model(opt, device)
+    if model is None:
+        return
+
+    model_fp32 = copy.deepcopy(model)
+    model_fp32.fuse()
+
+    # ----- fuse, calibrate and convert
+    prepare_quantization(model, opt.reid_precision, opt.backend)
+    calibrate(model, opt)
+    convert_quantization(model)
+
+    # ----- latency
+    x = torch.rand(1, 3, opt.net_h, opt.net_w)
+    t_fp32 = timeit(model_fp32, x, opt.iters)
+    t_int8 = timeit(model, x, opt.iters)
+    print('{:>10s} {:>10s} {:>8s}'.format('fp32(ms)', 'int8(ms)', 'speedup'))
+    print('{:>10.2f} {:>10.2f} {:>7.2f}x'.format(t_fp32, t_int8, t_fp32 / t_int8))
+
+    # ----- mAP
+    if opt.data:
+        map_fp32, map_int8 = eval_map(model_fp32, opt), eval_map(model, opt)
+        print('mAP@0.5: fp32 {:.4f}, int8 {:.4f}, delta {:+.4f}'.format(map_fp32, map_int8, map_int8 - map_fp32))
+
+    save_fused(model, opt.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--cfg',
+                        type=str,
+                        default='cfg/yolov4-paspp-mcmot.cfg',
+                        help='*.cfg path')
+    parser.add_argument('--weights',
+                        type=str,
+                        default='weights/mcmot_half_track_last_211014.weights',
+                        help='weights path(*.weights or *.pt)')
+    parser.add_argument('--output',
+                        type=str,
+                        default='weights/mcmot_int8.pt',
+                        help='int8 fused artifact path')
+    parser.add_argument('--source',
+                        type=str,
+                        default='/mnt/diskb/even/YOLOV4/data/videos/test5.mp4',
+                        help='calibration images dir or video')
+    parser.add_argument('--n-calib',
+                        type=int,
+                        default=100,
+                        help='number of calibration frames')
+    parser.add_argument('--calib-stride',
+                        type=int,
+                        default=5,
+                        help='video frame stride of the calibration frames')
+    parser.add_argument('--img-proc-method',
+                        type=str,
+                        default='resize',
+                        help='Image pre-processing method(letterbox, resize)')
+    parser.add_argument('--reid-precision',
+                        type=str,
+                        default='int8',
+                        help='precision of the reid head: int8 or fp32')
+    parser.add_argument('--backend',
+                        type=str,
+                        default='fbgemm',
+                        help='quantized engine: fbgemm(x86) or qnnpack(arm)')
+    parser.add_argument('--net_w',
+                        type=int,
+                        default=768,
+                        help='net input width')
+    parser.add_argument('--net_h',
+                        type=int,
+                        default=448,
+                        help='net input height')
+    parser.add_argument('--max-id-dict',
+                        type=str,
+                        default='/mnt/diskb/even/dataset/MCMOT/max_id_dict.npz',
+                        help='max_id_dict.npz path(track task)')
+    parser.add_argument('--task',
+                        type=str,
+                        default='track',  # track or detect
+                        help='task mode: track or detect')
+    parser.add_argument('--img-size',
+                        type=int,
+                        default=768,
+                        help='Image size')
+    parser.add_argument('--cutoff',
+                        type=int,
+                        default=0,
+                        help='cutoff layer index, 0 means all layers loaded.')
+    parser.add_argument('--feat-out-ids',
+                        type=str,
+                        default='-1',
+                        help='reid feature map output layer ids.')
+    parser.add_argument('--dim',
+                        type=int,
+                        default=128,
+                        help='reid feature map output embedding dimension')
+    parser.add_argument('--fc',
+                        type=str,
+                        default='Arc',
+                        help='FC layer type: FC or Arc')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=0,
+                        help='number of cpu threads(0: torch default)')
+    parser.add_argument('--iters',
+                        type=int,
+                        default=20,
+                        help='latency timing iterations')
+    parser.add_argument('--data',
+                        type=str,
+                        default='',
+                        help='*.data path: report the mAP delta by test.py')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=8,
+                        help='batch size of the mAP test')
+    parser.add_argument('--mot-root',
+                        type=str,
+                        default='',
+                        help='MCMOT evaluate root(test videos and ground truth)')
+    parser.add_argument('--mot-res',
+                        nargs=2,
+                        type=str,
+                        default=[],
+                        help='tracking result dirs of the fp32 and int8 models: report the MOTA delta')
+    parser.add_argument('--fps',
+                        type=int,
+                        default=12,
+                        help='fps of the MCMOT evaluation')
+
+    opt = parser.parse_args()
+    print(opt)
+
+    quantize(opt)
@@ -45,19 +45,28 @@ def test(cfg,
         for f in glob.glob('test_batch*.jpg'):
             os.remove(f)
 
-        # Initialize model
-        model = Darknet(cfg, img_size)
+        fused = weights.endswith('.pt') and is_fused_artifact(weights)
+        ckpt = load_checkpoint(weights, 'cpu') if weights.endswith('.pt') and not fused else None
+        if fused:  # fused(or int8 quantized) inference artifact
+            model = load_fused(weights, device)
+        else:
+            # Initialize model
+            model = Darknet(cfg, img_size)
+
+            # Load weights
+            # attempt_download(weights)
+            if ckpt is not None:  # pytorch format
+                model.load_state_dict(ckpt['model'])
+            else:  # darknet format
+                load_darknet_weights(model, weights)
 
-        # Load weights
-        # attempt_download(weights)
-        if weights.endswith('.pt'):  # pytorch format
-            model.load_state_dict(torch.load(weights, map_location=device)['model'])
-        else:  # darknet format
-            load_darknet_weights(model, weights)
+            # Fuse
+            model.fuse()
+            model.to(device)
 
-        # Fuse
-        model.fuse()
-        model.to(device)
+        # bf16 and(or) channels_last net(yolo decoding and nms stay in fp32)
+        if opt.precision != 'fp32' or opt.memory_format != 'contiguous':
+            model.set_precision(opt.precision, opt.memory_format)
 
         if device.type != 'cpu' and torch.cuda.device_count() > 1:
             model = nn.DataParallel(model)
@@ -362,6 +371,8 @@ if __name__ == '__main__':
     parser.add_argument('--device', default='6', help='device id (i.e. 0 or 0,1) or cpu')
     parser.add_argument('--single-cls', action='store_true', help='train as single-class dataset')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--precision', type=str, default='fp32', help='net precision: fp32 or bf16(cpu)')
+    parser.add_argument('--memory-format', type=str, default='contiguous', help='contiguous(NCHW) or channels_last')
 
     # Set task mode: pure_detect | detect | track
     # pure detect means the dataset do not contains ID info.
@@ -0,0 +1,6 @@
+# encoding=utf-8
+import os
+import sys
+
+# the tests import the repo modules the same way the scripts do(run from the repo root)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,63 @@
+# encoding=utf-8
+"""
+The memory efficient Mish/Swish autograd functions: gradients checked numerically(gradcheck, float64),
+and outputs and gradients equal to the reference activations differentiated by autograd.
+"""
+import pytest
+import torch
+import torch.nn.functional as F
+
+from utils.layers import MishImplementation, SwishImplementation, Mish, Swish, MISH_CUDA
+
+ACTIVATIONS = [(MishImplementation, lambda x: x * F.softplus(x).tanh()),
+               (SwishImplementation, lambda x: x * torch.sigmoid(x))]
+
+
+@pytest.mark.parametrize('func, reference', ACTIVATIONS, ids=['mish', 'swish'])
+def test_gradcheck(func, reference):
+    torch.manual_seed(0)
+    x = (torch.randn(4, 3, 5, 5, dtype=torch.float64) * 4).requires_grad_(True)  # tails of the activations too
+    assert torch.autograd.gradcheck(func.apply, (x,))
+
+
+@pytest.mark.parametrize('func, reference', ACTIVATIONS, ids=['mish', 'swish'])
+def test_matches_reference(func, reference):
+    torch.manual_seed(0)
+    x = torch.randn(2, 8, 16, 16) * 4
+    grad_out = torch.randn_like(x)
+
+    x_ref = x.clone().requires_grad_(True)
+    y_ref = reference(x_ref)
+    y_ref.backward(grad_out)
+
+    x_fn = x.clone().requires_grad_(True)
+    y_fn = func.apply(x_fn)
+    y_fn.backward(grad_out)
+
+    assert torch.allclose(y_fn, y_ref, atol=1e-6)
+    assert torch.allclose(x_fn.grad, x_ref.grad, atol=1e-5)
+
+
+@pytest.mark.parametrize('module, reference', [(Mish, ACTIVATIONS[0][1]), (Swish, ACTIVATIONS[1][1])],
+                         ids=['mish', 'swish'])
+def test_modules_train_eval(module, reference):
+    if module is Mish and MISH_CUDA:
+        pytest.skip('mish_cuda is installed')
+
+    torch.manual_seed(0)
+    x = torch.randn(2, 8, 16, 16)
+    act = module(inplace=True)
+
+    act.train()
+    x_train = x.clone().requires_grad_(True)
+    act(x_train).sum().backward()
+    x_ref = x.clone().requires_grad_(True)
+    reference(x_ref).sum().backward()
+    assert torch.allclose(x_train.grad, x_ref.grad, atol=1e-5)
+
+    act.eval()  # in place without grad
+    with torch.no_grad():
+        x_eval = x.clone()
+        y = act(x_eval)
+    assert y.data_ptr() == x_eval.data_ptr()
+    assert torch.allclose(y, reference(x), atol=1e-6)
@@ -0,0 +1,89 @@
+# encoding=utf-8
+"""
+The packed targets of all yolo layers(build_targets_packed) equal the per yolo layer loop they replace.
+"""
+import pytest
+import torch
+
+from models import Darknet
+from utils.utils import build_targets, build_targets_with_ids, wh_iou
+
+
+def loop_build_targets_with_ids(preds, targets, track_ids, model):
+    """
+    build_targets_with_ids before packing(reference): each yolo layer's anchors matched in turn
+    """
+    nt = targets.shape[0]
+    t_cls, t_box, indices, av, t_track_ids = [], [], [], [], []
+    gain = torch.ones(6, device=targets.device)
+
+    for i, idx in enumerate(model.yolo_layer_inds):
+        anchors = model.module_list[idx].anchor_vec
+
+        gain[2:] = torch.tensor(preds[i].shape)[[3, 2, 3, 2]]  # xyxy gain
+        t, a, tr_ids = targets * gain, torch.zeros(0, dtype=torch.long), track_ids  # the loop kept a = [] if nt == 0
+        gwh = t[:, 4:6]
+        if nt:
+            iou = wh_iou(anchors, gwh)
+            na = anchors.shape[0]
+            a = torch.arange(na).view(-1, 1).repeat(1, nt).view(-1)
+            t = t.repeat(na, 1)
+            tr_ids = track_ids.repeat(na)
+
+            idx = iou.view(-1) > model.hyp['iou_t']
+            t, a, tr_ids = t[idx], a[idx], tr_ids[idx]
+
+        b, c = t[:, :2].long().t()
+        gxy = t[:, 2:4]
+        gwh = t[:, 4:6]
+        gi, gj = gxy.long().t()
+        indices.append((b, a, gj, gi))
+
+        gxy -= gxy.floor()
+        t_box.append(torch.cat((gxy, gwh), 1))
+        av.append(anchors[a])
+        t_track_ids.append(tr_ids)
+        t_cls.append(c)
+
+    return t_cls, t_box, indices, av, t_track_ids
+
+
+def random_batch(model, bs, nt, net_h=192, net_w=320):
+    preds = []
+    for idx in model.yolo_layer_inds:
+        yolo = model.module_list[idx]
+        preds.append(torch.zeros(bs, yolo.na, net_h // yolo.stride, net_w // yolo.stride, yolo.no))
+
+    targets = torch.cat((torch.randint(0, bs, (nt, 1)).float(),
+                         torch.randint(0, model.nc, (nt, 1)).float(),
+                         torch.rand(nt, 2),
+                         torch.rand(nt, 2) * 0.5 + 0.01), 1)
+    track_ids = torch.randint(0, 100, (nt,))
+    return preds, targets, track_ids
+
+
+@pytest.mark.parametrize('cfg', ['cfg/yolov4-tiny.cfg', 'cfg/yolov4-paspp-mcmot.cfg'])
+@pytest.mark.parametrize('nt', [0, 1, 37])
+def test_packed_targets_match_loop(cfg, nt):
+    torch.manual_seed(nt)
+    model = Darknet(cfg, (192, 320), verbose=False, mode='detect')
+    model.nc = model.module_list[model.yolo_layer_inds[0]].nc
+    model.hyp = {'iou_t': 0.2}
+
+    for _ in range(2):  # the 2nd call uses the cached target tables
+        preds, targets, track_ids = random_batch(model, bs=4, nt=nt)
+        ref = loop_build_targets_with_ids(preds, targets, track_ids, model)
+        out = build_targets_with_ids(preds, targets, track_ids, model)
+
+        for ref_layers, out_layers in zip(ref, out):  # cls, box, indices, anchors, track ids
+            assert len(ref_layers) == len(out_layers) == len(model.yolo_layer_inds)
+            for r, o in zip(ref_layers, out_layers):
+                if isinstance(r, tuple):  # b, a, gj, gi
+                    for r_i, o_i in zip(r, o):
+                        assert torch.equal(r_i, o_i)
+                else:
+                    assert r.shape == o.shape and torch.allclose(r, o)
+
+        t_cls, t_box, indices, av = build_targets(preds, targets, model)
+        for r, o in zip(ref[0], t_cls):
+            assert torch.equal(r, o)
@@ -0,0 +1,79 @@
+# encoding=utf-8
+"""
+Joint(all classes, block-diagonal costs) and per-class association of BYTETracker
+give the same tracks on a synthetic multi-class sequence.
+"""
+import numpy as np
+import pytest
+from easydict import EasyDict as edict
+
+from ByteTracker.byte_tracker import BYTETracker
+
+N_CLASSES = 5
+
+
+def make_sequence(n_frames=30, n_objs=20, dim=16, seed=0):
+    """
+    :return: list of frames, each a list of (tlbr box, score, reid feature, cls_id) detections
+    """
+    rng = np.random.default_rng(seed)
+    pos = rng.random((n_objs, 2)) * [1500.0, 800.0]
+    vel = rng.normal(0.0, 6.0, (n_objs, 2))
+    size = rng.random((n_objs, 2)) * [80.0, 160.0] + 20.0
+    cls_ids = rng.integers(0, N_CLASSES, n_objs)
+    feats = rng.normal(size=(n_objs, dim))
+    feats /= np.linalg.norm(feats, axis=1, keepdims=True)
+
+    frames = []
+    for _ in range(n_frames):
+        pos += vel + rng.normal(0.0, 2.0, pos.shape)
+        scores = np.clip(rng.normal(0.6, 0.25, n_objs), 0.05, 0.99)
+        dets = []
+        for i in np.where(rng.random(n_objs) > 0.1)[0]:  # missed detections
+            feat = feats[i] + rng.normal(0.0, 0.1, dim)
+            dets.append((np.r_[pos[i], pos[i] + size[i]], scores[i], feat / np.linalg.norm(feat), int(cls_ids[i])))
+        rng.shuffle(dets)
+        frames.append(dets)
+
+    return frames
+
+
+def run_tracker(joint_assoc, with_emb):
+    """
+    :return: (track id, tlwh) of the online tracks of each class in each frame
+    """
+    args = edict({'mot20': False,
+                  'match_thresh': 0.8,
+                  'n_classes': N_CLASSES,
+                  'track_buffer': 30,
+                  'track_thresh': 0.5,
+                  'joint_assoc': joint_assoc})
+    tracker = BYTETracker(args, frame_rate=30)
+
+    results = []
+    for dets in make_sequence():
+        if with_emb:
+            boxes_dict, scores_dict, feats_dict = {}, {}, {}
+            for cls_id in range(N_CLASSES):
+                cls_dets = [det for det in dets if det[3] == cls_id]
+                boxes_dict[cls_id] = [det[0] for det in cls_dets]
+                scores_dict[cls_id] = [det[1] for det in cls_dets]
+                feats_dict[cls_id] = [det[2] for det in cls_dets]
+            online_targets = tracker.update_byte_mcmot_emb(boxes_dict, scores_dict, feats_dict)
+        else:
+            online_targets = tracker.update_byte_mcmot(np.array([np.r_[det[0], det[1], det[3]] for det in dets]))
+
+        results.append({cls_id: sorted((track.track_id, tuple(np.round(track.tlwh, 4)))
+                                       for track in online_targets[cls_id])
+                        for cls_id in range(N_CLASSES)})
+
+    return results
+
+
+@pytest.mark.parametrize('with_emb', [False, True])
+def test_joint_equals_per_class(with_emb):
+    per_class = run_tracker(joint_assoc=False, with_emb=with_emb)
+    joint = run_tracker(joint_assoc=True, with_emb=with_emb)
+
+    assert sum(len(tracks) for frame in per_class for tracks in frame.values()) > 0
+    assert joint == per_class
@@ -0,0 +1,54 @@
+# encoding=utf-8
+"""
+Activation checkpointing(Darknet.checkpoint_segments) gives the same training losses, parameter
+gradients and batch norm running statistics as the plain training forward/backward.
+"""
+import copy
+
+import pytest
+import torch
+
+from models import Darknet
+
+
+def train_step(model, x, weights):
+    """
+    :return: a random linear loss of the yolo outputs(and reid feature maps) and the parameter gradients
+    """
+    model.zero_grad()
+    outs = model(x)
+    preds = outs[0] + outs[1] if model.mode == 'track' else outs
+    loss = sum((p * w).sum() for p, w in zip(preds, weights))
+    loss.backward()
+    return loss.item(), {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+
+
+@pytest.mark.parametrize('cfg, mode, n_segments', [('cfg/yolov4-tiny.cfg', 'detect', 3),
+                                                   ('cfg/yolov4-paspp-mcmot.cfg', 'track', 4)])
+def test_checkpoint_matches_plain(cfg, mode, n_segments):
+    torch.manual_seed(0)
+    max_id_dict = {cls_id: 10 for cls_id in range(5)} if mode == 'track' else None
+    model = Darknet(cfg, (128, 192), verbose=False, max_id_dict=max_id_dict, mode=mode).train()
+    model_ckpt = copy.deepcopy(model)
+    model_ckpt.checkpoint_segments(n_segments)
+    assert sum(end is not None for end in model_ckpt.checkpoint_plan['ends']) > 1
+
+    x = torch.rand(2, 3, 128, 192)
+    with torch.no_grad():  # output shapes
+        outs = copy.deepcopy(model)(x)
+    preds = outs[0] + outs[1] if mode == 'track' else outs
+    weights = [torch.randn_like(p) for p in preds]
+
+    loss, grads = train_step(model, x, weights)
+    loss_ckpt, grads_ckpt = train_step(model_ckpt, x, weights)
+
+    assert loss_ckpt == pytest.approx(loss, rel=1e-5)
+    assert grads.keys() == grads_ckpt.keys()
+    for name, grad in grads.items():
+        assert torch.allclose(grads_ckpt[name], grad, rtol=1e-4, atol=1e-5), name
+
+    # the recomputed segments do not update the batch norm running statistics again
+    state, state_ckpt = model.state_dict(), model_ckpt.state_dict()
+    for name in state:
+        if 'running' in name:
+            assert torch.allclose(state_ckpt[name], state[name], atol=1e-6), name
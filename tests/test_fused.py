@@ -0,0 +1,51 @@
+# encoding=utf-8
+"""
+The fused artifact(save_fused) is recognized without unpickling and loads with the eager model's outputs,
+the training checkpoints load with weights_only.
+"""
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from models import Darknet, save_fused, load_fused, load_checkpoint, is_fused_artifact
+
+
+def test_fused_artifact(tmp_path):
+    torch.manual_seed(0)
+    model = Darknet('cfg/yolov4-tiny.cfg', (192, 320), verbose=False, mode='detect').eval()
+    x = torch.rand(1, 3, 192, 320)
+
+    path = str(tmp_path / 'fused.pt')
+    save_fused(model, path)  # fuses the model in place
+    with torch.no_grad():
+        ref, _ = model(x)
+
+    assert is_fused_artifact(path)
+    with pytest.raises(pickle.UnpicklingError):  # not loaded as a training checkpoint
+        load_checkpoint(path)
+
+    with torch.no_grad():
+        out, _ = load_fused(path)(x)
+    assert torch.equal(out, ref)
+
+
+def test_training_checkpoint(tmp_path):
+    model = Darknet('cfg/yolov4-tiny.cfg', (192, 320), verbose=False, mode='detect')
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    path = str(tmp_path / 'last.pt')
+    torch.save({'epoch': 3,
+                'batch': 100,
+                'best_fitness': np.float64(0.5),
+                'fitness_history': np.array([0.1, 0.5]),  # train.py's fitness() returns numpy arrays
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict()}, path)
+
+    assert not is_fused_artifact(path)
+    with pytest.raises(ValueError):
+        load_fused(path)
+
+    ckpt = load_checkpoint(path)
+    model.load_state_dict(ckpt['model'])
+    assert ckpt['epoch'] == 3
@@ -0,0 +1,40 @@
+# encoding=utf-8
+"""
+The batched kalman correction(triangular solves against the cholesky factors)
+matches the per-track correction.
+"""
+import numpy as np
+
+from tracking_utils.kalman_filter import KalmanFilter, solve_lower_triangular, solve_upper_triangular
+
+
+def random_states(kf, n=16):
+    rng = np.random.RandomState(0)
+    measurements = rng.rand(n, 4) * np.array([600., 300., 1., 100.]) + np.array([0., 0., 0.2, 20.])
+    states = [kf.initiate(m) for m in measurements]
+    states = [kf.predict(mean, cov) for mean, cov in states]
+    means = np.stack([mean for mean, _ in states])
+    covariances = np.stack([cov for _, cov in states])
+    return means, covariances, measurements + rng.randn(n, 4)
+
+
+def test_triangular_solves():
+    rng = np.random.RandomState(0)
+    a = rng.rand(10, 4, 4)
+    lower = np.linalg.cholesky(np.matmul(a, a.transpose((0, 2, 1))) + 4 * np.eye(4))
+    b = rng.rand(10, 4, 8)
+
+    np.testing.assert_allclose(solve_lower_triangular(lower, b), np.linalg.solve(lower, b), rtol=1e-9)
+    upper = lower.transpose((0, 2, 1))
+    np.testing.assert_allclose(solve_upper_triangular(upper, b), np.linalg.solve(upper, b), rtol=1e-9)
+
+
+def test_multi_update_matches():
+    kf = KalmanFilter()
+    means, covariances, measurements = random_states(kf)
+
+    new_means, new_covariances = kf.multi_update(means, covariances, measurements)
+    for i in range(len(means)):
+        ref_mean, ref_cov = kf.update(means[i], covariances[i], measurements[i])
+        np.testing.assert_allclose(new_means[i], ref_mean, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(new_covariances[i], ref_cov, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,54 @@
+# encoding=utf-8
+"""
+Multi-stream tracking(and the TrackerPool) rejects the inputs it cannot track up front.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from tracker.multitracker import MCJDETracker
+from tracker.tracker_pool import TrackerPool
+
+
+def make_tracker(feat_out_ids):
+    tracker = MCJDETracker.__new__(MCJDETracker)  # no weights to load: only the model's settings are read
+    tracker.model = SimpleNamespace(feat_out_ids=feat_out_ids)
+    tracker.backends = [None, None]
+    tracker.frame_id = 0
+    return tracker
+
+
+def test_count_mismatch():
+    tracker = make_tracker([-1])
+    imgs = torch.zeros(2, 3, 64, 64)
+    img0s = [np.zeros((64, 64, 3), dtype=np.uint8)]
+    with pytest.raises(ValueError):
+        tracker.update_tracks_multi_stream(imgs, img0s)
+    assert tracker.frame_id == 0
+
+
+def test_multi_feature_maps():
+    tracker = make_tracker([-1, -2, -3])
+    imgs = torch.zeros(2, 3, 64, 64)
+    img0s = [np.zeros((64, 64, 3), dtype=np.uint8)] * 2
+    with pytest.raises(ValueError):
+        tracker.update_tracks_multi_stream(imgs, img0s)
+
+
+def test_unsupported_mode():
+    tracker = make_tracker([-1])
+    with pytest.raises(ValueError):
+        tracker.update_tracks_multi_stream(torch.zeros(2, 3, 64, 64), [None, None], mode='fair')
+
+
+def test_pool_rejects_bad_streams():
+    pool = TrackerPool(make_tracker([-1]), byte_args=None)
+    imgs = torch.zeros(2, 3, 64, 64)
+    img0s = [np.zeros((64, 64, 3), dtype=np.uint8)] * 2
+    with pytest.raises(ValueError):
+        pool.update(['cam0'], imgs, img0s)
+    with pytest.raises(ValueError):
+        pool.update(['cam0', 'cam0'], imgs, img0s)
+    assert len(pool) == 0
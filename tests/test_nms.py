@@ -0,0 +1,35 @@
+# encoding=utf-8
+"""
+The NMS variants share the batched NMS: the same detections, with the yolo layer indices(and grids)
+of the kept candidates.
+"""
+import torch
+
+from utils.utils import non_max_suppression, non_max_suppression_with_yolo_inds, non_max_suppression_debug
+
+
+def random_predictions(B=3, N=500, nc=5):
+    torch.manual_seed(0)
+    xy = torch.rand(B, N, 2) * 300
+    wh = torch.rand(B, N, 2) * 60 + 10
+    obj = torch.rand(B, N, 1)
+    cls = torch.rand(B, N, nc)
+    return torch.cat((xy, wh, obj, cls), 2)
+
+
+def test_nms_debug_matches():
+    predictions = random_predictions()
+    yolo_inds = torch.randint(0, 3, (3, 500, 1))
+    grids = predictions[..., :2].clone()  # box centers: identify the kept candidates
+
+    ref = non_max_suppression(predictions.clone(), conf_thres=0.3, iou_thres=0.5)
+    _, ref_yolo_inds = non_max_suppression_with_yolo_inds(predictions.clone(), yolo_inds,
+                                                          conf_thres=0.3, iou_thres=0.5)
+    dets, out_yolo_inds, out_grids = non_max_suppression_debug(predictions.clone(), yolo_inds, grids,
+                                                               conf_thres=0.3, iou_thres=0.5)
+
+    assert len(dets) == len(ref) == 3
+    for det, r, y, r_y, g in zip(dets, ref, out_yolo_inds, ref_yolo_inds, out_grids):
+        assert torch.equal(det, r)
+        assert torch.equal(y, r_y)
+        assert torch.allclose(g, (det[:, :2] + det[:, 2:4]) / 2, atol=1e-3)
@@ -0,0 +1,40 @@
+# encoding=utf-8
+"""
+The ONNX export(save_onnx) run by OnnxDarknet gives the eager model's decoded detections and reid feature maps,
+with dense and sparse decoding.
+"""
+import pytest
+import torch
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from models import Darknet, OnnxDarknet, save_onnx
+
+
+@pytest.mark.parametrize('cfg, mode', [('cfg/yolov4-tiny.cfg', 'detect'),
+                                       ('cfg/yolov4-paspp-mcmot.cfg', 'track')])
+def test_onnx_matches_eager(tmp_path, cfg, mode):
+    torch.manual_seed(0)
+    max_id_dict = {cls_id: 10 for cls_id in range(5)} if mode == 'track' else None
+    model = Darknet(cfg, (192, 320), verbose=False, max_id_dict=max_id_dict, mode=mode).eval()
+    path = str(tmp_path / 'model.onnx')
+    save_onnx(model, (192, 320), path)  # fuses the model in place
+
+    runner = OnnxDarknet(path)
+    assert runner.mode == mode
+    x = torch.rand(2, 3, 192, 320)
+
+    for conf_thres in (None, 0.01):  # dense, sparse decoding
+        model.sparse_decode(conf_thres)
+        runner.sparse_decode(conf_thres)
+        with torch.no_grad():
+            ref = model(x)
+            out = runner(x)
+
+        assert len(out) == len(ref)
+        assert out[0].shape == ref[0].shape and out[0].shape[0] > 0
+        assert torch.allclose(out[0], ref[0], rtol=1e-3, atol=1e-2)  # boxes in net input pixels
+        if mode == 'track':
+            assert len(out[2]) == len(ref[2]) == 1
+            assert torch.allclose(out[2][0], ref[2][0], rtol=1e-3, atol=1e-4)
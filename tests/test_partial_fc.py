@@ -0,0 +1,32 @@
+# encoding=utf-8
+"""
+PartialFC.step applies the same update as a dense SGD step(momentum, weight decay) on the full weight,
+also when rows are sampled by several backward passes before the step.
+"""
+import torch
+
+from utils.layers import PartialFC
+
+
+def test_step_matches_dense_sgd():
+    torch.manual_seed(0)
+    fc = PartialFC(8, 40, sample_rate=0.25, margin=False)
+    weight = torch.nn.Parameter(fc.weight_store.clone())
+    sgd = torch.optim.SGD([weight], lr=0.1, momentum=fc.momentum, weight_decay=fc.weight_decay)
+
+    for _ in range(3):  # steps
+        sgd.zero_grad()
+        for _ in range(4):  # accumulated backward passes: overlapping sampled rows
+            labels = torch.randint(0, 40, (6,))
+            x = torch.randn(6, 8)
+            sub_weight, local_labels = fc.sample(labels)
+            (x @ sub_weight.t()).gather(1, local_labels.view(-1, 1)).sum().backward()
+            (x @ weight.t()).gather(1, labels.view(-1, 1)).sum().backward()
+
+        # the dense step updates the rows never sampled too(weight decay, momentum): compare the sampled ones
+        sampled = torch.unique(torch.cat([index for index, _ in fc.pending]))
+        fc.step(0.1)
+        sgd.step()
+        assert torch.allclose(fc.weight_store[sampled], weight.data[sampled], atol=1e-6)
+        fc.weight_store.copy_(weight.data)
+        fc.momentum_store.copy_(sgd.state[weight]['momentum_buffer'])
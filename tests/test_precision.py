@@ -0,0 +1,27 @@
+# encoding=utf-8
+"""
+bf16 / channels_last inference(Darknet.set_precision) returns fp32 outputs close to the fp32 model's.
+"""
+import pytest
+import torch
+
+from models import Darknet
+
+
+@pytest.mark.parametrize('precision, memory_format', [('fp32', 'channels_last'),
+                                                      ('bf16', 'contiguous'),
+                                                      ('bf16', 'channels_last')])
+def test_precision_detect(precision, memory_format):
+    torch.manual_seed(0)
+    model = Darknet('cfg/yolov4-tiny.cfg', (192, 320), verbose=False, mode='detect').eval()
+    x = torch.rand(1, 3, 192, 320)
+
+    with torch.no_grad():
+        ref, _ = model(x)
+        model.set_precision(precision, memory_format)
+        out, _ = model(x)
+
+    assert out.dtype == torch.float32
+    atol = 1e-4 if precision == 'fp32' else 0.5  # boxes in net input pixels, bf16 has an 8 bit mantissa
+    assert torch.allclose(out[..., :4], ref[..., :4], atol=atol, rtol=1e-2)
+    assert torch.allclose(out[..., 4:], ref[..., 4:], atol=atol / 10)
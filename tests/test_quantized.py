@@ -0,0 +1,33 @@
+# encoding=utf-8
+"""
+The int8 quantized artifact loads on cpu, and a non-cpu device is rejected up front.
+"""
+import pytest
+import torch
+
+from models import Darknet, prepare_quantization, convert_quantization, save_fused, load_fused
+
+
+def test_quantized_artifact_device(tmp_path):
+    torch.manual_seed(0)
+    model = Darknet('cfg/yolov4-tiny.cfg', (192, 320), verbose=False, mode='detect').eval()
+    x = torch.rand(1, 3, 192, 320)
+
+    prepare_quantization(model)
+    with torch.no_grad():
+        for _ in range(2):  # calibration
+            model(torch.rand(1, 3, 192, 320))
+    convert_quantization(model)
+    with torch.no_grad():
+        ref, _ = model(x)
+
+    path = str(tmp_path / 'int8.pt')
+    save_fused(model, path)
+
+    with pytest.raises(ValueError):
+        load_fused(path, 'cuda:0')
+
+    quantized = load_fused(path, 'cpu')
+    with torch.no_grad():
+        out, _ = quantized(x)
+    assert torch.equal(out, ref)
@@ -0,0 +1,118 @@
+# encoding=utf-8
+"""
+The packed multi-class reid losses equal the per class loops they replace(losses and classifier gradients).
+"""
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils.layers import ArcMargin
+from utils.utils import packed_id_logits, packed_id_loss, packed_ghmc_loss
+
+N_IDS = [30, 7, 50, 1, 12]  # track ids of the 5 object classes of yolov4-paspp-mcmot.cfg
+
+
+def loop_id_loss(id_vects, cls_ids, tr_ids, id_classifiers, fc_type):
+    """
+    The per class reid loss of compute_loss_with_ids before packing(reference)
+    """
+    CE_reid = nn.CrossEntropyLoss()
+    l_reid = id_vects.new_zeros(1)
+    for cls_id, classifier in enumerate(id_classifiers):
+        inds = torch.where(cls_ids == cls_id)
+        if inds[0].shape[0] == 0:
+            continue
+
+        if fc_type == 'FC':
+            fc_preds = classifier.forward(id_vects[inds]).contiguous()
+        else:
+            fc_preds = classifier.forward(id_vects[inds], tr_ids[inds]).contiguous()
+        l_reid += CE_reid(fc_preds, tr_ids[inds])
+
+    return l_reid
+
+
+def ghmc(pred, target, bins=100):
+    """
+    GHMC.forward(momentum 0, all labels valid) on any device(reference)
+    """
+    edges = torch.arange(bins + 1, device=pred.device).float() / bins
+    edges[-1] += 1e-6
+    weights = torch.zeros_like(pred, dtype=torch.float32)
+    g = torch.abs(pred.sigmoid().detach() - target)
+    tot = max(float(pred.numel()), 1.0)
+
+    n = 0  # n valid bins
+    for i in range(bins):
+        inds = (g >= edges[i]) & (g < edges[i + 1])
+        num_in_bin = inds.sum().item()
+        if num_in_bin > 0:
+            weights[inds] = tot / num_in_bin
+            n += 1
+    if n > 0:
+        weights = weights / n
+
+    return F.binary_cross_entropy_with_logits(pred, target, weights, reduction='sum') / tot
+
+
+def loop_ghmc_loss(id_vects, cls_ids, tr_ids, id_classifiers, fc_type):
+    """
+    The per class GHM-C reid loss of compute_loss_one_layer before vectorizing(reference)
+    """
+    logits, targets, _, offsets = packed_id_logits(id_vects, cls_ids, tr_ids, id_classifiers, fc_type)
+    bounds = offsets.tolist() + [logits.shape[1]]  # each class's column block
+
+    l_reid = id_vects.new_zeros(1)
+    for cls_id in range(len(id_classifiers)):
+        inds = torch.where(cls_ids == cls_id)
+        if inds[0].shape[0] == 0:
+            continue
+
+        fc_preds = logits[inds][:, bounds[cls_id]:bounds[cls_id + 1]]
+        target = torch.zeros_like(fc_preds)
+        target.scatter_(1, (targets[inds] - bounds[cls_id]).view(-1, 1), 1)
+        l_reid += ghmc(fc_preds, target)
+
+    return l_reid
+
+
+def ghmc_id_loss(id_vects, cls_ids, tr_ids, id_classifiers, fc_type):
+    """
+    The GHM-C reid loss of compute_loss_one_layer
+    """
+    logits, targets, col_cls, _ = packed_id_logits(id_vects, cls_ids, tr_ids, id_classifiers, fc_type)
+    return packed_ghmc_loss(logits, targets, cls_ids, col_cls)
+
+
+def make_batch(fc_type, n_gt=64, dim=16):
+    torch.manual_seed(0)
+    if fc_type == 'FC':
+        id_classifiers = nn.ModuleList([nn.Linear(dim, n) for n in N_IDS])
+    else:
+        id_classifiers = nn.ModuleList([ArcMargin(dim, n, device='cpu', m=0.1) for n in N_IDS])
+
+    cls_ids = torch.randint(0, len(N_IDS) - 1, (n_gt,))  # the last class has no GT
+    tr_ids = (torch.rand(n_gt) * torch.tensor(N_IDS)[cls_ids]).long()
+    feats = torch.randn(n_gt, dim)
+    return id_classifiers, F.normalize(feats, dim=1), cls_ids, tr_ids
+
+
+@pytest.mark.parametrize('fc_type', ['FC', 'Arc'])
+@pytest.mark.parametrize('loss_funcs', [(loop_id_loss, packed_id_loss), (loop_ghmc_loss, ghmc_id_loss)],
+                         ids=['ce', 'ghmc'])
+def test_packed_loss_matches_loop(fc_type, loss_funcs):
+    id_classifiers, id_vects, cls_ids, tr_ids = make_batch(fc_type)
+
+    losses, grads = [], []
+    for loss_func in loss_funcs:
+        id_classifiers.zero_grad()
+        loss = loss_func(id_vects, cls_ids, tr_ids, id_classifiers, fc_type)
+        loss.backward()
+        losses.append(loss.item())
+        # the classifiers of the classes without GT: no gradient in the loop, zero gradient when packed
+        grads.append([torch.zeros_like(p) if p.grad is None else p.grad.clone() for p in id_classifiers.parameters()])
+
+    assert losses[0] == pytest.approx(losses[1], rel=1e-5)
+    for g_loop, g_packed in zip(*grads):
+        assert torch.allclose(g_loop, g_packed, atol=1e-6)
@@ -0,0 +1,56 @@
+# encoding=utf-8
+"""
+Planned route concatenation(Darknet.plan_concat) gives the same outputs as the torch.cat routes.
+"""
+import pytest
+import torch
+
+from models import Darknet
+
+CFGS = ['cfg/yolov4-tiny.cfg',
+        'cfg/yolov4-pacsp-s.cfg',
+        'cfg/yolov4-pacsp-mish.cfg',
+        'cfg/yolov4-paspp-mcmot.cfg']
+
+
+@pytest.mark.parametrize('cfg', CFGS)
+def test_planned_concat_matches_cat(cfg):
+    torch.manual_seed(0)
+    model = Darknet(cfg, (192, 320), verbose=False, mode='detect').eval()
+    x = torch.rand(2, 3, 192, 320)
+
+    with torch.no_grad():
+        model.plan_concat(False)
+        ref, ref_p = model(x)
+
+        model.plan_concat(True)
+        assert any(route is not None for route in model.concat_plan['routes'])
+        out, out_p = model(x)
+        bufs = {i: buf.data_ptr() for i, buf in model.concat_bufs.items()}
+
+        # the buffers are reused by the next forward and do not alias the returned outputs
+        out2, out2_p = model(x)
+        assert {i: buf.data_ptr() for i, buf in model.concat_bufs.items()} == bufs
+
+    assert torch.equal(out, ref)
+    assert torch.equal(out2, ref)
+    for o, o2, r in zip(out_p, out2_p, ref_p):
+        assert torch.equal(o, r)
+        assert torch.equal(o2, r)
+
+
+def test_planned_concat_batch_change():
+    torch.manual_seed(0)
+    model = Darknet('cfg/yolov4-tiny.cfg', (192, 320), verbose=False, mode='detect').eval()
+    model.plan_concat(True)
+    plan = model.concat_plan
+
+    with torch.no_grad():
+        for bs in (1, 3, 1):  # the buffers are re-allocated when the batch size changes
+            x = torch.rand(bs, 3, 192, 320)
+            model.concat_plan = None
+            ref, _ = model(x)
+            model.concat_plan = plan
+            out, _ = model(x)
+            assert torch.equal(out, ref)
+            assert all(buf.shape[0] == bs for buf in model.concat_bufs.values())
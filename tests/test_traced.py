@@ -0,0 +1,25 @@
+# encoding=utf-8
+"""
+The traced model gives the eager model's detections and rejects a net input size it was not traced with.
+"""
+import pytest
+import torch
+
+from models import Darknet, save_traced, load_traced
+
+
+def test_traced_input_size(tmp_path):
+    torch.manual_seed(0)
+    model = Darknet('cfg/yolov4-tiny.cfg', (192, 320), verbose=False, mode='detect').eval()
+    path = str(tmp_path / 'model.torchscript')
+    save_traced(model, (192, 320), path)
+
+    with pytest.raises(ValueError):
+        load_traced(path, img_size=(320, 192))
+
+    traced = load_traced(path, img_size=(192, 320))
+    x = torch.rand(1, 3, 192, 320)
+    with torch.no_grad():
+        assert torch.allclose(traced(x)[0], model(x)[0], atol=1e-4)
+        with pytest.raises(ValueError):
+            traced(torch.rand(1, 3, 224, 320))
@@ -0,0 +1,55 @@
+# encoding=utf-8
+"""
+VideoSink writes the queued frames, and reports an encoder that died instead of looking successful.
+"""
+import os
+import stat
+
+import numpy as np
+import pytest
+
+from utils.video_sink import VideoSink
+
+
+def frames(n=5, w=64, h=48):
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 255, (h, w, 3), dtype=np.uint8) for _ in range(n)]
+
+
+def test_cv2_backend(tmp_path):
+    path = str(tmp_path / 'out.mp4')
+    sink = VideoSink(path, 12, backend='cv2')
+    for frame in frames():
+        sink.write(frame)
+
+    assert sink.close() == 5
+    assert os.path.getsize(path) > 0
+
+
+def test_dead_ffmpeg_raises_on_close(tmp_path, monkeypatch):
+    # an "ffmpeg" which exits at once without reading its stdin
+    fake_ffmpeg = tmp_path / 'ffmpeg'
+    fake_ffmpeg.write_text('#!/bin/sh\nexit 1\n')
+    fake_ffmpeg.chmod(fake_ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ.get('PATH', ''))
+
+    sink = VideoSink(str(tmp_path / 'out.mp4'), 12, backend='ffmpeg')
+    assert sink.backend == 'ffmpeg'
+    for frame in frames(n=20, w=640, h=480):  # more than the pipe buffer
+        sink.write(frame)
+
+    with pytest.raises(IOError):
+        sink.close()
+    assert sink.error is not None
+
+
+def test_context_manager_does_not_mask_exceptions(tmp_path, monkeypatch):
+    fake_ffmpeg = tmp_path / 'ffmpeg'
+    fake_ffmpeg.write_text('#!/bin/sh\nexit 1\n')
+    fake_ffmpeg.chmod(fake_ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ.get('PATH', ''))
+
+    with pytest.raises(KeyError):
+        with VideoSink(str(tmp_path / 'out.mp4'), 12, backend='ffmpeg') as sink:
+            sink.write(frames(n=1)[0])
+            raise KeyError('tracking failed')
@@ -7,13 +7,14 @@ import torch
 import torch.nn.functional as F
 from collections import deque, defaultdict
 
+from ByteTracker.byte_tracker import BYTETracker
 from models import *
 from tracker import matching
-from tracker.basetrack import BaseTrack, MCBaseTrack, TrackState
-from tracking_utils.kalman_filter import KalmanFilter
+from tracker.basetrack import BaseTrack, MCBaseTrack, TrackState, TrackIdAllocator
+from tracking_utils.kalman_filter import KalmanFilter, KalmanTrackTable
 from tracking_utils.log import logger
 from tracking_utils.utils import *
-from utils.utils import non_max_suppression  # , cos
+from utils.utils import non_max_suppression, non_max_suppression_sparse, gather_reid_feats  # , cos
 
 
 # Multi-class Track class
@@ -56,7 +57,7 @@ class MCTrack(MCBaseTrack):
         """
         :return:
         """
-        self.reset_track_id(self.cls_id)
+        self.id_allocator.reset_track_id(self.cls_id)
 
     def update_features(self, feat):
         """
@@ -93,6 +94,16 @@ class MCTrack(MCBaseTrack):
         :return:
         """
         if len(tracks) > 0:
+            # batched prediction in place for the tracks bound to track tables
+            track_groups, unbound_inds = MCBaseTrack.group_by_table(tracks)
+            for track_table, inds in track_groups:
+                track_table.predict([tracks[i].slot for i in inds],
+                                    [tracks[i].state != TrackState.Tracked for i in inds])
+
+            tracks = [tracks[i] for i in unbound_inds]
+            if len(tracks) == 0:
+                return
+
             multi_mean = np.asarray([track.mean.copy() for track in tracks])
             multi_covariance = np.asarray([track.covariance for track in tracks])
 
@@ -106,19 +117,25 @@ class MCTrack(MCBaseTrack):
                 tracks[i].mean = mean
                 tracks[i].covariance = cov
 
-    def activate(self, kalman_filter, frame_id):
+    def activate(self, kalman_filter, frame_id, track_table=None, id_allocator=None):
         """
         Start a new track: the initial activation
         :param kalman_filter:
         :param frame_id:
+        :param track_table: KalmanTrackTable of the object class
+        :param id_allocator: TrackIdAllocator of the owning tracker
         :return:
         """
         self.kalman_filter = kalman_filter  # assign a filter to each track?
+        if id_allocator is not None:
+            self.id_allocator = id_allocator
 
         # update track id for the object class
         self.track_id = self.next_id(self.cls_id)
 
         self.mean, self.covariance = self.kalman_filter.initiate(self.tlwh_to_xyah(self._tlwh))
+        if track_table is not None:  # keep the kalman state in the class's track table
+            self.bind_table(track_table)
 
         self.track_len = 0
         self.state = TrackState.Tracked  # set flag 'tracked'
@@ -129,17 +146,19 @@ class MCTrack(MCBaseTrack):
         self.frame_id = frame_id
         self.start_frame = frame_id
 
-    def re_activate(self, new_track, frame_id, new_id=False):
+    def re_activate(self, new_track, frame_id, new_id=False, update_kalman=True):
         """
         :param new_track:
         :param frame_id:
         :param new_id:
+        :param update_kalman: False if already corrected by multi_update_kalman
         :return:
         """
         # kalman update
-        self.mean, self.covariance = self.kalman_filter.update(self.mean,
-                                                               self.covariance,
-                                                               self.tlwh_to_xyah(new_track.tlwh))
+        if update_kalman:
+            self.mean, self.covariance = self.kalman_filter.update(self.mean,
+                                                                   self.covariance,
+                                                                   self.tlwh_to_xyah(new_track.tlwh))
 
         # feature vector update
         self.update_features(new_track.curr_feat)
@@ -158,19 +177,23 @@ class MCTrack(MCBaseTrack):
 
         self.score = new_track.score
 
-    def update(self, new_track, frame_id, update_feature=True):
+    def update(self, new_track, frame_id, update_feature=True, update_kalman=True):
         """
         Update a matched track
         :type new_track: Track
         :type frame_id: int
         :type update_feature: bool
+        :type update_kalman: bool
         :return:
         """
         self.frame_id = frame_id
         self.track_len += 1
 
-        new_tlwh = new_track.tlwh
-        self.mean, self.covariance = self.kalman_filter.update(self.mean, self.covariance, self.tlwh_to_xyah(new_tlwh))
+        if update_kalman:
+            new_tlwh = new_track.tlwh
+            self.mean, self.covariance = self.kalman_filter.update(self.mean,
+                                                                   self.covariance,
+                                                                   self.tlwh_to_xyah(new_tlwh))
 
         # set flag 'tracked'
         self.state = TrackState.Tracked
@@ -335,14 +358,17 @@ class Track(BaseTrack):
         """
         self.reset_track_count()
 
-    def activate(self, kalman_filter, frame_id):
+    def activate(self, kalman_filter, frame_id, id_allocator=None):
         """
         Start a new tracklet
         :param kalman_filter:
         :param frame_id:
+        :param id_allocator: TrackIdAllocator of the owning tracker
         :return:
         """
         self.kalman_filter = kalman_filter  # assign a filter to each tracklet?
+        if id_allocator is not None:
+            self.id_allocator = id_allocator
 
         # update the track id
         self.track_id = self.next_id()
@@ -458,6 +484,21 @@ class Track(BaseTrack):
 # Multi-class JDETracker
 from train import max_id_dict
 
+# ----- ByteTrack backend modes of multi-stream(batched) tracking
+MULTI_STREAM_MODES = ('byte_emb', 'byte')
+
+
+def check_single_image(img):
+    """
+    The single stream update methods track the first image of the batch only
+    :param img: net input: B×C×H×W
+    :return:
+    """
+    if img.shape[0] != 1:
+        raise ValueError('got a batch of {:d} images for one stream: '
+                         'use update_tracks_multi_stream(or TrackerPool) to track a batch of streams'
+                         .format(img.shape[0]))
+
 
 class MCJDETracker(object):
     def __init__(self, opt):
@@ -469,45 +510,79 @@ class MCJDETracker(object):
         # set device
         device = opt.device
 
-        # model in track mode(do detection and reid feature vector extraction)
-        if self.opt.task == 'track':
-            ## read from .npy(max_id_dict.npy file)
-            max_id_dict_file_path = '/mnt/diskb/even/dataset/MCMOT/max_id_dict.npz'
-            if os.path.isfile(max_id_dict_file_path):
-                load_dict = np.load(max_id_dict_file_path, allow_pickle=True)
-            max_id_dict = load_dict['max_id_dict'][()]
-            print(max_id_dict)
-
-            self.model = Darknet(cfg=opt.cfg,
-                                 img_size=opt.img_size,
-                                 verbose=False,
-                                 max_id_dict=max_id_dict,
-                                 emb_dim=opt.dim,
-                                 fc=opt.fc,
-                                 feat_out_ids=opt.feat_out_ids,
-                                 mode=opt.task).to(device)
-
-        elif self.opt.task == 'detect':
-            self.model = Darknet(cfg=opt.cfg,
-                                 img_size=opt.img_size,
-                                 mode='detect').to(device)
-        # print(self.model)
+        # ----- fused inference artifact(export.py): no cfg parsing, no module creation, no BN folding
+        fused = opt.weights.endswith('.pt') and is_fused_artifact(opt.weights)
+        ckpt = load_checkpoint(opt.weights, 'cpu') if opt.weights.endswith('.pt') and not fused else None
+        if opt.weights.endswith('.torchscript'):  # traced inference module(export.py --format torchscript)
+            self.model = load_traced(opt.weights, device, (opt.net_h, opt.net_w))
+            self.model.mode = opt.task
 
-        # Load checkpoint
-        if opt.weights.endswith('.pt'):  # py-torch format
-            ckpt = torch.load(opt.weights, map_location=device)
-            self.model.load_state_dict(ckpt['model'])
-            if 'epoch' in ckpt.keys():
-                print('Checkpoint of epoch {} loaded.\n'.format(ckpt['epoch']))
-        else:  # dark-net format
-            load_darknet_weights(self.model, opt.weights, int(opt.cutoff))
-            print('{} loaded.'.format(opt.weights))
-        # ----------
+        elif opt.weights.endswith('.onnx'):  # ONNX runtime runner(export.py --format onnx)
+            self.model = OnnxDarknet(opt.weights)
+            self.model.mode = opt.task
+
+        elif fused:
+            self.model = load_fused(opt.weights, device)
+            self.model.mode = opt.task
+            print('Fused model {} loaded.\n'.format(opt.weights))
+
+        else:
+            # model in track mode(do detection and reid feature vector extraction)
+            if self.opt.task == 'track':
+                ## read from .npy(max_id_dict.npy file)
+                max_id_dict_file_path = '/mnt/diskb/even/dataset/MCMOT/max_id_dict.npz'
+                if os.path.isfile(max_id_dict_file_path):
+                    load_dict = np.load(max_id_dict_file_path, allow_pickle=True)
+                max_id_dict = load_dict['max_id_dict'][()]
+                print(max_id_dict)
+
+                self.model = Darknet(cfg=opt.cfg,
+                                     img_size=opt.img_size,
+                                     verbose=False,
+                                     max_id_dict=max_id_dict,
+                                     emb_dim=opt.dim,
+                                     fc=opt.fc,
+                                     feat_out_ids=opt.feat_out_ids,
+                                     mode=opt.task).to(device)
+
+            elif self.opt.task == 'detect':
+                self.model = Darknet(cfg=opt.cfg,
+                                     img_size=opt.img_size,
+                                     mode='detect').to(device)
+            # print(self.model)
+
+            # Load checkpoint
+            if opt.weights.endswith('.pt'):  # py-torch format
+                self.model.load_state_dict(ckpt['model'])
+                if 'epoch' in ckpt.keys():
+                    print('Checkpoint of epoch {} loaded.\n'.format(ckpt['epoch']))
+            elif opt.weights.endswith('.flat'):  # flat(memory-mapped) format
+                load_flat_weights(self.model, opt.weights)
+                print('{} loaded.'.format(opt.weights))
+            else:  # dark-net format
+                load_darknet_weights(self.model, opt.weights, int(opt.cutoff),
+                                     mmap=getattr(opt, 'mmap_weights', False))
+                print('{} loaded.'.format(opt.weights))
+            # ----------
 
         # ----------
         # Put model to device and set eval mode
         self.model.to(device).eval()
 
+        # write route inputs into pre-allocated concat buffers instead of concatenating
+        if getattr(opt, 'planned_concat', False):
+            self.model.plan_concat()
+
+        # decode only the yolo cells above the objectness threshold(sparse candidates)
+        if getattr(opt, 'sparse_decode', False):
+            self.model.sparse_decode(opt.conf_thres)
+
+        # bf16 and(or) channels_last net(converted once, yolo decoding and reid maps stay in fp32)
+        precision = getattr(opt, 'precision', 'fp32')
+        memory_format = getattr(opt, 'memory_format', 'contiguous')
+        if precision != 'fp32' or memory_format != 'contiguous':
+            self.model.set_precision(precision, memory_format)
+
         # ----- image pre-processing method
         self.img_proc_method = opt.img_proc_method
 
@@ -532,9 +607,21 @@ class MCJDETracker(object):
         # init kalman filter(to stabilize tracking)
         self.kalman_filter = KalmanFilter()
 
+        # kalman states of each object class's tracks: dict(int, KalmanTrackTable)
+        self.track_tables = defaultdict(lambda: KalmanTrackTable(self.kalman_filter))
+
+        # track ids of this tracker(independent of other tracker instances)
+        self.id_allocator = TrackIdAllocator()
+
         ## ----- backend
         self.backend = None
 
+        ## ----- per-stream backends for multi-stream(batched) tracking
+        self.backends = []
+
+        # associate all object classes jointly(one assignment per matching round)
+        self.joint_assoc = getattr(opt, 'joint_assoc', False)
+
     def reset(self):
         """
         :return:
@@ -549,6 +636,36 @@ class MCJDETracker(object):
 
         # Reset kalman filter to stabilize tracking
         self.kalman_filter = KalmanFilter()
+        self.track_tables = defaultdict(lambda: KalmanTrackTable(self.kalman_filter))
+
+        # Reset track ids
+        self.id_allocator = TrackIdAllocator()
+
+        # Reset per-stream backends
+        for backend in self.backends:
+            backend.reset()
+
+    def apply_nms(self, pred, batch_size=1):
+        """
+        :param pred: dense(B×N×no) or sparse candidates(n×(2 + no)) inference output of the model
+        :param batch_size: number of images
+        :return: list of dets(n×6: x1, y1, x2, y2, score, cls_id) of each image, None if no objects detected
+        """
+        if pred.dim() == 2:  # sparse candidates
+            pred, _ = non_max_suppression_sparse(candidates=pred,
+                                                 batch_size=batch_size,
+                                                 conf_thres=self.opt.conf_thres,
+                                                 iou_thres=self.opt.iou_thres,
+                                                 classes=self.opt.classes,
+                                                 agnostic=self.opt.agnostic_nms)
+            return pred
+
+        return non_max_suppression(predictions=pred,
+                                   conf_thres=self.opt.conf_thres,
+                                   iou_thres=self.opt.iou_thres,
+                                   merge=False,
+                                   classes=self.opt.classes,
+                                   agnostic=self.opt.agnostic_nms)
 
     def update_detection(self, img, img0):
         """
@@ -556,6 +673,8 @@ class MCJDETracker(object):
         :param img0:
         :return:
         """
+        check_single_image(img)
+
         # ----- do detection only(reid feature vector will not be extracted)
         # only get aggregated result, not original YOLO output
         net_h, net_w = img.shape[2:]
@@ -566,12 +685,7 @@ class MCJDETracker(object):
             pred = pred.float()
 
             # apply NMS
-            pred = non_max_suppression(pred,
-                                       self.opt.conf_thres,
-                                       self.opt.iou_thres,
-                                       merge=False,
-                                       classes=self.opt.classes,
-                                       agnostic=self.opt.agnostic_nms)
+            pred = self.apply_nms(pred, img.shape[0])
             # print(pred)
 
             dets = pred[0]  # assume batch_size == 1 here
@@ -593,14 +707,48 @@ class MCJDETracker(object):
 
         return dets
 
-    def update_track_byte_emb(self, img, img0):
+    def get_dets_feats_dicts(self, dets, reid_feat_map, net_w, net_h, b_idx=0):
+        """
+        Split one image's dets by class and get the reid feature vector
+        at each object's center
+        :param dets: numpy array of n×6: x1, y1, x2, y2, score, cls_id
+        :param reid_feat_map: B×D×H×W reid feature map
+        :param net_w:
+        :param net_h:
+        :param b_idx: batch index of the image
+        :return: boxes dict, scores dict and feats dict(key: cls_id)
+        """
+        feats_dict = defaultdict(list)   # feature dict
+        boxes_dict = defaultdict(list)   # dets dict
+        scores_dict = defaultdict(list)  # scores dict
+
+        # get L2 normalized reid feature vectors of all dets: n×D
+        feats = gather_reid_feats(reid_feat_map, dets, net_w, net_h, b_idx)
+
+        # ----- Fill the dicts
+        for det, id_feat_vect in zip(dets, feats):
+            # up-zip det
+            x1, y1, x2, y2, score, cls_id = det  # 6
+
+            # put into a dets dict
+            boxes_dict[int(cls_id)].append([x1, y1, x2, y2])
+
+            # put int to scores dict
+            scores_dict[int(cls_id)].append(score)
+
+            # put feat vect to dict(key: cls_id)
+            feats_dict[int(cls_id)].append(id_feat_vect)
+
+        return boxes_dict, scores_dict, feats_dict
+
+    def infer_dets_feats_dicts(self, img, img0):
         """
+        Detection and reid feature extraction of the frame for the ByteTrack backend
         :param img:
         :param img0:
-        :return:
+        :return: boxes dict, scores dict and feats dict(key: cls_id), None if no objects detected
         """
-        # update frame id
-        self.frame_id += 1
+        check_single_image(img)
 
         ## ----- Start with context
         with torch.no_grad():
@@ -608,12 +756,7 @@ class MCJDETracker(object):
             pred, pred_orig, reid_feat_out = self.model.forward(img, augment=False)
 
             if len(self.model.feat_out_ids) == 1:
-                pred = non_max_suppression(predictions=pred,
-                                           conf_thres=self.opt.conf_thres,
-                                           iou_thres=self.opt.iou_thres,
-                                           merge=False,
-                                           classes=self.opt.classes,
-                                           agnostic=self.opt.agnostic_nms)
+                pred = self.apply_nms(pred, img.shape[0])
 
             ## ----- Get dets results
             dets = pred[0]  # assume batch_size == 1 here
@@ -634,68 +777,122 @@ class MCJDETracker(object):
                 dets = map_to_orig_coords(dets, self.net_w, self.net_h, img_w, img_h)
 
             ## ----- Get dets dict and reid feature dict
-            feats_dict = defaultdict(list)   # feature dict
-            boxes_dict = defaultdict(list)   # dets dict
-            scores_dict = defaultdict(list)  # scores dict
+            dets_feats_dicts = self.get_dets_feats_dicts(dets, reid_feat_out[0], net_w, net_h)
+        ## ----- End with context----------
+
+        return dets_feats_dicts
+
+    def update_track_byte_emb(self, img, img0):
+        """
+        :param img:
+        :param img0:
+        :return:
+        """
+        return self.track_byte_emb(self.infer_dets_feats_dicts(img, img0))
 
-            # ----- Get reid map
-            reid_feat_map = reid_feat_out[0]  # for one layer feature map
+    def track_byte_emb(self, dets_feats_dicts):
+        """
+        Update tracking result of the frame with its detections using the ByteTrack backend
+        :param dets_feats_dicts: the dicts returned by infer_dets_feats_dicts, None if no objects detected
+        :return:
+        """
+        # update frame id
+        self.frame_id += 1
 
-            # L2 normalize the feature map(feature map scale(1/4 of net input size))
-            reid_feat_map = F.normalize(reid_feat_map, dim=1)
+        if dets_feats_dicts is None:
+            return None
+        boxes_dict, scores_dict, feats_dict = dets_feats_dicts
 
-            # GPU -> CPU
-            reid_feat_map = reid_feat_map.detach().cpu().numpy()
+        ## ---------- Update tracking results of this frame
+        online_targets = self.backend.update_byte_mcmot_emb(boxes_dict, scores_dict, feats_dict)
+        ## ----------
 
-            # get feature map's size
-            b, reid_dim, feat_map_h, feat_map_w = reid_feat_map.shape
+        ## return the frame's tracking results
+        return online_targets
 
-            # ----- Fill the dicts
-            for det in dets:
-                # up-zip det
-                x1, y1, x2, y2, score, cls_id = det  # 6
+    def set_stream_backends(self, byte_args, n_streams, frame_rate=30):
+        """
+        Create one ByteTrack backend(tracking state) for each input stream
+        :param byte_args: ByteTrack args
+        :param n_streams: number of input streams(cameras)
+        :param frame_rate:
+        :return:
+        """
+        self.backends = [BYTETracker(byte_args, frame_rate=frame_rate)
+                         for _ in range(n_streams)]
 
-                # put into a dets dict
-                boxes_dict[int(cls_id)].append([x1, y1, x2, y2])
+    def update_tracks_multi_stream(self, imgs, img0s, backends=None, mode='byte_emb'):
+        """
+        Update tracking results of N streams(cameras) with one forward pass and one NMS call:
+        the i_th image of the batch is dispatched to the i_th stream's backend
+        :param imgs: stacked net input of N streams: N×C×H×W
+        :param img0s: list of N original images(H×W×C)
+        :param backends: list of N stream backends(self.backends if None)
+        :param mode: ByteTrack backend mode of the streams: byte_emb(with reid features) or byte.
+        The fair mode keeps its tracks in the tracker itself: use one MCJDETracker for each stream
+        :return: list of N online targets dict(None if no objects detected in that stream)
+        """
+        if mode not in MULTI_STREAM_MODES:
+            raise ValueError('multi-stream tracking supports the {} modes, got {}: '
+                             'the fair mode tracks one stream per MCJDETracker'
+                             .format(', '.join(MULTI_STREAM_MODES), mode))
 
-                # put int to scores dict
-                scores_dict[int(cls_id)].append(score)
+        if len(self.model.feat_out_ids) != 1:
+            raise ValueError('multi-stream tracking supports one reid feature map, got feat_out_ids {}'
+                             .format(self.model.feat_out_ids))
 
-                # get center point
-                center_x = (x1 + x2) * 0.5
-                center_y = (y1 + y2) * 0.5
+        if backends is None:
+            backends = self.backends
 
-                # map center point from net scale to feature map scale(1/4 of net input size)
-                center_x = center_x / float(net_w)
-                center_x = center_x * float(feat_map_w)
-                center_y = center_y / float(net_h)
-                center_y = center_y * float(feat_map_h)
+        n_streams = imgs.shape[0]
+        if n_streams != len(img0s) or n_streams != len(backends):
+            raise ValueError('number of images, original images and stream backends mismatch: {:d}, {:d}, {:d}'
+                             .format(n_streams, len(img0s), len(backends)))
 
-                # rounding and converting to int64 for indexing
-                center_x += 0.5
-                center_y += 0.5
-                center_x = int(center_x)
-                center_y = int(center_y)
+        # update frame id
+        self.frame_id += 1
 
-                # to avoid the object center out of reid feature map's range
-                center_x = center_x if center_x >= 0 else 0
-                center_x = center_x if center_x < feat_map_w else feat_map_w - 1
-                center_y = center_y if center_y >= 0 else 0
-                center_y = center_y if center_y < feat_map_h else feat_map_h - 1
+        ## ----- Get net size
+        b, c, net_h, net_w = imgs.shape  # net input img size: BCHW
 
-                # get reid feature vector and put into a dict
-                id_feat_vect = reid_feat_map[0, :, center_y, center_x]
-                id_feat_vect = id_feat_vect.squeeze()
-                feats_dict[int(cls_id)].append(id_feat_vect)  # put feat vect to dict(key: cls_id)
+        online_targets_list = []
 
-        ## ----- End with context----------
+        ## ----- Start with context
+        with torch.no_grad():
+            # ----- get dets and ReID feature-map of all streams in one forward pass
+            pred, pred_orig, reid_feat_out = self.model.forward(imgs, augment=False)
 
-        ## ---------- Update tracking results of this frame
-        online_targets = self.backend.update_byte_mcmot_emb(boxes_dict, scores_dict, feats_dict)
-        ## ----------
+            # ----- apply NMS for the whole batch
+            pred = self.apply_nms(pred, imgs.shape[0])
 
-        ## return the frame's tracking results
-        return online_targets
+            ## ----- Dispatch each image's dets and reid features to its stream
+            reid_feat_map = reid_feat_out[0]  # for one layer feature map: N×D×H×W
+            for i, (dets, img0) in enumerate(zip(pred, img0s)):
+                if dets is None:
+                    online_targets_list.append(None)
+                    continue
+                dets = dets.detach().cpu().numpy()
+
+                ## ----- Rescale boxes from net size to img size
+                img_h, img_w, _ = img0.shape  # img0: H×W×C
+                if self.opt.img_proc_method == 'resize':
+                    dets = map_resize_back(dets, self.net_w, self.net_h, img_w, img_h)
+                elif self.opt.img_proc_method == 'letterbox':
+                    dets = map_to_orig_coords(dets, self.net_w, self.net_h, img_w, img_h)
+
+                ## ----- Update tracking results of this stream
+                if mode == 'byte':
+                    online_targets = backends[i].update_byte_mcmot(dets)
+                else:
+                    boxes_dict, scores_dict, feats_dict = self.get_dets_feats_dicts(dets,
+                                                                                    reid_feat_map,
+                                                                                    net_w, net_h,
+                                                                                    b_idx=i)
+                    online_targets = backends[i].update_byte_mcmot_emb(boxes_dict, scores_dict, feats_dict)
+                online_targets_list.append(online_targets)
+        ## ----- End with context----------
+
+        return online_targets_list
 
     def update_track_byte(self, img, img0):
         """
@@ -703,6 +900,8 @@ class MCJDETracker(object):
         :param img0:
         :return:
         """
+        check_single_image(img)
+
         # update frame id
         self.frame_id += 1
 
@@ -716,12 +915,7 @@ class MCJDETracker(object):
                 pred, pred_orig, reid_feat_out = self.model.forward(img, augment=False)
 
             if len(self.model.feat_out_ids) == 1:
-                pred = non_max_suppression(predictions=pred,
-                                           conf_thres=self.opt.conf_thres,
-                                           iou_thres=self.opt.iou_thres,
-                                           merge=False,
-                                           classes=self.opt.classes,
-                                           agnostic=self.opt.agnostic_nms)
+                pred = self.apply_nms(pred, img.shape[0])
 
             ## ----- Get dets results
             dets_results = pred[0]  # assume batch_size == 1 here
@@ -748,20 +942,15 @@ class MCJDETracker(object):
 
         return online_targets
 
-    def update_track_fair(self, img, img0):
+    def infer_dets_feats(self, img, img0):
         """
-        Update tracking result of the frame
+        Detection and reid feature extraction of the frame
         :param img:
         :param img0:
-        :return:
+        :return: dets(n×6 numpy array: x1, y1, x2, y2, score, cls_id) in img0 scale
+        and their L2 normalized reid feature vectors(n×D), None if no objects detected
         """
-        # update frame id
-        self.frame_id += 1
-
-        # ----- reset the track ids for all object classes in the first frame
-        if self.frame_id == 1:
-            MCTrack.init_id_dict(self.opt.num_classes)
-        # -----
+        check_single_image(img)
 
         # Get image size
         img_h, img_w, _ = img0.shape  # H×W×C
@@ -769,16 +958,6 @@ class MCJDETracker(object):
         # Get net size
         b, c, net_h, net_w = img.shape  # B×C×H×W
 
-        ## ---------- Current frame: Record tracking states
-        unconfirmed_dict = defaultdict(list)
-        tracked_tracks_dict = defaultdict(list)
-        track_pool_dict = defaultdict(list)
-        activated_tracks_dict = defaultdict(list)
-        refind_tracks_dict = defaultdict(list)
-        lost_tracks_dict = defaultdict(list)
-        removed_tracks_dict = defaultdict(list)
-        output_tracks_dict = defaultdict(list)
-
         ## ---------- do detection and reid feature extraction
         # only get aggregated result, not original YOLO output
         ## ----- Start with context
@@ -789,12 +968,7 @@ class MCJDETracker(object):
             pred, pred_orig, reid_feat_out = self.model.forward(img, augment=False)
 
             # ----- apply NMS
-            pred = non_max_suppression(predictions=pred,
-                                       conf_thres=self.opt.conf_thres,
-                                       iou_thres=self.opt.iou_thres,
-                                       merge=False,
-                                       classes=self.opt.classes,
-                                       agnostic=self.opt.agnostic_nms)
+            pred = self.apply_nms(pred, img.shape[0])
 
             ## get dets
             dets = pred[0]  # assume batch_size == 1 here
@@ -808,202 +982,70 @@ class MCJDETracker(object):
             elif self.opt.img_proc_method == 'letterbox':
                 dets = map_to_orig_coords(dets, self.net_w, self.net_h, img_w, img_h)
 
-            ## ----- Get dets dict and reid feature dict
-            feats_dict = defaultdict(list)  # feature dict
-            dets_dict = defaultdict(list)  # dets dict
-
-            # get reid map
-            reid_feat_map = reid_feat_out[0]  # for one layer feature map
-
-            # L2 normalize the feature map(feature map scale(1/4 of net input size))
-            reid_feat_map = F.normalize(reid_feat_map, dim=1)
-
-            # GPU -> CPU
-            reid_feat_map = reid_feat_map.detach().cpu().numpy()
-
-            # get feature map's size
-            b, reid_dim, feat_map_h, feat_map_w = reid_feat_map.shape
-
             dets = dets.detach().cpu().numpy()
-            for det in dets:
-                # up-zip det
-                x1, y1, x2, y2, conf, cls_id = det  # 6
-
-                # put into a dict into dict
-                dets_dict[int(cls_id)].append(det)
-
-                # get center point
-                center_x = (x1 + x2) * 0.5
-                center_y = (y1 + y2) * 0.5
 
-                # map center point from net scale to feature map scale(1/4 of net input size)
-                center_x = center_x / float(net_w)
-                center_x = center_x * float(feat_map_w)
-                center_y = center_y / float(net_h)
-                center_y = center_y * float(feat_map_h)
-
-                # rounding and converting to int64 for indexing
-                center_x += 0.5
-                center_y += 0.5
-                center_x = int(center_x)
-                center_y = int(center_y)
-
-                # to avoid the object center out of reid feature map's range
-                center_x = center_x if center_x >= 0 else 0
-                center_x = center_x if center_x < feat_map_w else feat_map_w - 1
-                center_y = center_y if center_y >= 0 else 0
-                center_y = center_y if center_y < feat_map_h else feat_map_h - 1
-
-                # get reid feature vector and put into a dict
-                id_feat_vect = reid_feat_map[0, :, center_y, center_x]
-                id_feat_vect = id_feat_vect.squeeze()
-                feats_dict[int(cls_id)].append(id_feat_vect)  # put feat vect to dict(key: cls_id)
+            # get L2 normalized reid feature vectors of all dets(for one layer feature map)
+            feats = gather_reid_feats(reid_feat_out[0], dets, net_w, net_h)
         ## ----- End with context----------
 
-        ## ---------- Process each object class
-        for cls_id in range(self.opt.num_classes):
-            cls_dets = dets_dict[cls_id]
-            cls_dets = np.array(cls_dets)
-
-            cls_id_feat = feats_dict[cls_id]  # n_objs × 128
-            cls_id_feat = np.array(cls_id_feat)
-
-            if len(cls_dets) > 0:
-                '''Detections, tlbrs: top left bottom right score'''
-                cls_detections = [
-                    MCTrack(MCTrack.tlbr_to_tlwh(tlbrs[:4]), tlbrs[4], feat, cls_id, 30)
-                    for (tlbrs, feat) in
-                    zip(cls_dets[:, :5], cls_id_feat)
-                ]  # convert detection of current frame to track format
-            else:
-                cls_detections = []
-
-            '''Add newly detected tracks(current frame) to tracked_tracks'''
-            ## 分类: 将历史的tracked_tracks按照是否activated分为
-            # 当前帧的unconfirmed和tracked
-            for track in self.tracked_tracks_dict[cls_id]:
-                if not track.is_activated:
-                    unconfirmed_dict[cls_id].append(track)  # record unconfirmed tracks in this frame
-                else:
-                    tracked_tracks_dict[cls_id].append(track)  # record tracked tracks of this frame
-
-            '''Step 2: First association, with embedding'''
-            ## ----- build current frame's track pool by joining tracked_tracks and lost tracks
-            track_pool_dict[cls_id] = join_tracks(tracked_tracks_dict[cls_id], self.lost_tracks_dict[cls_id])
-
-            # Predict the current location with KF
-            # for track in track_pool:
-
-            ## ----- kalman prediction for track_pool
-            MCTrack.multi_predict(track_pool_dict[cls_id])         # predict all track-lets
-            # MCTrack.multi_predict(tracked_tracks_dict[cls_id])   # predict only activated track-lets
-
-            dists = matching.embedding_distance(track_pool_dict[cls_id], cls_detections)
-            dists = matching.fuse_motion(self.kalman_filter, dists, track_pool_dict[cls_id], cls_detections)
-            matches, u_track, u_detection = matching.linear_assignment(dists, thresh=0.7)  # thresh=0.7
-
-            # --- process matched pairs between track pool and current frame detection
-            for i_tracked, i_det in matches:
-                track = track_pool_dict[cls_id][i_tracked]
-                det = cls_detections[i_det]
-
-                if track.state == TrackState.Tracked:
-                    track.update(det, self.frame_id)
-                    activated_tracks_dict[cls_id].append(track)  # for multi-class
-                else:  # re-activate the lost track
-                    track.re_activate(det, self.frame_id, new_id=False)
-                    refind_tracks_dict[cls_id].append(track)
-
-            '''Step 3: Second association, with IOU'''
-            # match between track pool and unmatched detection in current frame
-            cls_detections = [cls_detections[i] for i in u_detection]
-            r_tracked_tracks = [track_pool_dict[cls_id][i]
-                                for i in u_track if track_pool_dict[cls_id][i].state == TrackState.Tracked]
-
-            dists = matching.iou_distance(r_tracked_tracks, cls_detections)
-            matches, u_track, u_detection = matching.linear_assignment(dists, thresh=0.5)  # thresh=0.5
-
-            ## ----- process matched tracks
-            for i_tracked, i_det in matches:
-                track = r_tracked_tracks[i_tracked]
-                det = cls_detections[i_det]
-
-                if track.state == TrackState.Tracked:
-                    track.update(det, self.frame_id)
-                    activated_tracks_dict[cls_id].append(track)
-                else:
-                    track.re_activate(det, self.frame_id, new_id=False)
-                    refind_tracks_dict[cls_id].append(track)
-
-            ## ----- mark the track lost if two matching rounds failed
-            for i in u_track:
-                track = r_tracked_tracks[i]
-                if not track.state == TrackState.Lost:
-                    track.mark_lost()  # mark unmatched track as lost track
-                    lost_tracks_dict[cls_id].append(track)
-
-            '''The 3rd matching(The final matching round):
-             Deal with unconfirmed tracks, usually tracks with only one beginning frame'''
-            cls_detections = [cls_detections[i] for i in u_detection]  # current frame's unmatched detection
+        return dets, feats
 
-            ## ----- compute iou matching cost
-            dists = matching.iou_distance(unconfirmed_dict[cls_id], cls_detections)
-            matches, u_unconfirmed, u_detection = matching.linear_assignment(dists, thresh=0.7)  # thresh=0.7
-
-            ## ----- process the matched
-            for i_tracked, i_det in matches:
-                unconfirmed_det = cls_detections[i_det]
-                unconfirmed_track = unconfirmed_dict[cls_id][i_tracked]
-
-                unconfirmed_track.update(cls_detections[i_det], self.frame_id)
-                activated_tracks_dict[cls_id].append(unconfirmed_track)
-
-            ## ----- process the frame's [un-matched tracks]
-            for i in u_unconfirmed:
-                track = unconfirmed_dict[cls_id][i]
-                track.mark_removed()
-                removed_tracks_dict[cls_id].append(track)
-
-            """ Step 4: Init new tracks"""
-            ## ----- process the frame's [un-matched detections]
-            for i_new in u_detection:
-                track = cls_detections[i_new]
-                if track.score < self.det_thresh:
-                    continue
+    def update_track_fair(self, img, img0):
+        """
+        Update tracking result of the frame
+        :param img:
+        :param img0:
+        :return:
+        """
+        return self.track_fair(self.infer_dets_feats(img, img0))
 
-                # initial activation: tracked state
-                track.activate(self.kalman_filter, self.frame_id)
+    def track_fair(self, dets_feats):
+        """
+        Update tracking result of the frame with its detections
+        :param dets_feats: (dets, feats) returned by infer_dets_feats, None if no objects detected
+        :return:
+        """
+        # update frame id
+        self.frame_id += 1
 
-                # activated_tarcks_dict may contain track with 'is_activated' False
-                activated_tracks_dict[cls_id].append(track)
+        # ----- reset the track ids for all object classes in the first frame
+        if self.frame_id == 1:
+            self.id_allocator.init_id_dict(self.opt.num_classes)
+        # -----
 
-            """ Step 5: Update state for lost tracks: 
-            remove some lost tracks that lost more than max_time(30 frames by default)
-            """
-            for lost_track in self.lost_tracks_dict[cls_id]:
-                if self.frame_id - lost_track.end_frame > self.max_time_lost:
-                    lost_track.mark_removed()
-                    removed_tracks_dict[cls_id].append(lost_track)
-            # print('Remained match {} s'.format(t4-t3))
+        if dets_feats is None:
+            return None
+        dets, feats = dets_feats
 
-            """Final: Post processing"""
-            self.tracked_tracks_dict[cls_id] = [t for t in self.tracked_tracks_dict[cls_id] if
-                                                t.state == TrackState.Tracked]
-            self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id],
-                                                           activated_tracks_dict[cls_id])  # add activated track
-            self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id],
-                                                           refind_tracks_dict[cls_id])  # add refined track
-            self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id],
-                                                       self.tracked_tracks_dict[cls_id])  # update lost tracks
-            self.lost_tracks_dict[cls_id].extend(lost_tracks_dict[cls_id])
-            self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id], self.removed_tracks_dict[cls_id])
-            self.removed_tracks_dict[cls_id].extend(removed_tracks_dict[cls_id])
-            self.tracked_tracks_dict[cls_id], self.lost_tracks_dict[cls_id] = remove_duplicate_tracks(
-                self.tracked_tracks_dict[cls_id],
-                self.lost_tracks_dict[cls_id])
+        ## ---------- Current frame: Record tracking states
+        activated_tracks_dict = defaultdict(list)
+        refind_tracks_dict = defaultdict(list)
+        lost_tracks_dict = defaultdict(list)
+        removed_tracks_dict = defaultdict(list)
+        output_tracks_dict = defaultdict(list)
 
-            # get scores of lost tracks
-            output_tracks_dict[cls_id] = [track for track in self.tracked_tracks_dict[cls_id] if track.is_activated]
+        ## ---------- Steps 2 - 4 of each class group(all classes for joint association)
+        for class_ids in self.class_groups():
+            ## ----- the dets of the classes(class by class, stable)
+            inds = np.where(np.isin(dets[:, 5].astype(np.int64), class_ids))[0]
+            inds = inds[np.argsort(dets[inds, 5], kind='stable')]
+            detections = [MCTrack(MCTrack.tlbr_to_tlwh(dets[i, :4]), dets[i, 4], feats[i], int(dets[i, 5]), 30)
+                          for i in inds]  # convert detection of current frame to track format
+
+            self.associate(class_ids,
+                           detections,
+                           activated_tracks_dict,
+                           refind_tracks_dict,
+                           lost_tracks_dict,
+                           removed_tracks_dict)
+
+        """ Step 5: Update state and post processing of each object class"""
+        for cls_id in range(self.opt.num_classes):
+            output_tracks_dict[cls_id] = self.merge_class_tracks(cls_id,
+                                                                 activated_tracks_dict[cls_id],
+                                                                 refind_tracks_dict[cls_id],
+                                                                 lost_tracks_dict[cls_id],
+                                                                 removed_tracks_dict[cls_id])
 
             # logger.debug('===========Frame {}=========='.format(self.frame_id))
             # logger.debug('Activated: {}'.format(
@@ -1017,6 +1059,178 @@ class MCJDETracker(object):
 
         return output_tracks_dict
 
+    def class_groups(self):
+        """
+        The object classes associated together: all classes at once(joint association)
+        or one class at a time
+        :return: list of class id lists
+        """
+        if self.joint_assoc:
+            return [list(range(self.opt.num_classes))]
+        return [[cls_id] for cls_id in range(self.opt.num_classes)]
+
+    def associate(self,
+                  class_ids,
+                  detections,
+                  activated_tracks_dict,
+                  refind_tracks_dict,
+                  lost_tracks_dict,
+                  removed_tracks_dict):
+        """
+        Steps 2 - 4 of the current frame for the object classes class_ids: the tracks and detections
+        of the classes are associated at once(one block-diagonal cost matrix
+        with class-mismatch costs set to inf for each matching round)
+        :param class_ids: object classes of the association(one class: per-class association)
+        :param detections: the detections of the classes
+        :param activated_tracks_dict: the activated tracks of the current frame(key: cls_id)
+        :param refind_tracks_dict: the re-found tracks of the current frame
+        :param lost_tracks_dict: the newly lost tracks of the current frame
+        :param removed_tracks_dict: the newly removed tracks of the current frame
+        :return:
+        """
+        '''Add newly detected tracks(current frame) to tracked_tracks'''
+        ## 分类: 将历史的tracked_tracks按照是否activated分为
+        # 当前帧的unconfirmed和tracked
+        unconfirmed = []
+        track_pool = []
+        for cls_id in class_ids:
+            cls_tracked_tracks = []
+            for track in self.tracked_tracks_dict[cls_id]:
+                if not track.is_activated:
+                    unconfirmed.append(track)  # record unconfirmed tracks in this frame
+                else:
+                    cls_tracked_tracks.append(track)  # record tracked tracks of this frame
+
+            ## ----- build current frame's track pool by joining tracked_tracks and lost tracks
+            track_pool.extend(join_tracks(cls_tracked_tracks, self.lost_tracks_dict[cls_id]))
+
+        ## ----- kalman prediction for track_pool(batched per track table)
+        MCTrack.multi_predict(track_pool)  # predict all track-lets
+
+        '''Step 2: First association, with embedding'''
+        dists = matching.embedding_distance(track_pool, detections)
+        dists = matching.fuse_motion(self.kalman_filter, dists, track_pool, detections)
+        dists = matching.mask_class_mismatch(dists, track_pool, detections)
+        matches, u_track, u_detection = matching.linear_assignment(dists, thresh=0.7)  # thresh=0.7
+        self.update_matched(track_pool, detections, matches, activated_tracks_dict, refind_tracks_dict)
+
+        '''Step 3: Second association, with IOU'''
+        # match between track pool and unmatched detection in current frame
+        detections = [detections[i] for i in u_detection]
+        r_tracked_tracks = [track_pool[i] for i in u_track if track_pool[i].state == TrackState.Tracked]
+
+        dists = matching.iou_distance(r_tracked_tracks, detections)
+        dists = matching.mask_class_mismatch(dists, r_tracked_tracks, detections)
+        matches, u_track, u_detection = matching.linear_assignment(dists, thresh=0.5)  # thresh=0.5
+        self.update_matched(r_tracked_tracks, detections, matches, activated_tracks_dict, refind_tracks_dict)
+
+        ## ----- mark the track lost if two matching rounds failed
+        for i in u_track:
+            track = r_tracked_tracks[i]
+            if not track.state == TrackState.Lost:
+                track.mark_lost()  # mark unmatched track as lost track
+                lost_tracks_dict[track.cls_id].append(track)
+
+        '''The 3rd matching(The final matching round):
+         Deal with unconfirmed tracks, usually tracks with only one beginning frame'''
+        detections = [detections[i] for i in u_detection]  # current frame's unmatched detection
+
+        ## ----- compute iou matching cost
+        dists = matching.iou_distance(unconfirmed, detections)
+        dists = matching.mask_class_mismatch(dists, unconfirmed, detections)
+        matches, u_unconfirmed, u_detection = matching.linear_assignment(dists, thresh=0.7)  # thresh=0.7
+        self.update_matched(unconfirmed, detections, matches, activated_tracks_dict, refind_tracks_dict)
+
+        ## ----- process the frame's [un-matched tracks]
+        for i in u_unconfirmed:
+            track = unconfirmed[i]
+            track.mark_removed()
+            removed_tracks_dict[track.cls_id].append(track)
+
+        """ Step 4: Init new tracks"""
+        ## ----- process the frame's [un-matched detections]
+        for i_new in u_detection:
+            track = detections[i_new]
+            if track.score < self.det_thresh:
+                continue
+
+            # initial activation: tracked state
+            track.activate(self.kalman_filter, self.frame_id, self.track_tables[track.cls_id], self.id_allocator)
+
+            # activated_tarcks_dict may contain track with 'is_activated' False
+            activated_tracks_dict[track.cls_id].append(track)
+
+    def update_matched(self, tracks, detections, matches, activated_tracks_dict, refind_tracks_dict):
+        """
+        Update the matched tracks with their detections(batched kalman correction):
+        tracked(and unconfirmed) tracks are updated, lost tracks are re-activated
+        :param tracks:
+        :param detections:
+        :param matches: matched (track index, detection index) pairs
+        :param activated_tracks_dict:
+        :param refind_tracks_dict:
+        :return:
+        """
+        # --- batched kalman correction of the matched tracks
+        MCTrack.multi_update_kalman([tracks[i_tracked] for i_tracked, i_det in matches],
+                                    [detections[i_det] for i_tracked, i_det in matches])
+
+        # --- process matched pairs between tracks and current frame detection
+        for i_tracked, i_det in matches:
+            track = tracks[i_tracked]
+            det = detections[i_det]
+
+            if track.state == TrackState.Tracked:
+                track.update(det, self.frame_id, update_kalman=False)
+                activated_tracks_dict[track.cls_id].append(track)  # for multi-class
+            else:  # re-activate the lost track
+                track.re_activate(det, self.frame_id, new_id=False, update_kalman=False)
+                refind_tracks_dict[track.cls_id].append(track)
+
+    def merge_class_tracks(self,
+                           cls_id,
+                           activated_tracks,
+                           refind_tracks,
+                           lost_tracks,
+                           removed_tracks):
+        """
+        Update state for lost tracks and post-process the tracks of one object class
+        :param cls_id:
+        :param activated_tracks: the class's activated tracks of the current frame
+        :param refind_tracks: the class's re-found tracks of the current frame
+        :param lost_tracks: the class's newly lost tracks of the current frame
+        :param removed_tracks: the class's newly removed tracks of the current frame
+        :return: output tracks of the object class
+        """
+        """ Step 5: Update state for lost tracks: 
+        remove some lost tracks that lost more than max_time(30 frames by default)
+        """
+        for lost_track in self.lost_tracks_dict[cls_id]:
+            if self.frame_id - lost_track.end_frame > self.max_time_lost:
+                lost_track.mark_removed()
+                removed_tracks.append(lost_track)
+
+        """Final: Post processing"""
+        self.tracked_tracks_dict[cls_id] = [t for t in self.tracked_tracks_dict[cls_id] if
+                                            t.state == TrackState.Tracked]
+        self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id],
+                                                       activated_tracks)  # add activated track
+        self.tracked_tracks_dict[cls_id] = join_tracks(self.tracked_tracks_dict[cls_id],
+                                                       refind_tracks)  # add refined track
+        self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id],
+                                                   self.tracked_tracks_dict[cls_id])  # update lost tracks
+        self.lost_tracks_dict[cls_id].extend(lost_tracks)
+        self.lost_tracks_dict[cls_id] = sub_tracks(self.lost_tracks_dict[cls_id], self.removed_tracks_dict[cls_id])
+        self.removed_tracks_dict[cls_id].extend(removed_tracks)
+        self.tracked_tracks_dict[cls_id], self.lost_tracks_dict[cls_id] = remove_duplicate_tracks(
+            self.tracked_tracks_dict[cls_id],
+            self.lost_tracks_dict[cls_id])
+
+        # release the track table slots of removed(or dropped) tracks
+        self.track_tables[cls_id].retain(self.tracked_tracks_dict[cls_id] + self.lost_tracks_dict[cls_id])
+
+        return [track for track in self.tracked_tracks_dict[cls_id] if track.is_activated]
+
 
 class JDETracker(object):
     def __init__(self, opt):
@@ -1063,6 +1277,9 @@ class JDETracker(object):
         # ----- using kalman filter to stabilize tracking
         self.kalman_filter = KalmanFilter()
 
+        # track ids of this tracker(independent of other tracker instances)
+        self.id_allocator = TrackIdAllocator()
+
     def reset(self):
         """
         :return:
@@ -1078,6 +1295,9 @@ class JDETracker(object):
         # Reset kalman filter to stabilize tracking
         self.kalman_filter = KalmanFilter()
 
+        # Reset track ids
+        self.id_allocator = TrackIdAllocator()
+
     def update_detection(self, img, img0):
         """
         :param img:
@@ -1215,9 +1435,8 @@ class JDETracker(object):
                 cls_detections = []
 
             # reset the track ids for a different object class in the first frame
-            if self.frame_id == 1:
-                for track in cls_detections:
-                    track.reset_track_id()
+            if self.frame_id == 1 and len(cls_detections) > 0:
+                self.id_allocator.reset_track_id()
 
             ''' Add newly detected tracks(current frame) to tracked_tracks'''
             unconfirmed_dict = defaultdict(list)
@@ -1302,7 +1521,7 @@ class JDETracker(object):
                     continue
 
                 # tracked but not activated
-                track.activate(self.kalman_filter, self.frame_id)  # Note: activate do not set 'is_activated' to be True
+                track.activate(self.kalman_filter, self.frame_id, self.id_allocator)  # Note: activate do not set 'is_activated' to be True
 
                 # activated_tarcks_dict may contain track with 'is_activated' False
                 activated_tracks_dict[cls_id].append(track)
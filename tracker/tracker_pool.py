@@ -0,0 +1,124 @@
+# encoding=utf-8
+
+from collections import OrderedDict
+
+from ByteTracker.byte_tracker import BYTETracker
+from tracker.multitracker import MULTI_STREAM_MODES
+
+
+class TrackerPool(object):
+    """
+    Independent per-stream trackers sharing one MCJDETracker(model):
+    each stream owns its ByteTrack backend(tracks, kalman states and track ids),
+    the frames of many streams are batched into one forward pass of the shared model
+    """
+
+    def __init__(self, tracker, byte_args, frame_rate=30, max_batch_size=16, mode='byte_emb'):
+        """
+        :param tracker: MCJDETracker holding the shared model
+        :param byte_args: ByteTrack args of the per-stream backends
+        :param frame_rate: default frame rate of the streams
+        :param max_batch_size: max number of streams in one forward pass
+        :param mode: ByteTrack backend mode of the streams: byte_emb or byte
+        """
+        if mode not in MULTI_STREAM_MODES:
+            raise ValueError('TrackerPool supports the {} modes, got {}'.format(', '.join(MULTI_STREAM_MODES), mode))
+
+        self.tracker = tracker
+        self.mode = mode
+        self.byte_args = byte_args
+        self.frame_rate = frame_rate
+        self.max_batch_size = max_batch_size
+
+        # per-stream backends: key: stream id, value: BYTETracker
+        self.backends = OrderedDict()
+
+    def __len__(self):
+        """
+        :return:
+        """
+        return len(self.backends)
+
+    def __contains__(self, stream_id):
+        """
+        :param stream_id:
+        :return:
+        """
+        return stream_id in self.backends
+
+    def add_stream(self, stream_id, frame_rate=None):
+        """
+        :param stream_id: hashable id of the stream(camera)
+        :param frame_rate: frame rate of the stream(the pool's default if None)
+        :return: the stream's backend
+        """
+        if stream_id in self.backends:
+            print('[Warning]: stream {} already exists.'.format(stream_id))
+            return self.backends[stream_id]
+
+        if frame_rate is None:
+            frame_rate = self.frame_rate
+
+        self.backends[stream_id] = BYTETracker(self.byte_args, frame_rate=frame_rate)
+        return self.backends[stream_id]
+
+    def remove_stream(self, stream_id):
+        """
+        :param stream_id:
+        :return: the removed backend(None if the stream does not exist)
+        """
+        return self.backends.pop(stream_id, None)
+
+    def reset_stream(self, stream_id):
+        """
+        Reset the tracking state of one stream(e.g. the camera is switched)
+        :param stream_id:
+        :return:
+        """
+        if stream_id not in self.backends:
+            print('[Warning]: stream {} does not exist.'.format(stream_id))
+            return
+
+        self.backends[stream_id].reset()
+
+    def reset(self):
+        """
+        :return:
+        """
+        for backend in self.backends.values():
+            backend.reset()
+
+    def update(self, stream_ids, imgs, img0s):
+        """
+        Update tracking results of the streams' current frames:
+        the streams not in the pool are added on their first frame
+        :param stream_ids: list of N stream ids(no duplicates)
+        :param imgs: stacked net input of N streams: N×C×H×W
+        :param img0s: list of N original images(H×W×C)
+        :return: dict of online targets dict(key: stream id, value: None if no objects detected)
+        """
+        if len(stream_ids) != imgs.shape[0] or len(stream_ids) != len(img0s):
+            raise ValueError('number of stream ids, images and original images mismatch: {:d}, {:d}, {:d}'
+                             .format(len(stream_ids), imgs.shape[0], len(img0s)))
+        if len(set(stream_ids)) != len(stream_ids):
+            raise ValueError('duplicate stream ids in one update: {}'.format(list(stream_ids)))
+
+        for stream_id in stream_ids:
+            if stream_id not in self.backends:
+                self.add_stream(stream_id)
+
+        online_targets_dict = OrderedDict()
+
+        ## ----- Run the shared model on at most max_batch_size streams at a time
+        for start in range(0, len(stream_ids), self.max_batch_size):
+            end = start + self.max_batch_size
+            batch_ids = stream_ids[start:end]
+            online_targets_list = self.tracker.update_tracks_multi_stream(imgs[start:end],
+                                                                          img0s[start:end],
+                                                                          [self.backends[stream_id]
+                                                                           for stream_id in batch_ids],
+                                                                          self.mode)
+            for stream_id, online_targets in zip(batch_ids, online_targets_list):
+                online_targets_dict[stream_id] = online_targets
+
+        return online_targets_dict
@@ -0,0 +1,151 @@
+# encoding=utf-8
+
+from collections import defaultdict
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TrackIdAllocator(object):
+    """
+    Track id allocator owned by one tracker instance:
+    track ids of each object class count from 1, independently of other trackers
+    """
+
+    def __init__(self):
+        self.id_dict = defaultdict(int)  # key: cls_id, value: the last allocated track id
+
+    def init_id_dict(self, num_classes):
+        """
+        Initiate the track id counter for all object classes
+        :param num_classes:
+        """
+        for cls_id in range(num_classes):
+            self.id_dict[cls_id] = 0
+
+    def next_id(self, cls_id=0):
+        """
+        :param cls_id:
+        :return:
+        """
+        self.id_dict[cls_id] += 1
+        return self.id_dict[cls_id]
+
+    def reset_track_id(self, cls_id=0):
+        """
+        :param cls_id:
+        :return:
+        """
+        self.id_dict[cls_id] = 0
+
+
+class KalmanTableTrack(object):
+    """
+    Track whose kalman state can be kept in a slot of a KalmanTrackTable,
+    shared by the multi-class tracks of both trackers
+    """
+    # kalman state: stored in the track table's slot when bound to a KalmanTrackTable
+    track_table = None
+    slot = -1
+    _mean = None
+    _covariance = None
+
+    @property
+    def mean(self):
+        """
+        :return: 8 dimensional mean vector(a view into the track table if bound)
+        """
+        if self.track_table is None:
+            return self._mean
+        return self.track_table.means[self.slot]
+
+    @mean.setter
+    def mean(self, mean):
+        if self.track_table is None:
+            self._mean = mean
+        else:
+            self.track_table.means[self.slot] = mean
+
+    @property
+    def covariance(self):
+        """
+        :return: 8x8 covariance matrix(a view into the track table if bound)
+        """
+        if self.track_table is None:
+            return self._covariance
+        return self.track_table.covariances[self.slot]
+
+    @covariance.setter
+    def covariance(self, covariance):
+        if self.track_table is None:
+            self._covariance = covariance
+        else:
+            self.track_table.covariances[self.slot] = covariance
+
+    def bind_table(self, track_table):
+        """
+        Move the track's kalman state into a slot of the track table
+        :param track_table: KalmanTrackTable
+        :return:
+        """
+        if self.track_table is not None:
+            self.unbind_table()
+
+        self.slot = track_table.alloc(self, self._mean, self._covariance)
+        self.track_table = track_table
+        self._mean, self._covariance = None, None
+
+    def unbind_table(self):
+        """
+        Copy the track's kalman state out of the track table and release the slot
+        :return:
+        """
+        if self.track_table is None:
+            return
+
+        self._mean = self.track_table.means[self.slot].copy()
+        self._covariance = self.track_table.covariances[self.slot].copy()
+        self.track_table.release(self.slot)
+        self.track_table, self.slot = None, -1
+
+    @staticmethod
+    def group_by_table(tracks):
+        """
+        :param tracks:
+        :return: list of (track table, indices of its tracks) and
+        indices of the tracks not bound to any track table
+        """
+        track_groups = OrderedDict()  # key: id of the track table
+        unbound_inds = []
+        for i, track in enumerate(tracks):
+            if track.track_table is None:
+                unbound_inds.append(i)
+            else:
+                track_groups.setdefault(id(track.track_table), (track.track_table, []))[1].append(i)
+
+        return list(track_groups.values()), unbound_inds
+
+    @staticmethod
+    def multi_update_kalman(tracks, new_tracks):
+        """
+        Kalman correction of the matched tracks with the new tracks(detections),
+        batched for the tracks sharing a track table
+        :param tracks:
+        :param new_tracks:
+        :return:
+        """
+        if len(tracks) == 0:
+            return
+
+        measurements = np.asarray([track.tlwh_to_xyah(new_track.tlwh)
+                                   for track, new_track in zip(tracks, new_tracks)])
+
+        track_groups, unbound_inds = KalmanTableTrack.group_by_table(tracks)
+        for track_table, inds in track_groups:
+            track_table.update([tracks[i].slot for i in inds], measurements[inds])
+
+        for i in unbound_inds:
+            track = tracks[i]
+            track.mean, track.covariance = track.kalman_filter.update(track.mean,
+                                                                      track.covariance,
+                                                                      measurements[i])
@@ -19,6 +19,33 @@ chi2inv95 = {
     9: 16.919}
 
 
+def solve_lower_triangular(lower, b):
+    """
+    Batched forward substitution: solves lower @ x = b for T small lower triangular systems
+    :param lower: T×n×n lower triangular matrices(e.g. cholesky factors)
+    :param b: T×n×D right hand sides
+    :return: T×n×D solutions
+    """
+    x = np.empty(b.shape, dtype=np.result_type(lower, b))
+    for i in range(lower.shape[1]):
+        x[:, i] = (b[:, i] - np.einsum('tk,tkd->td', lower[:, i, :i], x[:, :i])) / lower[:, i, i, None]
+    return x
+
+
+def solve_upper_triangular(upper, b):
+    """
+    Batched back substitution: solves upper @ x = b for T small upper triangular systems
+    :param upper: T×n×n upper triangular matrices(e.g. transposed cholesky factors)
+    :param b: T×n×D right hand sides
+    :return: T×n×D solutions
+    """
+    n = upper.shape[1]
+    x = np.empty(b.shape, dtype=np.result_type(upper, b))
+    for i in range(n - 1, -1, -1):
+        x[:, i] = (b[:, i] - np.einsum('tk,tkd->td', upper[:, i, i + 1:], x[:, i + 1:])) / upper[:, i, i, None]
+    return x
+
+
 class KalmanFilter(object):
     """
     A simple Kalman filter for tracking bounding boxes in image space.
@@ -183,10 +210,8 @@ class KalmanFilter(object):
         ]
         sqr = np.square(np.r_[std_pos, std_vel]).T
 
-        motion_cov = []
-        for i in range(len(mean)):
-            motion_cov.append(np.diag(sqr[i]))
-        motion_cov = np.asarray(motion_cov)
+        motion_cov = np.zeros((len(mean), 8, 8))
+        motion_cov[:, np.arange(8), np.arange(8)] = sqr
 
         mean = np.dot(mean, self._motion_mat.T)
         left = np.dot(self._motion_mat, covariance).transpose((1, 0, 2))
@@ -278,3 +303,238 @@ class KalmanFilter(object):
             return squared_maha
         else:
             raise ValueError('invalid distance metric')
+
+    def multi_project(self, mean, covariance):
+        """Project state distributions to measurement space (Vectorized version).
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean matrix of the object states.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrics of the object states.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx4 projected means and Nx4x4 projected covariance
+            matrics of the given state estimates.
+        """
+        std = [
+            self._std_weight_position * mean[:, 3],
+            self._std_weight_position * mean[:, 3],
+            1e-1 * np.ones_like(mean[:, 3]),
+            self._std_weight_position * mean[:, 3]
+        ]
+        sqr = np.square(np.r_[std]).T
+
+        innovation_cov = np.zeros((len(mean), 4, 4))
+        innovation_cov[:, np.arange(4), np.arange(4)] = sqr
+
+        mean = np.dot(mean, self._update_mat.T)
+        covariance = np.matmul(np.matmul(self._update_mat, covariance), self._update_mat.T)
+        return mean, covariance + innovation_cov
+
+    def multi_update(self, mean, covariance, measurement):
+        """Run Kalman filter correction step (Vectorized version):
+        the projected covariances are factorized by one batched Cholesky decomposition.
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional predicted states' mean matrix.
+        covariance : ndarray
+            The Nx8x8 dimensional states' covariance matrics.
+        measurement : ndarray
+            The Nx4 dimensional measurement matrix (x, y, a, h), one row for each state.
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the measurement-corrected state distributions.
+        """
+        projected_mean, projected_cov = self.multi_project(mean, covariance)
+
+        # solve (L L^T) K^T = (P H^T)^T for all states
+        chol_factor = np.linalg.cholesky(projected_cov)
+        b = np.matmul(covariance, self._update_mat.T).transpose((0, 2, 1))
+        kalman_gain = solve_upper_triangular(chol_factor.transpose((0, 2, 1)),
+                                             solve_lower_triangular(chol_factor, b)).transpose((0, 2, 1))
+        innovation = measurement - projected_mean
+
+        new_mean = mean + np.matmul(kalman_gain, innovation[:, :, None])[:, :, 0]
+        new_covariance = covariance - np.matmul(np.matmul(kalman_gain, projected_cov),
+                                                kalman_gain.transpose((0, 2, 1)))
+        return new_mean, new_covariance
+
+    def multi_gating_distance(self,
+                              mean,
+                              covariance,
+                              measurements,
+                              only_position=False,
+                              metric='maha'):
+        """Compute gating distance between T state distributions and D measurements
+        (Vectorized version): all covariances are projected at once and all the
+        triangular systems are solved in one batched call.
+        Parameters
+        ----------
+        :param mean : ndarray
+            The Tx8 dimensional mean matrix of the state distributions.
+        :param covariance : ndarray
+            The Tx8x8 dimensional covariance matrics of the state distributions.
+        :param measurements : ndarray
+            A Dx4 dimensional matrix of D measurements, each in
+            format (x, y, a, h).
+        :param only_position : Optional[bool]
+            If True, distance computation is done with respect to the bounding
+            box center position only.
+        :param metric
+        :return:
+        -------
+        ndarray
+            Returns a TxD matrix, where the (i, j) element contains the
+            squared Mahalanobis distance between the i-th state distribution and
+            `measurements[j]`.
+        """
+        mean, covariance = self.multi_project(mean, covariance)
+        if only_position:
+            mean, covariance = mean[:, :2], covariance[:, :2, :2]
+            measurements = measurements[:, :2]
+
+        d = measurements[None, :, :] - mean[:, None, :]  # T×D×4
+        if metric == 'gaussian':
+            return np.sum(d * d, axis=2)
+        elif metric == 'maha':
+            # solve the T small triangular systems for all D measurements at once
+            cholesky_factor = np.linalg.cholesky(covariance)
+            z = solve_lower_triangular(cholesky_factor, d.transpose((0, 2, 1)))  # T×4×D
+            squared_maha = np.sum(z * z, axis=1)
+            return squared_maha
+        else:
+            raise ValueError('invalid distance metric')
+
+
+class KalmanTrackTable(object):
+    """
+    Structure-of-arrays store of the Kalman states of one object class's tracks.
+
+    All means are kept in an Nx8 array and all covariances in an Nx8x8 array,
+    a track bound to the table only holds its slot index(see KalmanTableTrack.mean),
+    so predict, project, update and gating run as batched array operations.
+    """
+
+    def __init__(self, kalman_filter, capacity=64):
+        """
+        :param kalman_filter: KalmanFilter providing the multi_* methods
+        :param capacity: initial number of slots(grows when full)
+        """
+        self.kalman_filter = kalman_filter
+
+        self.means = np.zeros((capacity, 8))
+        self.covariances = np.zeros((capacity, 8, 8))
+        self.owners = [None] * capacity
+        self.free_slots = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        """
+        :return: number of used slots
+        """
+        return len(self.owners) - len(self.free_slots)
+
+    def grow(self):
+        """
+        Double the capacity, slots already allocated are kept
+        :return:
+        """
+        capacity = len(self.owners)
+        self.means = np.concatenate((self.means, np.zeros_like(self.means)), axis=0)
+        self.covariances = np.concatenate((self.covariances, np.zeros_like(self.covariances)), axis=0)
+        self.owners.extend([None] * capacity)
+        self.free_slots = list(range(2 * capacity - 1, capacity - 1, -1)) + self.free_slots
+
+    def alloc(self, owner, mean, covariance):
+        """
+        :param owner: the track occupying the slot
+        :param mean: 8 dimensional mean vector
+        :param covariance: 8x8 covariance matrix
+        :return: slot index
+        """
+        if len(self.free_slots) == 0:
+            self.grow()
+
+        slot = self.free_slots.pop()
+        self.means[slot] = mean
+        self.covariances[slot] = covariance
+        self.owners[slot] = owner
+        return slot
+
+    def release(self, slot):
+        """
+        :param slot:
+        :return:
+        """
+        self.owners[slot] = None
+        self.free_slots.append(slot)
+
+    def retain(self, tracks):
+        """
+        Unbind every owner which is not in tracks(i.e. removed or dropped tracks)
+        :param tracks: the tracks still to be kept in the table
+        :return:
+        """
+        keep = set(id(track) for track in tracks)
+        for owner in list(self.owners):
+            if owner is not None and id(owner) not in keep:
+                owner.unbind_table()
+
+    def predict(self, slots, zero_velocity_mask=None):
+        """
+        Run Kalman filter prediction step for the slots in place
+        :param slots: index array
+        :param zero_velocity_mask: bool array, set height velocity to 0 for these slots first
+        :return:
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        if len(slots) == 0:
+            return
+
+        mean = self.means[slots]
+        if zero_velocity_mask is not None:
+            mean[np.asarray(zero_velocity_mask, dtype=bool), 7] = 0
+
+        self.means[slots], self.covariances[slots] = self.kalman_filter.multi_predict(mean,
+                                                                                     self.covariances[slots])
+
+    def project(self, slots):
+        """
+        :param slots: index array
+        :return: Nx4 projected means and Nx4x4 projected covariances
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        return self.kalman_filter.multi_project(self.means[slots], self.covariances[slots])
+
+    def update(self, slots, measurements):
+        """
+        Run Kalman filter correction step for the slots in place
+        :param slots: index array
+        :param measurements: Nx4 measurements (x, y, a, h)
+        :return:
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        if len(slots) == 0:
+            return
+
+        self.means[slots], self.covariances[slots] = self.kalman_filter.multi_update(self.means[slots],
+                                                                                    self.covariances[slots],
+                                                                                    np.asarray(measurements))
+
+    def gating_distance(self, slots, measurements, only_position=False, metric='maha'):
+        """
+        :param slots: index array of T slots
+        :param measurements: Dx4 measurements (x, y, a, h)
+        :param only_position:
+        :param metric:
+        :return: TxD gating distance matrix
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        return self.kalman_filter.multi_gating_distance(self.means[slots],
+                                                        self.covariances[slots],
+                                                        measurements,
+                                                        only_position,
+                                                        metric)
@@ -171,6 +171,10 @@ def train():
                 print('Layer ', layer_name, ' requires grad.')
                 pass
 
+    # ---------- Activation checkpointing: recompute the segment activations in backward(larger batch sizes)
+    if opt.checkpoint_segments > 0:
+        model.checkpoint_segments(opt.checkpoint_segments)
+
     # ---------- Optimizer definition and model parameters registration
     # define optimizer parameter groups 0, 1, 2
     pg0, pg1, pg2 = [], [], []
@@ -525,6 +529,8 @@ def train():
                 if ni % accumulate == 0:
                     optimizer.step()
                     optimizer.zero_grad()
+                    (model.module if hasattr(model, 'module') else model).step_id_classifiers(
+                        optimizer.param_groups[0]['lr'])  # sampled(partial fc) reid classifiers
                     ema.update(model)
 
                 # Print
@@ -775,7 +781,13 @@ if __name__ == '__main__':
     parser.add_argument('--fc',
                         type=str,
                         default='FC',  # Arc or FC
-                        help='FC layer type: FC or Arc')
+                        help='FC layer type: FC, Arc, PartialFC or PartialArc(sampled softmax for huge id counts)')
+
+    # ----- trade compute for memory: gradient checkpointing of the layer segments
+    parser.add_argument('--checkpoint-segments',
+                        type=int,
+                        default=0,  # 0: off, 2~8 for the 1088×608 cfgs
+                        help='number of activation checkpointing segments of the net(0: off)')
 
     # use debug mode to enforce the parameter of worker number to be 0
     parser.add_argument('--debug',
@@ -3,10 +3,11 @@
 import glob
 import math
 import os
+import queue
 import random
 import shutil
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from pathlib import Path
 from threading import Thread
 
@@ -45,17 +46,23 @@ def exif_size(img):
 
 
 class LoadImages:  # for inference
-    def __init__(self, path, img_proc_method, net_w=416, net_h=416):
+    def __init__(self, path, img_proc_method, net_w=416, net_h=416, stride=1, seek_stride=0):
         """
         :param path:
         :param img_proc_method:
         :param net_w:
         :param net_h:
+        :param stride: video frame stride: only 1 of every stride frames is decoded and pre-processed
+        :param seek_stride: seek the video(instead of grabbing the skipped frames) if stride >= seek_stride > 0
         """
         # ----- image pre-processing method
         self.img_proc_method = img_proc_method
         print('Image pre-processing method: {:s}'.format(self.img_proc_method))
 
+        # ----- video frame sampling
+        self.stride = max(int(stride), 1)
+        self.seek = 0 < seek_stride <= self.stride
+
         if type(path) == list:
             self.files = path
 
@@ -103,6 +110,17 @@ class LoadImages:  # for inference
         return self
 
     def __next__(self):
+        path, img0, cap = self.read()
+        img = self.preprocess(img0)
+
+        # cv2.imwrite(path + '.letterbox.jpg', 255 * img.transpose((1, 2, 0))[:, :, ::-1])  # save letterbox image
+        return path, img, img0, cap
+
+    def read(self):
+        """
+        Read(decode) the next image or sampled video frame
+        :return: path, img0(HWC, BGR), video capture
+        """
         if self.count == self.nF:
             raise StopIteration
         path = self.files[self.count]
@@ -121,11 +139,15 @@ class LoadImages:  # for inference
                     self.new_video(path)
                     ret_val, img0 = self.cap.read()
 
-            if self.frame % 30 == 0:
+            if self.frame % 30 < self.stride:
                 # print('video %g/%g (%g/%g) %s: ' % (self.count + 1, self.nF, self.frame, self.nframes, path))
                 print('video (%g/%g) %s: ' % (self.frame, self.nframes, path))
             self.frame += 1
 
+            # skip the next stride - 1 frames: grabbed only, never retrieved or pre-processed
+            if self.stride > 1:
+                self.skip_frames(self.stride - 1)
+
         else:
             # Read image
             self.count += 1
@@ -134,6 +156,14 @@ class LoadImages:  # for inference
             assert img0 is not None, 'Image Not Found ' + path
             print('image %g/%g %s: ' % (self.count, self.nF, path), end='')
 
+        return path, img0, self.cap
+
+    def preprocess(self, img0, out=None):
+        """
+        :param img0: HWC, BGR
+        :param out: optional pre-allocated 3×net_h×net_w uint8 array to write the result into
+        :return: net input img: CHW, RGB, contiguous
+        """
         # Pad and resize
         # img = letterbox(img0, new_shape=self.img_size)[0]  # to make sure mod by 64
         if self.img_proc_method == 'letterbox':
@@ -143,10 +173,11 @@ class LoadImages:  # for inference
 
         # Convert: BGR to RGB and HWC to CHW
         img = img[:, :, ::-1].transpose(2, 0, 1)
-        img = np.ascontiguousarray(img)
+        if out is None:
+            return np.ascontiguousarray(img)
 
-        # cv2.imwrite(path + '.letterbox.jpg', 255 * img.transpose((1, 2, 0))[:, :, ::-1])  # save letterbox image
-        return path, img, img0, self.cap
+        np.copyto(out, img)
+        return out
 
     def new_video(self, path):
         """
@@ -157,10 +188,132 @@ class LoadImages:  # for inference
         self.cap = cv2.VideoCapture(path)
         self.nframes = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    def skip_frames(self, n):
+        """
+        Skip n frames of the current video without decoding them
+        :param n:
+        :return:
+        """
+        if self.seek:
+            self.frame += n
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.frame)
+            return
+
+        for _ in range(n):
+            if not self.cap.grab():  # end of the video: the next read fails
+                break
+            self.frame += 1
+
     def __len__(self):
         return self.nF  # number of files
 
 
+class PrefetchLoader:  # for inference
+    def __init__(self, dataset, prefetch=4, pin_memory=False, hold=1):
+        """
+        Decode and pre-process the frames of a LoadImages ahead on a worker thread,
+        into a pool of pre-allocated(optionally pinned) uint8 net input buffers
+        :param dataset: LoadImages
+        :param prefetch: number of frames decoded ahead
+        :param pin_memory: allocate the buffers in page-locked memory(faster host to GPU copy)
+        :param hold: number of returned frames whose img buffers are still used by the caller:
+        a returned img is overwritten after hold more frames are returned
+        """
+        self.dataset = dataset
+        self.prefetch = max(int(prefetch), 1)
+        self.hold = max(int(hold), 1)
+
+        ## ----- Pre-allocate the buffers: CHW, uint8
+        shape = (3, dataset.net_h, dataset.net_w)
+        pin_memory = pin_memory and torch.cuda.is_available()
+        self.buffers = [torch.empty(shape, dtype=torch.uint8, pin_memory=pin_memory)
+                        for _ in range(self.prefetch + self.hold)]
+        self.arrays = [buffer.numpy() for buffer in self.buffers]  # numpy views sharing the memory
+
+        self.free_slots = None
+        self.ready = None
+        self.used_slots = None
+        self.thread = None
+        self.error = None
+
+    def __iter__(self):
+        self.close()
+
+        self.free_slots = queue.Queue()
+        for slot in range(len(self.buffers)):
+            self.free_slots.put(slot)
+        self.ready = queue.Queue()
+        self.used_slots = deque()
+        self.error = None
+
+        iter(self.dataset)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        """
+        Worker: decode and pre-process frames into the free buffers
+        :return:
+        """
+        try:
+            while True:
+                slot = self.free_slots.get()
+                if slot is None:  # closed
+                    break
+
+                try:
+                    path, img0, cap = self.dataset.read()
+                except StopIteration:
+                    break
+
+                self.dataset.preprocess(img0, out=self.arrays[slot])
+                self.ready.put((slot, path, img0, cap))
+        except Exception as e:
+            self.error = e
+
+        self.ready.put(None)
+
+    def __next__(self):
+        if self.thread is None:
+            raise StopIteration
+
+        # recycle the buffers no longer held by the caller
+        while len(self.used_slots) >= self.hold:
+            self.free_slots.put(self.used_slots.popleft())
+
+        item = self.ready.get()
+        if item is None:
+            self.thread.join()
+            self.thread = None
+            if self.error is not None:
+                raise self.error
+            raise StopIteration
+
+        slot, path, img0, cap = item
+        self.used_slots.append(slot)
+
+        # img: numpy view of the buffer, torch.from_numpy(img) shares(no copy) the buffer memory
+        return path, self.arrays[slot], img0, cap
+
+    def close(self):
+        """
+        Stop the worker thread
+        :return:
+        """
+        if self.thread is None:
+            return
+
+        self.free_slots.put(None)
+        while self.ready.get() is not None:  # unblock and drain the worker
+            self.free_slots.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+
 class LoadWebcam:  # for inference
     def __init__(self, pipe=0, img_size=416):
         self.img_size = img_size
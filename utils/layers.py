@@ -6,9 +6,24 @@ from torch.nn import Parameter
 
 try:
     from mish_cuda import MishCuda as Mish
+
+    MISH_CUDA = True
 except:
+    MISH_CUDA = False
+
     class Mish(nn.Module):  # https://github.com/digantamisra98/Mish
+        def __init__(self, inplace=False):
+            """
+            :param inplace: compute in place in inference(when x does not require grad)
+            """
+            super(Mish, self).__init__()
+            self.inplace = inplace
+
         def forward(self, x):
+            if self.training and x.requires_grad:  # saves only x for backward, see MishImplementation
+                return MishImplementation.apply(x)
+            if self.inplace and not x.requires_grad:
+                return x.mul_(F.softplus(x).tanh_())
             return x * F.softplus(x).tanh()
 
 
@@ -93,6 +108,126 @@ class ArcMargin(nn.Module):
         return output
 
 
+class PartialFC(nn.Module):
+    """
+    Sampled softmax(Partial FC) reid classifier for huge identity counts:
+    each training step only computes the logits of the batch's positive ids plus
+    a uniformly sampled subset of negative ids(sample_rate of out_features).
+    The full weight lives in a store off the model's parameters(on store_device, cpu: offloaded),
+    so it is neither moved by model.to() nor held by the optimizer: the sampled rows are gathered
+    to the input's device and updated sparsely by step(SGD with momentum and weight decay).
+    The arc margin constants are the same as ArcMargin's(margin=True),
+    the saved weight('weight' key) is interchangeable with ArcMargin's and nn.Linear's.
+    """
+
+    def __init__(self,
+                 in_features,
+                 out_features,
+                 sample_rate=0.1,
+                 margin=True,
+                 s=30.0,
+                 m=0.50,
+                 easy_margin=False,
+                 momentum=0.9,
+                 weight_decay=5e-4,
+                 store_device='cpu'):
+        """
+        :param in_features:
+        :param out_features: number of track ids
+        :param sample_rate: ratio of the ids sampled as negatives each step
+        :param margin: arc margin(True) or plain(no bias) FC logits
+        :param s:
+        :param m:
+        :param easy_margin:
+        :param momentum:
+        :param weight_decay:
+        :param store_device: device of the weight store
+        """
+        super(PartialFC, self).__init__()
+
+        self.in_dim = in_features
+        self.out_dim = out_features
+        self.n_sample = max(int(sample_rate * out_features), 1)
+        print('=> in dim: %d, out dim: %d, sampled: %d' % (self.in_dim, self.out_dim, self.n_sample))
+
+        self.margin = margin
+        self.bias = None
+        self.s = s
+        self.m = m
+        self.easy_margin = easy_margin
+        self.cos_m = math.cos(m)
+        self.sin_m = math.sin(m)
+        self.th = math.cos(math.pi - m)
+        self.mm = math.sin(math.pi - m) * m
+
+        # ----- weight store and its sparse optimizer state
+        self.weight_store = torch.empty(self.out_dim, self.in_dim, device=store_device)
+        nn.init.xavier_uniform_(self.weight_store)
+        self.momentum = momentum
+        self.momentum_store = torch.zeros_like(self.weight_store) if momentum > 0 else None
+        self.weight_decay = weight_decay
+        self.pending = []  # (sampled rows, grad) of the backward passes since the last step
+
+    def sample(self, labels):
+        """
+        :param labels: track ids of the GT(of this object class) in the batch
+        :return: sampled weight rows(on labels' device) and the labels' indices in them
+        """
+        if labels.numel() == 0:
+            return self.weight_store.new_zeros((0, self.in_dim), device=labels.device), labels
+
+        store_device = self.weight_store.device
+        labels = labels.long()
+        negatives = torch.randint(0, self.out_dim, (self.n_sample,), device=store_device)
+        index = torch.unique(torch.cat((labels.to(store_device), negatives)))  # sorted, positives included
+        local_labels = torch.searchsorted(index.to(labels.device), labels)
+
+        sub_weight = self.weight_store[index].to(labels.device, non_blocking=True)
+        if self.training and torch.is_grad_enabled():
+            sub_weight.requires_grad_(True)
+            sub_weight.register_hook(lambda grad: self.pending.append((index, grad.to(store_device))))
+
+        return sub_weight, local_labels
+
+    def step(self, lr):
+        """
+        Sparse SGD update of the rows sampled since the last step: the gradients of a row sampled
+        by several backward passes(e.g. gradient accumulation) are summed first, so the momentum
+        and weight decay are applied once per row, as by a dense SGD step
+        :param lr:
+        :return:
+        """
+        if not self.pending:
+            return
+
+        with torch.no_grad():
+            index, inverse = torch.unique(torch.cat([index for index, _ in self.pending]), return_inverse=True)
+            grads = torch.cat([grad for _, grad in self.pending])
+            grad = grads.new_zeros((index.shape[0], self.in_dim)).index_add_(0, inverse, grads)
+
+            weight = self.weight_store[index]
+            grad += self.weight_decay * weight
+            if self.momentum_store is not None:
+                grad = self.momentum_store[index].mul_(self.momentum).add_(grad)
+                self.momentum_store[index] = grad
+            self.weight_store[index] = weight - lr * grad  # in place: the EMA model shares the store
+        self.pending = []
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(PartialFC, self)._save_to_state_dict(destination, prefix, keep_vars)
+        destination[prefix + 'weight'] = self.weight_store
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        key = prefix + 'weight'
+        if key in state_dict:
+            self.weight_store.copy_(state_dict.pop(key))
+        elif strict:
+            missing_keys.append(key)
+        super(PartialFC, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                     missing_keys, unexpected_keys, error_msgs)
+
+
 def make_divisible(v, divisor):
     # Function ensures all layers have a channel number that is divisible by 8
     # https://github.com/tensorflow/models/blob/master/research/slim/nets/mobilenet/mobilenet.py
@@ -135,14 +270,17 @@ class RouteGroup(nn.Module):
         :return:
         """
         if self.multi:
-            outs = []
-            for layer in self.layers:
-                out = torch.chunk(outputs[layer], self.groups, dim=1)
-                outs.append(out[self.group_id])
-            return torch.cat(outs, dim=1)
+            return torch.cat([self.group(outputs[layer]) for layer in self.layers], dim=1)
         else:
-            out = torch.chunk(outputs[self.layers[0]], self.groups, dim=1)
-            return out[self.group_id]
+            return self.group(outputs[self.layers[0]])  # a view, no copy
+
+    def group(self, x):
+        """
+        :param x:
+        :return: channel group group_id of x(a view of x)
+        """
+        c = x.shape[1] // self.groups
+        return x.narrow(1, c * self.group_id, c)
 
 
 # SAM layer: ScaleSpatial
@@ -234,12 +372,14 @@ class GAP(nn.Module):
 
 
 class FeatureConcat(nn.Module):
-    def __init__(self, layers):
+    def __init__(self, layers, channels=None):
         """
         :param layers:
+        :param channels: channels of each input layer(for the planned concat buffer)
         """
         super(FeatureConcat, self).__init__()
         self.layers = layers  # layer indices
+        self.channels = channels  # input layer channels
         self.multiple = len(layers) > 1  # multiple layers flag
 
     def forward(self, x, outputs):
@@ -419,10 +559,35 @@ class MemoryEfficientMish(nn.Module):
 
 
 class Swish(nn.Module):
+    def __init__(self, inplace=False):
+        """
+        :param inplace: compute in place in inference(when x does not require grad)
+        """
+        super(Swish, self).__init__()
+        self.inplace = inplace
+
     def forward(self, x):
+        if self.training and x.requires_grad:  # saves only x for backward, see SwishImplementation
+            return SwishImplementation.apply(x)
+        if self.inplace and not x.requires_grad:
+            return x.mul_(torch.sigmoid(x))
         return x * torch.sigmoid(x)
 
 
+# Activations which can write into a given output tensor(out=):
+# used by the planned concat to write a layer output into its concat buffer slice
+ACTIVATION_OUT = {
+    nn.LeakyReLU: lambda act, x, out: torch.max(torch.mul(x, act.negative_slope, out=out), x, out=out),
+    nn.ReLU: lambda act, x, out: torch.clamp(x, min=0, out=out),
+    nn.Sigmoid: lambda act, x, out: torch.sigmoid(x, out=out),
+    Swish: lambda act, x, out: torch.mul(x, torch.sigmoid(x), out=out),
+    MemoryEfficientSwish: lambda act, x, out: torch.mul(x, torch.sigmoid(x), out=out),
+    MemoryEfficientMish: lambda act, x, out: torch.mul(x, torch.tanh(F.softplus(x)), out=out),
+}
+if not MISH_CUDA:
+    ACTIVATION_OUT[Mish] = lambda act, x, out: torch.mul(x, F.softplus(x).tanh(), out=out)
+
+
 class HardSwish(nn.Module):  # https://arxiv.org/pdf/1905.02244.pdf
     def forward(self, x):
         return x * F.hardtanh(x + 3, 0., 6., True) / 6.
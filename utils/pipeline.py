@@ -0,0 +1,167 @@
+# encoding=utf-8
+
+import queue
+import time
+from threading import Thread
+
+# end of stream marker passed through the stage queues
+_END = object()
+
+
+class PipelineStage(object):
+    """
+    One pipeline stage running on its own worker thread:
+    items are taken from the input queue, processed by fn and put into the output queue.
+    fn returns None to drop an item(e.g. a frame without results)
+    """
+
+    def __init__(self, name, fn):
+        """
+        :param name: stage name(for the throughput report)
+        :param fn: callable: item -> item(or None)
+        """
+        self.name = name
+        self.fn = fn
+
+        self.in_queue = None
+        self.out_queue = None
+        self.thread = None
+        self.error = None
+
+        # ----- throughput statistics
+        self.n_items = 0
+        self.busy_time = 0.0
+
+    def run(self, stop_flag):
+        """
+        :param stop_flag: list of one bool shared by all the stages: set on error
+        :return:
+        """
+        while True:
+            item = self.in_queue.get()
+            if item is _END or stop_flag[0]:
+                break
+
+            try:
+                t1 = time.perf_counter()
+                item = self.fn(item)
+                self.busy_time += time.perf_counter() - t1
+            except Exception as e:
+                self.error = e
+                stop_flag[0] = True
+                break
+
+            self.n_items += 1
+            if item is not None and self.out_queue is not None:
+                self.out_queue.put(item)
+
+        # drain the input queue to unblock the upstream stage after an error
+        if stop_flag[0]:
+            while item is not _END:
+                item = self.in_queue.get()
+
+        if self.out_queue is not None:
+            self.out_queue.put(_END)
+
+
+class Pipeline(object):
+    """
+    Multi-threaded pipeline: source -> stage_1 -> ... -> stage_n.
+    Each stage runs on its own thread and the stages are connected by bounded FIFO queues,
+    so the item order is kept and a slow stage blocks(back-pressure) its upstream stages
+    """
+
+    def __init__(self, source, stages, queue_size=4):
+        """
+        :param source: iterable of input items, iterated on its own thread
+        :param stages: list of PipelineStage
+        :param queue_size: max number of items waiting between two stages
+        """
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+
+        # ----- source statistics
+        self.n_items = 0
+        self.busy_time = 0.0
+        self.wall_time = 0.0
+        self.error = None
+
+    def feed(self, out_queue, stop_flag):
+        """
+        Iterate the source and feed the first stage
+        :param out_queue:
+        :param stop_flag:
+        :return:
+        """
+        try:
+            t1 = time.perf_counter()
+            for item in self.source:
+                self.busy_time += time.perf_counter() - t1
+                if stop_flag[0]:
+                    break
+
+                self.n_items += 1
+                out_queue.put(item)
+                t1 = time.perf_counter()
+        except Exception as e:
+            self.error = e
+            stop_flag[0] = True
+
+        out_queue.put(_END)
+
+    def run(self):
+        """
+        Run all the stages until the source is exhausted
+        :return:
+        """
+        if len(self.stages) == 0:
+            print('[Err]: empty pipeline.')
+            return
+
+        stop_flag = [False]
+
+        ## ----- Connect the stages by bounded queues
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages))]
+        for i, stage in enumerate(self.stages):
+            stage.in_queue = queues[i]
+            stage.out_queue = queues[i + 1] if i + 1 < len(self.stages) else None
+
+        t_start = time.perf_counter()
+
+        threads = [Thread(target=self.feed, args=(queues[0], stop_flag), daemon=True)]
+        for stage in self.stages:
+            stage.thread = Thread(target=stage.run, args=(stop_flag,), daemon=True)
+            threads.append(stage.thread)
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.wall_time = time.perf_counter() - t_start
+
+        ## ----- Re-raise the first error in the caller's thread
+        if self.error is not None:
+            raise self.error
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+
+    def print_stats(self):
+        """
+        Print per-stage throughput: fps of the stage's busy time and its share of the wall time
+        :return:
+        """
+        print('Pipeline: {:d} items in {:.3f}s, {:.2f} fps.'
+              .format(self.n_items, self.wall_time, self.n_items / max(self.wall_time, 1e-9)))
+
+        stats = [('source', self.n_items, self.busy_time)]
+        stats += [(stage.name, stage.n_items, stage.busy_time) for stage in self.stages]
+        for name, n_items, busy_time in stats:
+            print('{:>12s}: {:d} items, busy {:.3f}s, {:.2f} fps, utilization {:.1f}%.'
+                  .format(name,
+                          n_items,
+                          busy_time,
+                          n_items / max(busy_time, 1e-9),
+                          100.0 * busy_time / max(self.wall_time, 1e-9)))
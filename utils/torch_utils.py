@@ -88,6 +88,8 @@ def fuse_conv_and_bn(conv, bn):
                                     kernel_size=conv.kernel_size,
                                     stride=conv.stride,
                                     padding=conv.padding,
+                                    dilation=conv.dilation,
+                                    groups=conv.groups,
                                     bias=True)
 
         # prepare filters
@@ -99,7 +101,7 @@ def fuse_conv_and_bn(conv, bn):
         if conv.bias is not None:
             b_conv = conv.bias
         else:
-            b_conv = torch.zeros(conv.weight.size(0))
+            b_conv = torch.zeros(conv.weight.size(0), device=conv.weight.device)
         b_bn = bn.bias - bn.weight.mul(bn.running_mean).div(torch.sqrt(bn.running_var + bn.eps))
         fusedconv.bias.copy_(torch.mm(w_bn, b_conv.reshape(-1, 1)).reshape(-1) + b_bn)
 
@@ -185,6 +187,12 @@ class ModelEMA:
         for p in self.ema.parameters():
             p.requires_grad_(False)
 
+        # sampled(PartialFC) reid classifier weight stores are shared with the model, not averaged:
+        # averaging them would cost time linear in the number of track ids each update
+        for m, e in zip(model.modules(), self.ema.modules()):
+            if hasattr(m, 'weight_store'):
+                e.weight_store, e.momentum_store = m.weight_store, None
+
     def update(self, model):
         self.updates += 1
         d = self.decay(self.updates)
@@ -195,7 +203,7 @@ class ModelEMA:
                 msd, esd = model.state_dict(), self.ema.state_dict()
 
             for k, v in esd.items():
-                if v.dtype.is_floating_point:
+                if v.dtype.is_floating_point and v is not msd[k]:  # shared tensors are not averaged
                     v *= d
                     v += (1. - d) * msd[k].detach()
 
@@ -297,6 +297,41 @@ def map_to_orig_coords(dets, net_w, net_h, orig_w, orig_h):
     return dets
 
 
+# gather reid feature vectors at objects' centers
+def gather_reid_feats(reid_feat_map, boxes, img_w, img_h, b_idx=0):
+    """
+    Gather the L2 normalized reid feature vector at each box's center point on device,
+    only N×D floats are transferred to host instead of the whole feature map
+    :param reid_feat_map: B×D×H×W reid feature map(tensor)
+    :param boxes: x1, y1, x2, y2: N×4(numpy array or tensor) in img_w×img_h scale
+    :param img_w: width of the boxes' coordinate system
+    :param img_h: height of the boxes' coordinate system
+    :param b_idx: batch index of the feature map
+    :return: N×D numpy array
+    """
+    b, reid_dim, feat_map_h, feat_map_w = reid_feat_map.shape
+    if len(boxes) == 0:
+        return np.zeros((0, reid_dim), dtype=np.float32)
+
+    boxes = torch.as_tensor(boxes[:, :4], dtype=torch.float32).to(reid_feat_map.device)
+
+    # get center point and map it from img scale to feature map scale
+    centers_x = (boxes[:, 0] + boxes[:, 2]) * 0.5 / float(img_w) * float(feat_map_w)
+    centers_y = (boxes[:, 1] + boxes[:, 3]) * 0.5 / float(img_h) * float(feat_map_h)
+
+    # rounding and converting to int64 for indexing,
+    # to avoid the object center out of reid feature map's range
+    centers_x = (centers_x + 0.5).long().clamp(0, feat_map_w - 1)
+    centers_y = (centers_y + 0.5).long().clamp(0, feat_map_h - 1)
+
+    # get reid feature vectors: N×D and L2 normalize them
+    feats = reid_feat_map[b_idx, :, centers_y, centers_x].t()
+    feats = F.normalize(feats.float(), dim=1)
+
+    # GPU -> CPU
+    return feats.detach().cpu().numpy()
+
+
 # 坐标系转换
 def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
     """
@@ -617,6 +652,119 @@ def smooth_BCE(eps=0.1):  # https://github.com/ultralytics/yolov3/issues/238#iss
     return 1.0 - 0.5 * eps, 0.5 * eps
 
 
+def packed_id_logits(id_vects, cls_ids, tr_ids, id_classifiers, fc_type):
+    """
+    ReID classification logits of the GT of all object classes by one matmul:
+    the classifiers(nn.Linear or ArcMargin) of all classes are packed into one weight matrix,
+    each class's classifier occupies the rows [offsets[c], offsets[c] + nID_c)
+    :param id_vects: n×D L2 normalized reid feature vectors
+    :param cls_ids: n object class ids(index of id_classifiers)
+    :param tr_ids: n track ids(in each object class)
+    :param id_classifiers: the per class classifiers(Darknet.id_classifiers)
+    :param fc_type: FC, Arc, PartialFC or PartialArc
+    :return: n×sum(nID) logits(ArcMargin's margin applied to the target column),
+    n packed targets, packed column class ids and per class row offsets
+    """
+    tr_ids = tr_ids.long()
+    if fc_type.startswith('Partial'):  # sampled classifiers: only each class's positive + sampled negative rows
+        weights = []
+        for cls_id, classifier in enumerate(id_classifiers):
+            mask = cls_ids == cls_id
+            weight, tr_ids_sampled = classifier.sample(tr_ids[mask])
+            tr_ids = tr_ids.masked_scatter(mask, tr_ids_sampled)  # track ids in the sampled rows
+            weights.append(weight)
+        fc_type = fc_type[len('Partial'):]
+    else:
+        weights = [classifier.weight for classifier in id_classifiers]
+
+    n_ids = torch.tensor([w.shape[0] for w in weights], device=id_vects.device)
+    offsets = torch.cumsum(n_ids, 0) - n_ids
+    col_cls = torch.repeat_interleave(torch.arange(len(weights), device=id_vects.device), n_ids)
+    targets = offsets[cls_ids] + tr_ids
+
+    weight = torch.cat(weights, 0)  # sum(nID)×D
+    if fc_type == 'FC':
+        bias = None
+        if id_classifiers[0].bias is not None:
+            bias = torch.cat([classifier.bias for classifier in id_classifiers], 0)
+        return F.linear(id_vects, weight, bias), targets, col_cls, offsets
+
+    # ----- arc margin: cos(θ + m) at the target column, cos(θ) elsewhere, scaled by s
+    arc = id_classifiers[0]  # all classes share s and m
+    cosine = F.linear(F.normalize(id_vects, p=2), F.normalize(weight, p=2))
+    rows = torch.arange(cosine.shape[0], device=cosine.device)
+    cos_t = cosine[rows, targets]
+    sin_t = torch.sqrt((1.0 - cos_t * cos_t).clamp(min=0.0))
+    phi = cos_t * arc.cos_m - sin_t * arc.sin_m
+    if arc.easy_margin:
+        phi = torch.where(cos_t > 0, phi, cos_t)
+    else:
+        phi = torch.where(cos_t > arc.th, phi, cos_t - arc.mm)
+
+    return cosine.index_put((rows, targets), phi) * arc.s, targets, col_cls, offsets
+
+
+def packed_id_loss(id_vects, cls_ids, tr_ids, id_classifiers, fc_type):
+    """
+    ReID loss of the GT of all object classes: one packed classifier matmul(see packed_id_logits)
+    and one cross entropy with the other classes' columns masked out,
+    equal to the sum over classes of each class's mean cross entropy
+    :param id_vects: n×D L2 normalized reid feature vectors
+    :param cls_ids: n object class ids
+    :param tr_ids: n track ids(in each object class)
+    :param id_classifiers:
+    :param fc_type: FC, Arc, PartialFC or PartialArc
+    :return:
+    """
+    keep = cls_ids < len(id_classifiers)  # object classes without a classifier are skipped
+    if not keep.all():
+        id_vects, cls_ids, tr_ids = id_vects[keep], cls_ids[keep], tr_ids[keep]
+    if cls_ids.numel() == 0:
+        return id_vects.new_zeros(1)
+
+    logits, targets, col_cls, _ = packed_id_logits(id_vects, cls_ids, tr_ids, id_classifiers, fc_type)
+    logits = logits.masked_fill(col_cls.unsqueeze(0) != cls_ids.unsqueeze(1), float('-inf'))
+    ce = F.cross_entropy(logits, targets, reduction='none')
+
+    counts = torch.bincount(cls_ids, minlength=len(id_classifiers)).to(ce.dtype)
+    return (ce / counts[cls_ids]).sum().view(1)
+
+
+def packed_ghmc_loss(logits, targets, cls_ids, col_cls, bins=100):
+    """
+    GHM-C loss(GHMC, momentum 0) of the packed logits, equal to the sum over object classes of
+    GHMC on each class's block(its GT rows × its classifier columns): the gradient length histograms
+    of all classes are counted at once by one bincount of (class, bin) keys
+    :param logits: n×sum(nID) packed logits(see packed_id_logits)
+    :param targets: n packed targets
+    :param cls_ids: n object class ids
+    :param col_cls: packed column class ids
+    :param bins: number of gradient length bins
+    :return:
+    """
+    if cls_ids.numel() == 0:
+        return logits.new_zeros(1)
+
+    rows, cols = torch.where(col_cls.unsqueeze(0) == cls_ids.unsqueeze(1))  # entries of the class blocks
+    preds = logits[rows, cols]
+    labels = (targets[rows] == cols).to(preds.dtype)
+
+    with torch.no_grad():
+        edges = torch.arange(bins + 1, device=logits.device).float() / bins
+        edges[-1] += 1e-6
+
+        # gradient length bin of each entry: edges[i] <= g < edges[i + 1]
+        g = torch.abs(preds.sigmoid().float() - labels.float())
+        keys = cls_ids[rows] * bins + torch.bucketize(g, edges, right=True) - 1
+        counts = torch.bincount(keys, minlength=(int(cls_ids.max()) + 1) * bins)
+        n_valid = (counts.view(-1, bins) > 0).sum(1)  # valid bins of each class
+
+        # GHMC's tot / num_in_bin / n weights, divided by its tot
+        weights = 1.0 / (counts[keys] * n_valid[cls_ids[rows]]).to(preds.dtype)
+
+    return (F.binary_cross_entropy_with_logits(preds, labels, reduction='none') * weights).sum().view(1)
+
+
 def compute_loss_one_layer(preds, reid_feat_out,
                            targets, track_ids,
                            model, dev,
@@ -644,8 +792,6 @@ def compute_loss_one_layer(preds, reid_feat_out,
     # Define criteria
     BCE_cls = nn.BCEWithLogitsLoss(pos_weight=ft([h['cls_pw']]), reduction=reduction)
     BCE_obj = nn.BCEWithLogitsLoss(pos_weight=ft([h['obj_pw']]), reduction=reduction)
-    CE_reid = nn.CrossEntropyLoss()
-    ghm_c = GHMC(bins=100)  # 30, 60, 80, 100
 
     # class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
     cp, cn = smooth_BCE(eps=0.0)
@@ -717,53 +863,20 @@ def compute_loss_one_layer(preds, reid_feat_out,
             # get reid feature vector for GT boxes
             t_reid_feat_vects = reid_feat_map[b, :, center_y, center_x]  # nb × 128: only one feature map layer
 
-            # ----- compute each object class's reid loss_funcs
+            # ----- reid loss_funcs of all object classes: one packed classifier matmul
             multi_gpu = type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)
+            id_model = model.module if multi_gpu else model
+            id_vects = F.normalize(t_reid_feat_vects, dim=1)  # L2 normalize the feature vector
             if multi_gpu:
-                for cls_id, id_num in model.module.max_id_dict.items():
-                    inds = torch.where(cls_ids == cls_id)
-                    if inds[0].shape[0] == 0:
-                        # print('skip class id', cls_id)
-                        continue
-
-                    id_vects = t_reid_feat_vects[inds]
-                    id_vects = F.normalize(id_vects, dim=1)  # L2 normalize the feature vector
-
-                    fc_preds = model.module.id_classifiers[cls_id].forward(id_vects).contiguous()
-                    l_reid += CE_reid(fc_preds, tr_ids[inds])
+                l_reid += packed_id_loss(id_vects, cls_ids, tr_ids, id_model.id_classifiers, id_model.fc_type)
             else:
-                for cls_id, id_num in model.max_id_dict.items():
-                    inds = torch.where(cls_ids == cls_id)
-                    if inds[0].shape[0] == 0:
-                        # print('skip class id', cls_id)
-                        continue
-
-                    id_vects = t_reid_feat_vects[inds]
-
-                    # L2 normalize the feature vector
-                    id_vects = F.normalize(id_vects, dim=1)
-
-                    if model.fc_type == 'FC':
-                        ## normal FC layer as classifier
-                        fc_preds = model.id_classifiers[cls_id].forward(id_vects).contiguous()
-                        # l_reid += CE_reid(fc_preds, tr_ids[inds])  # using cross entropy loss
-
-                        ## using GHM-C loss for reid classification
-                        target = torch.zeros_like(fc_preds)
-                        target.scatter_(1, tr_ids[inds].view(-1, 1).long(), 1)
-                        label_weight = torch.ones_like(fc_preds)
-                        l_reid += ghm_c.forward(fc_preds, target, label_weight)
-
-                    elif model.fc_type == 'Arc':
-                        ## arc margin FC layer as classifier
-                        fc_preds = model.id_classifiers[cls_id].forward(id_vects, tr_ids[inds]).contiguous()
-                        # l_reid += CE_reid(fc_preds, tr_ids[inds])
-
-                        ## using GHM-C loss for reid classification
-                        target = torch.zeros_like(fc_preds)
-                        target.scatter_(1, tr_ids[inds].view(-1, 1).long(), 1)
-                        label_weight = torch.ones_like(fc_preds)
-                        l_reid += ghm_c.forward(fc_preds, target, label_weight)
+                keep = cls_ids < len(id_model.id_classifiers)
+                cls_ids, tr_ids, id_vects = cls_ids[keep], tr_ids[keep], id_vects[keep]
+                fc_preds, targets_all, col_cls, _ = packed_id_logits(id_vects, cls_ids, tr_ids,
+                                                                     id_model.id_classifiers, id_model.fc_type)
+
+                ## using GHM-C loss for reid classification: per object class statistics on its logits block
+                l_reid += packed_ghmc_loss(fc_preds, targets_all, cls_ids, col_cls, bins=100)  # 30, 60, 80, 100
 
             # Append targets to text file
             # with open('targets.txt', 'a') as file:
@@ -813,7 +926,6 @@ def compute_loss_no_upsample(preds, reid_feat_out, targets, track_ids, model):
     # Define criteria
     BCE_cls = nn.BCEWithLogitsLoss(pos_weight=ft([h['cls_pw']]), reduction=red)
     BCE_obj = nn.BCEWithLogitsLoss(pos_weight=ft([h['obj_pw']]), reduction=red)
-    CE_reid = nn.CrossEntropyLoss()
 
     # class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
     cp, cn = smooth_BCE(eps=0.0)
@@ -884,39 +996,11 @@ def compute_loss_no_upsample(preds, reid_feat_out, targets, track_ids, model):
             # get reid feature vector for GT boxes
             t_reid_feat_vects = reid_feat_out[i][b, :, center_y, center_x]  # nb × 128
 
-            # ----- compute each object class's reid loss_funcs
+            # ----- reid loss_funcs of all object classes: one packed classifier matmul and one masked CE
             multi_gpu = type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)
-            if multi_gpu:
-                for cls_id, id_num in model.module.max_id_dict.items():
-                    inds = torch.where(cls_ids == cls_id)
-                    if inds[0].shape[0] == 0:
-                        # print('skip class id', cls_id)
-                        continue
-
-                    id_vects = t_reid_feat_vects[inds]
-                    id_vects = F.normalize(id_vects, dim=1)  # L2 normalize the feature vector
-
-                    fc_preds = model.module.id_classifiers[cls_id].forward(id_vects).contiguous()
-                    l_reid += CE_reid(fc_preds, tr_ids[inds])
-            else:
-                for cls_id, id_num in model.max_id_dict.items():
-                    inds = torch.where(cls_ids == cls_id)
-                    if inds[0].shape[0] == 0:
-                        # print('skip class id', cls_id)
-                        continue
-
-                    id_vects = t_reid_feat_vects[inds]
-
-                    # L2 normalize the feature vector
-                    id_vects = F.normalize(id_vects, dim=1)
-
-                    # # normal FC layer as classifier
-                    fc_preds = model.id_classifiers[cls_id].forward(id_vects).contiguous()
-                    l_reid += CE_reid(fc_preds, tr_ids[inds])
-
-                    # arc margin FC layer as classifier
-                    # fc_preds = model.id_classifiers[cls_id].forward(id_vects, tr_ids[inds]).contiguous()
-                    # l_reid += CE_reid(fc_preds, tr_ids[inds])
+            id_model = model.module if multi_gpu else model
+            id_vects = F.normalize(t_reid_feat_vects, dim=1)  # L2 normalize the feature vector
+            l_reid += packed_id_loss(id_vects, cls_ids, tr_ids, id_model.id_classifiers, id_model.fc_type)
 
             # Append targets to text file
             # with open('targets.txt', 'a') as file:
@@ -962,7 +1046,6 @@ def compute_loss_with_ids(preds, reid_feat_out, targets, track_ids, model):
     # Define criteria
     BCE_cls = nn.BCEWithLogitsLoss(pos_weight=ft([h['cls_pw']]), reduction=red)
     BCE_obj = nn.BCEWithLogitsLoss(pos_weight=ft([h['obj_pw']]), reduction=red)
-    CE_reid = nn.CrossEntropyLoss()
 
     # class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
     cp, cn = smooth_BCE(eps=0.0)
@@ -1033,39 +1116,11 @@ def compute_loss_with_ids(preds, reid_feat_out, targets, track_ids, model):
             # get reid feature vector for GT boxes
             t_reid_feat_vects = reid_feat_out[i][b, :, center_y, center_x]  # nb × 128
 
-            # ----- compute each object class's reid loss_funcs
+            # ----- reid loss_funcs of all object classes: one packed classifier matmul and one masked CE
             multi_gpu = type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)
-            if multi_gpu:
-                for cls_id, id_num in model.module.max_id_dict.items():
-                    inds = torch.where(cls_ids == cls_id)
-                    if inds[0].shape[0] == 0:
-                        # print('skip class id', cls_id)
-                        continue
-
-                    id_vects = t_reid_feat_vects[inds]
-                    id_vects = F.normalize(id_vects, dim=1)  # L2 normalize the feature vector
-
-                    fc_preds = model.module.id_classifiers[cls_id].forward(id_vects).contiguous()
-                    l_reid += CE_reid(fc_preds, tr_ids[inds])
-            else:
-                for cls_id, id_num in model.max_id_dict.items():
-                    inds = torch.where(cls_ids == cls_id)
-                    if inds[0].shape[0] == 0:
-                        # print('skip class id', cls_id)
-                        continue
-
-                    id_vects = t_reid_feat_vects[inds]
-                    id_vects = F.normalize(id_vects, dim=1)  # L2 normalize the feature vector
-
-                    if model.fc_type == 'FC':
-                        ## normal FC layer as classifier
-                        fc_preds = model.id_classifiers[cls_id].forward(id_vects).contiguous()
-                        l_reid += CE_reid(fc_preds, tr_ids[inds])
-
-                    elif model.fc_type == 'Arc':
-                        ## arc margin FC layer as classifier
-                        fc_preds = model.id_classifiers[cls_id].forward(id_vects, tr_ids[inds]).contiguous()
-                        l_reid += CE_reid(fc_preds, tr_ids[inds])
+            id_model = model.module if multi_gpu else model
+            id_vects = F.normalize(t_reid_feat_vects, dim=1)  # L2 normalize the feature vector
+            l_reid += packed_id_loss(id_vects, cls_ids, tr_ids, id_model.id_classifiers, id_model.fc_type)
 
             # Append targets to text file
             # with open('targets.txt', 'a') as file:
@@ -1170,144 +1225,118 @@ def compute_loss(preds, targets, model):  # predictions, targets, model
     return loss, torch.cat((l_box, l_obj, l_cls, loss)).detach()
 
 
+def get_target_tables(model, preds):
+    """
+    Stacked anchor vectors and grid gains of all yolo layers, cached on the model
+    per (device, grid sizes): multi-scale training changes the grid sizes
+    :param model:
+    :param preds: the yolo layers' training outputs(bs×na×ny×nx×no)
+    :return: L×na×2 anchor vectors(in each yolo layer's grid scale), L×6 gains(normalized targets to grid space)
+    """
+    multi_gpu = type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)
+    m = model.module if multi_gpu else model
+
+    key = (str(preds[0].device), tuple(tuple(pred.shape[2:4]) for pred in preds))
+    tables = m.target_tables.get(key)
+    if tables is None:
+        anchor_vecs = [m.module_list[idx].anchor_vec for idx in m.yolo_layer_inds]
+
+        # zero padded anchors(of layers with less anchors) never match: wh iou 0
+        anchors = torch.zeros(len(anchor_vecs), max(len(vec) for vec in anchor_vecs), 2)
+        for i, vec in enumerate(anchor_vecs):
+            anchors[i, :len(vec)] = vec
+
+        gain = torch.ones(len(preds), 6)
+        for i, pred in enumerate(preds):
+            ny, nx = pred.shape[2:4]
+            gain[i, 2:] = torch.tensor([nx, ny, nx, ny], dtype=gain.dtype)  # xywh gain
+
+        tables = (anchors.to(preds[0].device), gain.to(preds[0].device))
+        m.target_tables[key] = tables
+
+    return tables
+
+
+def build_targets_packed(preds, targets, model, track_ids=None):
+    """
+    Targets of all yolo layers built in one batched operation: the GT boxes are matched against
+    the stacked anchors of all yolo layers at once(anchor-GT wh iou > iou_t, each GT with every anchor)
+    :param preds: the yolo layers' training outputs
+    :param targets: nt×6: image index in the batch, class id, x, y, w, h(normalized)
+    :param model:
+    :param track_ids: nt GT track ids, None: no reid targets
+    :return: dict of the packed tensors of the n matched anchor-GT pairs(ordered by yolo layer, anchor, GT):
+    layer, b(image index), a(anchor index), gj, gi(grid y, x), cls, box(xywh in grids),
+    anchor(anchor vectors), track_ids(None if not given) and counts(number of pairs of each yolo layer)
+    """
+    anchors, gain = get_target_tables(model, preds)  # L×na×2, L×6
+    n_layers = anchors.shape[0]
+
+    # ----- wh iou of all(yolo layer, anchor, GT): L×na×nt
+    t_all = targets.unsqueeze(0) * gain.unsqueeze(1)  # L×nt×6: targets in each yolo layer's grid space
+    gwh = t_all[:, None, :, 4:6]  # L×1×nt×2
+    awh = anchors[:, :, None]  # L×na×1×2
+    inter = torch.min(awh, gwh).prod(3)
+    iou = inter / (awh.prod(3) + gwh.prod(3) - inter)
+
+    # ----- positive samples: anchors whose iou with the GT box exceeds the iou threshold
+    layer, a, n = torch.nonzero(iou > model.hyp['iou_t'], as_tuple=True)  # ordered by layer, anchor, GT
+
+    t = t_all[layer, n]  # n×6
+    b, c = t[:, :2].long().t()  # target image index in the batch, class id
+    gxy = t[:, 2:4]  # grid x, y (GT center)
+    gwh = t[:, 4:6]  # grid w, h
+    gi, gj = gxy.long().t()  # grid x, y indices(int64)
+
+    if c.shape[0]:  # if any targets
+        assert c.max() < model.nc, \
+            'Model accepts %g classes labeled from 0-%g, however you labelled a class %g. ' \
+            'See https://github.com/ultralytics/yolov3/wiki/Train-Custom-Data' % (
+                model.nc, model.nc - 1, c.max())
+
+    return {'layer': layer,
+            'b': b,
+            'a': a,
+            'gj': gj,
+            'gi': gi,
+            'cls': c,
+            'box': torch.cat((gxy - gxy.floor(), gwh), 1),  # GT center's fractional part, wh(grids)
+            'anchor': anchors[layer, a],  # anchor vectors of corresponding GT boxes
+            'track_ids': None if track_ids is None else track_ids[n],
+            'counts': torch.bincount(layer, minlength=n_layers).tolist()}
+
+
 def build_targets_with_ids(preds, targets, track_ids, model):
     """
+    Per yolo layer views of build_targets_packed
     :param preds:
     :param targets:
     :param track_ids:
     :param model:
-    :return:
+    :return: t_cls, t_box, indices(b, a, gj, gi), anchor vectors and t_track_ids of each yolo layer
     """
     # targets = [image, class, x, y, w, h]
+    packed = build_targets_packed(preds, targets, model, track_ids)
+    split = lambda key: list(packed[key].split(packed['counts']))
 
-    nt = targets.shape[0]
-    t_cls, t_box, indices, av, t_track_ids = [], [], [], [], []
-    reject, use_all_anchors = True, True
-    gain = torch.ones(6, device=targets.device)  # normalized to grid space gain
-
-    # m = list(model.modules())[-1]
-    # for i in range(m.nl):
-    #    anchors = m.anchors[i]
-    multi_gpu = type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)
-
-    # build each YOLO layer of corresponding scale
-    for i, idx in enumerate(model.yolo_layer_inds):
-        # get number of grid points and anchor vec for this YOLO layer:
-        # anchors in YOLO layer(feature map)'s scale
-        anchors = model.module.module_list[idx].anchor_vec if multi_gpu else model.module_list[idx].anchor_vec
-
-        # iou of targets-anchors
-        gain[2:] = torch.tensor(preds[i].shape)[[3, 2, 3, 2]]  # xyxy gain
-        t, a = targets * gain, []
-        gwh = t[:, 4:6]  # targets(GT): bbox_w, bbox_h in yolo layer(feature map)'s scale
-        if nt:
-            iou = wh_iou(anchors, gwh)  # iou(3,n) = wh_iou(anchors(3,2), gwh(n,2))
-
-            if use_all_anchors:
-                na = anchors.shape[0]  # number of anchors
-                a = torch.arange(na).view(-1, 1).repeat(1, nt).view(
-                    -1)  # anchor index, N_a × N_gt_box:e.g. 56个0, 56个1, 56个2
-                t = t.repeat(na, 1)  # 56 × 6 -> (56×3) × 6
-                tr_ids = track_ids.repeat(na)  # 56 -> 56×3
-            else:  # use best anchor only
-                iou, a = iou.max(0)  # best iou and anchor
-
-            # reject anchors below iou_thres (OPTIONAL, increases P, lowers R)
-            if reject:
-                # get index whose anchor and gt box's iou exceeds the iou threshold,
-                # defined as positive sample
-                idx = iou.view(-1) > model.hyp['iou_t']  # iou threshold hyper parameter
-                t, a = t[idx], a[idx]
-
-                # GT track ids: for reid classification training
-                tr_ids = tr_ids[idx]
-
-        # Indices
-        b, c = t[:, :2].long().t()  # target image index in the batch, class id
-        gxy = t[:, 2:4]  # grid x, y (GT center)
-        gwh = t[:, 4:6]  # grid w, h
-        gi, gj = gxy.long().t()  # grid x, y indices(int64), .t(): transpose a matrix
-        indices.append((b, a, gj, gi))
-
-        # Box
-        gxy -= gxy.floor()  # GT box center xy 's fractional part
-        t_box.append(torch.cat((gxy, gwh), 1))  # xywh (grids)
-        av.append(anchors[a])  # anchor vectors of corresponding GT boxes
-
-        # GT track ids
-        t_track_ids.append(tr_ids)
-
-        # GT Class ids
-        t_cls.append(c)
-        if c.shape[0]:  # if any targets
-            assert c.max() < model.nc, \
-                'Model accepts %g classes labeled from 0-%g, however you labelled a class %g. ' \
-                'See https://github.com/ultralytics/yolov3/wiki/Train-Custom-Data' % (
-                    model.nc, model.nc - 1, c.max())
-
-    return t_cls, t_box, indices, av, t_track_ids
+    indices = list(zip(split('b'), split('a'), split('gj'), split('gi')))
+    return split('cls'), split('box'), indices, split('anchor'), split('track_ids')
 
 
 def build_targets(preds, targets, model):
+    """
+    Per yolo layer views of build_targets_packed
+    :param preds:
+    :param targets:
+    :param model:
+    :return: t_cls, t_box, indices(b, a, gj, gi) and anchor vectors of each yolo layer
+    """
     # targets = [image, class, x, y, w, h]
+    packed = build_targets_packed(preds, targets, model)
+    split = lambda key: list(packed[key].split(packed['counts']))
 
-    nt = targets.shape[0]
-    t_cls, t_box, indices, av = [], [], [], []
-    reject, use_all_anchors = True, True
-    gain = torch.ones(6, device=targets.device)  # normalized to grid space gain
-
-    # m = list(model.modules())[-1]
-    # for i in range(m.nl):
-    #    anchors = m.anchors[i]
-    multi_gpu = type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)
-    for i, idx in enumerate(model.yolo_layer_inds):  # each YOLO layer of corresponding scale
-        # get number of grid points and anchor vec for this YOLO layer:
-        # anchors in YOLO layer(feature map)'s scale
-        anchors = model.module.module_list[idx].anchor_vec if multi_gpu else model.module_list[idx].anchor_vec
-
-        # iou of targets-anchors
-        gain[2:] = torch.tensor(preds[i].shape)[[3, 2, 3, 2]]  # xyxy gain
-        t, a = targets * gain, []
-        gwh = t[:, 4:6]  # targets(GT): bbox_w, bbox_h in yolo layer(feature map)'s scale
-        if nt:
-            iou = wh_iou(anchors, gwh)  # iou(3,n) = wh_iou(anchors(3,2), gwh(n,2))
-
-            if use_all_anchors:
-                na = anchors.shape[0]  # number of anchors
-                a = torch.arange(na).view(-1, 1).repeat(1, nt).view(
-                    -1)  # anchor index, N_a × N_gt_box:e.g. 56个0, 56个1, 56个2
-                t = t.repeat(na, 1)  # 56 × 6 -> (56×3) × 6
-            else:  # use best anchor only
-                iou, a = iou.max(0)  # best iou and anchor
-
-            # reject anchors below iou_thres (OPTIONAL, increases P, lowers R)
-            if reject:
-                # get index whose anchor and gt box's iou exceeds the iou threshold,
-                # defined as positive sample
-                idx = iou.view(-1) > model.hyp['iou_t']  # iou threshold hyper parameter
-                t, a = t[idx], a[idx]
-
-        # Indices
-        b, c = t[:, :2].long().t()  # target image index in the batch, class id
-        gxy = t[:, 2:4]  # grid x, y (GT center)
-        gwh = t[:, 4:6]  # grid w, h
-        gi, gj = gxy.long().t()  # grid x, y indices(int64), .t(): transpose a matrix
-        indices.append((b, a, gj, gi))
-
-        # Box
-        gxy -= gxy.floor()  # GT box center xy 's fractional part
-        t_box.append(torch.cat((gxy, gwh), 1))  # xywh (grids)
-        av.append(anchors[a])  # anchor vectors of corresponding GT boxes
-
-        # GT Class ids
-        t_cls.append(c)
-        if c.shape[0]:  # if any targets
-            assert c.max() < model.nc, \
-                'Model accepts %g classes labeled from 0-%g, however you labelled a class %g. ' \
-                'See https://github.com/ultralytics/yolov3/wiki/Train-Custom-Data' % (
-                    model.nc, model.nc - 1, c.max())
-
-    return t_cls, t_box, indices, av
+    indices = list(zip(split('b'), split('a'), split('gj'), split('gi')))
+    return split('cls'), split('box'), indices, split('anchor')
 
 
 def non_max_suppression_debug(predictions,
@@ -1323,6 +1352,21 @@ def non_max_suppression_debug(predictions,
     Returns:
          detections with shape: nx6 (x1, y1, x2, y2, conf, cls)
     """
+    if not merge:  # one NMS call for the whole batch
+        # the candidates' indices(in the batch's B×N predictions) are carried through NMS like yolo layer indices
+        B, N = predictions.shape[:2]
+        cand_inds = torch.arange(B * N, device=predictions.device).view(B, N, 1)
+        dets, offsets, cand_inds = non_max_suppression_batched(predictions,
+                                                               conf_thres=conf_thres,
+                                                               iou_thres=iou_thres,
+                                                               classes=classes,
+                                                               agnostic=agnostic,
+                                                               yolo_inds=cand_inds)
+        cand_inds = cand_inds.to(yolo_inds.device)
+        return split_dets(dets[:, 1:], offsets), \
+               split_dets(yolo_inds.reshape(B * N, -1)[cand_inds], offsets), \
+               split_dets(grids.reshape(B * N, -1)[cand_inds.to(grids.device)], offsets)
+
     if predictions.dtype is torch.float16:
         predictions = predictions.float()  # to FP32
 
@@ -1360,7 +1404,7 @@ def non_max_suppression_debug(predictions,
 
         # Detections matrix nx6 (xyxy, conf, cls)
         if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero(as_tupe=False).t()
+            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).t()
 
             boxes = box[i]
             cls_scores = x[i, j + 5, None]
@@ -1431,6 +1475,15 @@ def non_max_suppression_with_yolo_inds(predictions,
     Returns:
          detections with shape: nx6 (x1, y1, x2, y2, conf, cls)
     """
+    if not merge:  # one NMS call for the whole batch
+        dets, offsets, yolo_inds = non_max_suppression_batched(predictions,
+                                                               conf_thres=conf_thres,
+                                                               iou_thres=iou_thres,
+                                                               classes=classes,
+                                                               agnostic=agnostic,
+                                                               yolo_inds=yolo_inds)
+        return split_dets(dets[:, 1:], offsets), split_dets(yolo_inds[:, None], offsets)
+
     if predictions.dtype is torch.float16:
         predictions = predictions.float()  # to FP32
 
@@ -1540,6 +1593,14 @@ def non_max_suppression(predictions,
     :param agnostic:
     :return:
     """
+    if not merge:  # one NMS call for the whole batch
+        dets, offsets, _ = non_max_suppression_batched(predictions,
+                                                       conf_thres=conf_thres,
+                                                       iou_thres=iou_thres,
+                                                       classes=classes,
+                                                       agnostic=agnostic)
+        return split_dets(dets[:, 1:], offsets)
+
     if predictions.dtype is torch.float16:
         predictions = predictions.float()  # to FP32
 
@@ -1618,6 +1679,156 @@ def non_max_suppression(predictions,
     return output
 
 
+def non_max_suppression_sparse(candidates,
+                               batch_size,
+                               conf_thres=0.1,
+                               iou_thres=0.6,
+                               classes=None,
+                               agnostic=False):
+    """
+    Performs Non-Maximum Suppression (NMS) on sparse inference results(Darknet.sparse_decode)
+    Returns:
+         detections with shape: nx6 (x1, y1, x2, y2, conf, cls) and their yolo layer indices
+    :param candidates: n×(2 + no): image index, yolo layer index, x, y, w, h, obj, cls scores
+    :param batch_size: number of images
+    :param conf_thres:
+    :param iou_thres:
+    :param classes:
+    :param agnostic:
+    :return:
+    """
+    dets, offsets, yolo_inds = non_max_suppression_batched(candidates,
+                                                           conf_thres=conf_thres,
+                                                           iou_thres=iou_thres,
+                                                           classes=classes,
+                                                           agnostic=agnostic,
+                                                           batch_size=batch_size)
+    return split_dets(dets[:, 1:], offsets), split_dets(yolo_inds, offsets)
+
+
+def non_max_suppression_batched(predictions,
+                                conf_thres=0.1,
+                                iou_thres=0.6,
+                                classes=None,
+                                agnostic=False,
+                                max_det=300,
+                                pre_nms_topk=3000,
+                                yolo_inds=None,
+                                batch_size=None):
+    """
+    Performs Non-Maximum Suppression (NMS) on the inference results of a whole batch with one NMS call:
+    boxes are offset by image index and class, each image keeps its pre_nms_topk most confident
+    candidates before NMS and its max_det most confident detections after NMS
+    Returns:
+         packed detections of all images sorted by image index: nx7 (img_idx, x1, y1, x2, y2, conf, cls),
+         split offsets: (B + 1): detections of image i are dets[offsets[i]:offsets[i + 1]]
+         and the detections' yolo layer indices(n), None if unknown
+    :param predictions: dense B×N×no inference output,
+    or sparse n×(2 + no) candidates(image index, yolo layer index, x, y, w, h, obj, cls scores)
+    :param conf_thres:
+    :param iou_thres:
+    :param classes:
+    :param agnostic:
+    :param max_det: maximum number of detections per image
+    :param pre_nms_topk: maximum number of candidates per image fed into NMS
+    :param yolo_inds: B×N×1 yolo layer indices of the dense predictions
+    :param batch_size: number of images(sparse candidates only)
+    :return:
+    """
+    if predictions.dtype is torch.float16:
+        predictions = predictions.float()  # to FP32
+
+    # ----- flatten the candidates of all images: image indices, yolo layer indices and n×no predictions
+    if predictions.dim() == 3:  # dense
+        batch_size = predictions.shape[0]
+        xc = predictions[..., 4] > conf_thres  # candidates
+        img_inds = xc.nonzero(as_tuple=False)[:, 0]
+        if yolo_inds is not None:
+            yolo_inds = yolo_inds.view(batch_size, -1)[xc].to(predictions.device)
+        x = predictions[xc]
+    else:  # sparse
+        predictions = predictions[predictions[:, 6] > conf_thres]  # the decoding threshold may be lower
+        img_inds = predictions[:, 0].long()
+        yolo_inds = predictions[:, 1].long()
+        x = predictions[:, 2:]
+
+    # Settings
+    nc = x.shape[1] - 5  # number of classes
+    max_wh = 4096  # (pixels) maximum box width and height
+    multi_label = nc > 1  # multiple labels per box (adds 0.5ms/img)
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).t()
+        x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = (conf.view(-1) > conf_thres).nonzero(as_tuple=False).view(-1)
+        x = torch.cat((box, conf, j.float()), 1)[i]
+    img_inds = img_inds[i]
+    yolo_inds = yolo_inds[i] if yolo_inds is not None else None
+
+    # Filter by class
+    if classes:
+        k = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, img_inds = x[k], img_inds[k]
+        yolo_inds = yolo_inds[k] if yolo_inds is not None else None
+
+    # ----- Per image top-k on confidence before NMS
+    k = top_k_per_image(x[:, 4], img_inds, batch_size, pre_nms_topk)
+    x, img_inds = x[k], img_inds[k]
+    yolo_inds = yolo_inds[k] if yolo_inds is not None else None
+
+    # ----- One NMS for the whole batch: boxes offset by image index and class
+    groups = img_inds * (1 if agnostic else max(nc, 1)) + (0 if agnostic else x[:, 5].long())
+    k = torchvision.ops.boxes.batched_nms(x[:, :4], x[:, 4], groups, iou_thres)
+
+    # ----- Per image max_det cap, packed by image index
+    k = k[top_k_per_image(x[k, 4], img_inds[k], batch_size, max_det)]
+    dets = torch.cat((img_inds[k, None].float(), x[k]), 1)
+    yolo_inds = yolo_inds[k] if yolo_inds is not None else None
+
+    counts = torch.bincount(img_inds[k], minlength=batch_size)
+    offsets = torch.cat((counts.new_zeros(1), counts.cumsum(0)))
+
+    return dets, offsets, yolo_inds
+
+
+def top_k_per_image(scores, img_inds, batch_size, k):
+    """
+    :param scores: n
+    :param img_inds: n image indices
+    :param batch_size: number of images
+    :param k: maximum number of items kept per image
+    :return: indices of each image's k highest scores, sorted by image index then by score(descending)
+    """
+    # sort by image index, then by score descending(scores are in [0, 1])
+    order = (img_inds.double() * 2.0 - scores.double()).argsort()
+
+    # rank of each item in its image
+    counts = torch.bincount(img_inds, minlength=batch_size)
+    starts = counts.cumsum(0) - counts
+    rank = torch.arange(order.shape[0], device=order.device) - starts[img_inds[order]]
+
+    return order[rank < k]
+
+
+def split_dets(dets, offsets):
+    """
+    :param dets: packed detections of a batch(sorted by image index)
+    :param offsets: split offsets(B + 1)
+    :return: list of each image's detections, None if no objects detected in that image
+    """
+    offsets = offsets.tolist()
+    return [dets[start:end] if end > start else None for start, end in zip(offsets[:-1], offsets[1:])]
+
+
 def get_yolo_layers(model):
     """
     :param model:
@@ -0,0 +1,165 @@
+# encoding=utf-8
+
+import queue
+import shutil
+import subprocess
+from threading import Thread
+
+import cv2
+import numpy as np
+
+# end of stream marker
+_END = object()
+
+
+class VideoSink(object):
+    """
+    Streaming video writer: BGR frames are queued and encoded on a background thread,
+    piped as raw video to ffmpeg's stdin or written by cv2.VideoWriter,
+    no intermediate frame is written to disk
+    """
+
+    def __init__(self,
+                 path,
+                 fps,
+                 backend='ffmpeg',
+                 queue_size=8,
+                 bitrate='5000k',
+                 codec='mpeg4'):
+        """
+        :param path: output video path
+        :param fps: output video frame rate
+        :param backend: ffmpeg or cv2
+        :param queue_size: max number of frames waiting to be encoded(write blocks when full)
+        :param bitrate: ffmpeg output bitrate
+        :param codec: ffmpeg output video codec
+        """
+        self.path = path
+        self.fps = fps
+        self.bitrate = bitrate
+        self.codec = codec
+
+        if backend == 'ffmpeg' and shutil.which('ffmpeg') is None:
+            print('[Warning]: ffmpeg not found, use cv2.VideoWriter instead.')
+            backend = 'cv2'
+        if backend not in ('ffmpeg', 'cv2'):
+            print('[Err]: un-recognized video backend {}, use cv2.VideoWriter instead.'.format(backend))
+            backend = 'cv2'
+        self.backend = backend
+
+        self.frame_size = None  # (w, h): set by the first frame
+        self.n_frames = 0
+        self.error = None
+
+        self.proc = None    # ffmpeg process
+        self.writer = None  # cv2.VideoWriter
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(raise_error=exc_type is None)  # do not mask the exception being raised
+
+    def open(self, w, h):
+        """
+        Open the encoder with the first frame's size
+        :param w:
+        :param h:
+        :return:
+        """
+        self.frame_size = (w, h)
+
+        if self.backend == 'ffmpeg':
+            cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                   '-s', '{:d}x{:d}'.format(w, h), '-r', str(self.fps),
+                   '-i', '-',
+                   '-b:v', self.bitrate, '-c:v', self.codec,
+                   self.path]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        else:
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            self.writer = cv2.VideoWriter(self.path, fourcc, self.fps, (w, h))
+
+    def encode(self, frame):
+        """
+        :param frame: H×W×3 BGR uint8 image
+        :return:
+        """
+        h, w = frame.shape[:2]
+        if self.frame_size is None:
+            self.open(w, h)
+        elif self.frame_size != (w, h):
+            print('[Warning]: frame size {:d}×{:d} mismatch the video size {:d}×{:d}, resized.'
+                  .format(w, h, self.frame_size[0], self.frame_size[1]))
+            frame = cv2.resize(frame, self.frame_size, cv2.INTER_LINEAR)
+
+        if self.backend == 'ffmpeg':
+            self.proc.stdin.write(np.ascontiguousarray(frame).data)
+        else:
+            self.writer.write(frame)
+
+        self.n_frames += 1
+
+    def run(self):
+        """
+        Encode the queued frames until the sink is closed
+        :return:
+        """
+        while True:
+            frame = self.queue.get()
+            if frame is _END:
+                break
+            if self.error is not None:  # drop the frames after an error
+                continue
+
+            try:
+                self.encode(frame)
+            except Exception as e:
+                self.error = e
+                print('[Err]: failed to write {}: {}'.format(self.path, e))
+
+        ## ----- Flush and close the encoder
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError as e:  # ffmpeg died: broken pipe
+                if self.error is None:
+                    self.error = e
+            if self.proc.wait() != 0 and self.error is None:
+                self.error = RuntimeError('ffmpeg exited with code {:d}'.format(self.proc.returncode))
+        if self.writer is not None:
+            self.writer.release()
+
+    def write(self, frame):
+        """
+        Queue one frame to be encoded: blocks while the queue is full
+        :param frame: H×W×3 BGR uint8 image(not modified by the caller afterwards)
+        :return:
+        """
+        self.queue.put(frame)
+
+    def close(self, raise_error=True):
+        """
+        Encode the remaining frames and close the video
+        :param raise_error: raise the encoding error(if any), otherwise only print it
+        :return: number of frames written
+        """
+        if self.thread is not None:
+            self.queue.put(_END)
+            self.thread.join()
+            self.thread = None
+
+            if self.error is None:
+                print('{:s} written, {:d} frames.'.format(self.path, self.n_frames))
+            elif raise_error:
+                raise IOError('failed to write {:s} after {:d} frames: {}'
+                              .format(self.path, self.n_frames, self.error)) from self.error
+            else:
+                print('[Err]: failed to write {:s} after {:d} frames: {}'.format(self.path, self.n_frames, self.error))
+
+        return self.n_frames